@@ -1,15 +1,18 @@
 from flask import Flask, request, jsonify
-from pymongo import MongoClient
-import face_recognition
 import base64
-import pickle
+import io
 import numpy as np
 import cv2
 import logging
-import re
+import os
 import threading
-import time
 from flask_cors import CORS
+from gallery import DEFAULT_PARTITION, is_valid_partition
+from gallery_service import GalleryService, FileStore, build_store
+from encoding_format import unpack_encodings
+from face_detection import build_detector
+from face_encoding import build_encoder
+from config import GALLERY_CONFIG, SHARED_GALLERY_CONFIG, SNAPSHOT_CONFIG, STORAGE_CONFIG, READINESS_CONFIG, DETECTION_CONFIG, ENCODING_CONFIG
 import torch
 from transformers import RobertaTokenizer, RobertaForSequenceClassification
 
@@ -17,13 +20,6 @@ from transformers import RobertaTokenizer, RobertaForSequenceClassification
 # Define the path to your saved model folder
 model_path = "./models"
 
-# Load the tokenizer (using the original model base)
-tokenizer = RobertaTokenizer.from_pretrained("roberta-base")
-
-# Load the saved model
-model = RobertaForSequenceClassification.from_pretrained(model_path)
-model.eval()  # Set model to evaluation mode
-
 
 
 def predict_toxicity(text):
@@ -57,17 +53,73 @@ def predict_toxicity(text):
 app = Flask(__name__)
 CORS(app)
 
-client = MongoClient('mongodb://localhost:27017/')
-db = client['face_recognition_db']
-users_collection = db['users']
-
 logging.basicConfig(level=logging.INFO)
 
-# Global variables to store known faces in memory.
-known_face_encodings = []
-known_face_names = []
-# A simple checksum (e.g., number of users) to detect changes.
-db_checksum = None
+# 'standalone', 'writer' or 'reader'; see SHARED_GALLERY_CONFIG.
+GALLERY_ROLE = os.environ.get('VELORA_GALLERY_ROLE', 'standalone')
+# Upper bound for the number of candidates returned by /face-recognizer in top-k mode.
+MAX_TOP_K = 50
+
+# Set by init_services().
+tokenizer = model = None
+store = gallery_service = detector = encoder = None
+services_lock = threading.Lock()
+services_started = False
+
+def init_services():
+    """Load the models and open the user store and the gallery used by the request handlers.
+
+    Not done at import: on spawn platforms (Windows) the worker processes of
+    the index shards and of the legacy conversion import this module again,
+    and must not load RoBERTa, connect to MongoDB or time the detectors.
+    Called once per serving process through start_services().
+    """
+    global tokenizer, model, store, gallery_service, detector, encoder
+    # Load the tokenizer (using the original model base)
+    tokenizer = RobertaTokenizer.from_pretrained("roberta-base")
+    # Load the saved model
+    model = RobertaForSequenceClassification.from_pretrained(model_path)
+    model.eval()  # Set model to evaluation mode
+
+    # User store (see STORAGE_CONFIG), also used for lookups outside the in-memory gallery.
+    store = build_store(STORAGE_CONFIG['backend'], **STORAGE_CONFIG['params'])
+    # Known faces in memory: one matcher per partition (tenant/site/group), kept current
+    # in the background. Readers map the galleries published by the writer instead.
+    if GALLERY_ROLE == 'reader':
+        gallery_service = GalleryService(FileStore(SHARED_GALLERY_CONFIG['directory'], matcher_options=GALLERY_CONFIG),
+                                         GALLERY_CONFIG)
+    else:
+        gallery_service = GalleryService(
+            store, GALLERY_CONFIG,
+            snapshot_directory=os.path.join(SNAPSHOT_CONFIG['directory'], 'api'),
+            snapshot_interval=SNAPSHOT_CONFIG['min_interval'],
+            serve_mapped=SNAPSHOT_CONFIG['serve_mapped'],
+            publish_directory=SHARED_GALLERY_CONFIG['directory'] if GALLERY_ROLE == 'writer' else None)
+
+    # Face detection pipeline (backend, bounded resolution, Haar pre-filter); see DETECTION_CONFIG.
+    detector = build_detector(DETECTION_CONFIG)
+    encoder = build_encoder(ENCODING_CONFIG, 'api')
+
+def start_services():
+    """Run init_services() and start the gallery updater, once per process."""
+    global services_started
+    if services_started:
+        return
+    with services_lock:
+        if not services_started:
+            init_services()
+            start_gallery_updater()
+            services_started = True
+
+def create_app():
+    """App factory for WSGI servers, e.g. gunicorn 'app:create_app()': starts the services of the worker."""
+    start_services()
+    return app
+
+@app.before_request
+def ensure_services():
+    # A WSGI server importing app:app starts the services of each worker on its first request.
+    start_services()
 
 def decode_base64_image(image_base64):
     try:
@@ -86,108 +138,205 @@ def decode_base64_image(image_base64):
         logging.error(f"Error decoding base64 image: {e}")
         return None
 
-def get_face_encoding(image):
+def decode_image_buffer(buffer):
+    """Decode an encoded image (JPEG, PNG, ...) straight from a bytes-like buffer, without copying it."""
+    np_arr = np.frombuffer(buffer, np.uint8)
+    if not np_arr.size:
+        return None
+    return cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+
+def decode_image(payload):
+    """Decode the 'image' of a request: a base64 string (JSON) or the raw encoded bytes; None if invalid."""
+    if isinstance(payload, str):
+        return decode_base64_image(payload)
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return decode_image_buffer(payload)
+    # Any other JSON value (number, null, list, ...).
+    return None
+
+def _form_params(values):
+    params = values.to_dict()
+    if 'top_k' in params:
+        try:
+            params['top_k'] = int(params['top_k'])
+        except ValueError:
+            pass  # Rejected with the other invalid values.
+    return params
+
+def read_request_data():
+    """Return the parameters of an image request, the encoded image under 'image'.
+
+    Three formats are accepted:
+    - a raw image body (Content-Type image/jpeg, image/png, ... or application/octet-stream)
+      with the other parameters in the query string;
+    - a multipart/form-data upload with the image in the 'image' file field and the other
+      parameters as form fields;
+    - JSON with a base64 'image', as before.
+    The binary formats are decoded from the request buffer with no base64 step or extra copy.
+    """
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        data = _form_params(request.args)
+        body = request.get_data(cache=False)
+        if body:
+            data['image'] = body
+        return data
+    if request.mimetype == 'multipart/form-data':
+        data = _form_params(request.form)
+        upload = request.files.get('image')
+        if upload is not None:
+            # Small uploads are spooled in memory: use that buffer instead of reading a copy.
+            stream = upload.stream
+            data['image'] = stream.getbuffer() if isinstance(stream, io.BytesIO) else stream.read()
+        return data
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+def get_face_encoding(image, payload=None):
+    """Encode the first face of a BGR image, found with the DETECTION_CONFIG pipeline.
+
+    payload is the encoded upload the image was decoded from, used for a
+    reduced-size decode when DETECTION_CONFIG['reduced_decode'] is set.
+    """
     try:
         rgb_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        face_locations = face_recognition.face_locations(rgb_img)
+        face_locations = detector.locate(rgb_img, detector.reduced_copy(image.shape, payload))
         if not face_locations:
             return None
-        face_encodings = face_recognition.face_encodings(rgb_img, face_locations)
+        face_encodings = encoder.encode(rgb_img, face_locations)
         return face_encodings[0] if face_encodings else None
     except Exception as e:
         logging.error(f"Error extracting face encoding: {e}")
         return None
 
-def update_known_faces():
-    """
-    Background job that periodically:
-    1. Scans the database to update any records stored in a JS (Base64) format into pickled encodings.
-    2. Loads all face encodings and names into memory.
+def start_gallery_updater():
+    """Start the thread that loads the gallery of this worker (from the saved snapshot if any) and keeps it current.
+
+    Returns at once: requests are gated on readiness (see gallery_not_ready).
     """
-    global known_face_encodings, known_face_names, db_checksum
-    while True:
-        try:
-            users = list(users_collection.find({}))
-            # Compute a simple checksum (e.g., total count)
-            new_checksum = len(users)
-            # Only update if the checksum has changed or force update every time
-            if new_checksum != db_checksum:
-                logging.info("Detected change in user database. Updating known faces...")
-                db_checksum = new_checksum
-            # Clear current lists
-            known_face_encodings = []
-            known_face_names = []
-            for user in users:
-                stored_data = user['face_encoding']
-                try:
-                    # Attempt to load as pickled data
-                    face_encoding = pickle.loads(stored_data)
-                except Exception as pickle_error:
-                    logging.warning(f"Pickle load failed for user {user['name']} (likely stored from JS). Converting.")
-                    try:
-                        # If stored_data is a string, assume Base64 and remove header.
-                        if isinstance(stored_data, str):
-                            base64_str = re.sub(r"^data:image\/\w+;base64,", "", stored_data)
-                            image_data = base64.b64decode(base64_str)
-                        else:
-                            image_data = stored_data
-
-                        np_arr = np.frombuffer(image_data, np.uint8)
-                        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-                        if img is None:
-                            logging.error(f"Failed to decode image for user {user['name']}.")
-                            continue
-
-                        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                        face_locations = face_recognition.face_locations(rgb_img, model="hog")
-                        if not face_locations:
-                            logging.warning(f"No face detected for user {user['name']}.")
-                            continue
-
-                        face_encodings = face_recognition.face_encodings(rgb_img, face_locations)
-                        if not face_encodings:
-                            logging.warning(f"Face encoding failed for user {user['name']}.")
-                            continue
-
-                        face_encoding = face_encodings[0]
-                        # Pickle the computed encoding
-                        pickled_encoding = pickle.dumps(face_encoding)
-                        users_collection.update_one({'_id': user['_id']}, {'$set': {'face_encoding': pickled_encoding}})
-                        logging.info(f"Updated user {user['name']} with pickled encoding.")
-                    except Exception as js_error:
-                        logging.error(f"Error converting JS data for user {user['name']}: {js_error}")
-                        continue
-
-                known_face_encodings.append(face_encoding)
-                known_face_names.append(user['name'])
-            logging.info(f"Loaded {len(known_face_encodings)} known faces into memory.")
-        except Exception as e:
-            logging.error(f"Error in background update: {e}")
-        # Sleep for 60 seconds (adjust as needed)
-        time.sleep(10)
+    if GALLERY_ROLE == 'reader':
+        return gallery_service.start(SHARED_GALLERY_CONFIG['poll_interval'])
+    return gallery_service.start(STORAGE_CONFIG['sync_interval'])
+
+def gallery_not_ready():
+    """Return a 503 response if the gallery is still loading after a bounded wait, or None once it is served."""
+    if gallery_service.wait_ready(READINESS_CONFIG['max_wait']):
+        return None
+    response = jsonify({'error': 'Gallery is still loading', **gallery_service.readiness()})
+    response.headers['Retry-After'] = str(READINESS_CONFIG['retry_after'])
+    return response, 503
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe: 200 once the gallery is served, 503 with the loading progress before."""
+    readiness = gallery_service.readiness()
+    if not readiness['ready']:
+        response = jsonify(readiness)
+        response.headers['Retry-After'] = str(READINESS_CONFIG['retry_after'])
+        return response, 503
+    return jsonify(readiness), 200
 
 @app.route('/face-recognizer', methods=['POST'])
 def face_recognizer():
-    data = request.json
+    data = read_request_data()
     if 'image' not in data:
         return jsonify({'error': 'No image provided'}), 400
 
-    image_base64 = data['image']
-    image = decode_base64_image(image_base64)
+    not_ready = gallery_not_ready()
+    if not_ready:
+        return not_ready
+
+    # Only the gallery of the requested partition is searched.
+    partition = data.get('partition', DEFAULT_PARTITION)
+    if not is_valid_partition(partition):
+        return jsonify({'error': 'Invalid partition'}), 400
+    gallery = gallery_service.get(partition)
+    if gallery is None:
+        return jsonify({'error': f'Unknown partition {partition}'}), 404
+
+    image = decode_image(data['image'])
     if image is None:
         return jsonify({'error': 'Invalid image data'}), 400
 
-    face_encoding = get_face_encoding(image)
+    face_encoding = get_face_encoding(image, data['image'])
     if face_encoding is None:
         return jsonify({'error': 'No face detected'}), 400
 
-    # Compare against the known faces in memory.
-    for stored_encoding, name in zip(known_face_encodings, known_face_names):
-        match = face_recognition.compare_faces([stored_encoding], face_encoding, tolerance=0.6)
-        if match[0]:
-            return jsonify({'name': name}), 200
+    top_k = data.get('top_k')
+    if top_k is None:
+        # Compare against all known faces in memory at once.
+        name, distance = gallery.best_match(face_encoding, tolerance=0.6)
+        return jsonify({'name': name or 'Unknown', 'distance': distance}), 200
+
+    if not isinstance(top_k, int) or isinstance(top_k, bool) or not 1 <= top_k <= MAX_TOP_K:
+        return jsonify({'error': f'top_k must be an integer between 1 and {MAX_TOP_K}'}), 400
+
+    # Always fetch at least two candidates so the top-1/top-2 margin can be reported.
+    candidates = gallery.top_k(face_encoding, k=max(top_k, 2))
+    name, distance = candidates[0] if candidates else ('Unknown', None)
+    if distance is not None and distance > 0.6:
+        name = 'Unknown'
+    margin = candidates[1][1] - candidates[0][1] if len(candidates) > 1 else None
+    return jsonify({
+        'name': name,
+        'distance': distance,
+        'margin': margin,
+        'candidates': [{'name': n, 'distance': d} for n, d in candidates[:top_k]]
+    }), 200
+
+@app.route('/face-verify', methods=['POST'])
+def face_verify():
+    """1:1 verification: compare the image only with the templates of the claimed user."""
+    data = read_request_data()
+    if 'image' not in data:
+        return jsonify({'error': 'No image provided'}), 400
+
+    name = data.get('name')
+    if name is None and 'user_id' in data:
+        try:
+            name = store.user_name(data['user_id'])
+        except ValueError:
+            return jsonify({'error': 'Invalid user_id'}), 400
+        if name is None:
+            return jsonify({'error': 'Unknown user'}), 404
+    if not name:
+        return jsonify({'error': 'No claimed name or user_id provided'}), 400
+    if not isinstance(name, str):
+        return jsonify({'error': 'Invalid name'}), 400
+
+    not_ready = gallery_not_ready()
+    if not_ready:
+        return not_ready
+    partition = data.get('partition', DEFAULT_PARTITION)
+    if not is_valid_partition(partition):
+        return jsonify({'error': 'Invalid partition'}), 400
+    gallery = gallery_service.get(partition)
+    if gallery is None:
+        return jsonify({'error': f'Unknown partition {partition}'}), 404
+
+    image = decode_image(data['image'])
+    if image is None:
+        return jsonify({'error': 'Invalid image data'}), 400
+
+    face_encoding = get_face_encoding(image, data['image'])
+    if face_encoding is None:
+        return jsonify({'error': 'No face detected'}), 400
+
+    match, distance = gallery.verify(name, face_encoding, tolerance=0.6)
+    if match is None:
+        # Not in memory yet (e.g. enrolled since the last reload): look the user up in the store.
+        data = store.find_user(name, partition)
+        templates = unpack_encodings(data) if data else []
+        if not len(templates):
+            return jsonify({'error': f'Unknown user {name}'}), 404
+        distance = float(np.linalg.norm(templates - face_encoding, axis=1).min())
+        match = distance <= 0.6
+
+    return jsonify({'name': name, 'match': bool(match), 'distance': distance}), 200
 
-    return jsonify({'name': 'Unknown'}), 200
+@app.route('/gallery-stats', methods=['GET'])
+def gallery_stats():
+    """Sizes of the in-memory galleries and refresh metrics of this worker."""
+    return jsonify(gallery_service.stats()), 200
 
 @app.route('/find-toxicity', methods=['POST'])
 def find_toxicity():
@@ -233,7 +382,6 @@ def predict_toxicity(text):
 
 
 if __name__ == '__main__':
-    # Start the background thread to update known faces.
-    updater_thread = threading.Thread(target=update_known_faces, daemon=True)
-    updater_thread.start()
+    # Loads the models and starts the background thread that keeps the known faces current.
+    start_services()
     app.run(debug=True)
@@ -0,0 +1,149 @@
+import argparse
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from face_detection import DETECTOR_BACKENDS, HaarPrefilter, build_backend, locate_faces, reduction_factor, decode_reduced
+from face_encoding import build_encoder
+from config import DETECTION_CONFIG, ENCODING_CONFIG
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def box_iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes."""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, bottom - top) * max(0, right - left)
+    area = lambda box: (box[2] - box[0]) * (box[1] - box[3])
+    return inter / float(area(a) + area(b) - inter) if inter else 0.0
+
+
+def timed(function, repeat):
+    """Return (median seconds, last result) of repeat calls of function."""
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), result
+
+
+def compare(reference, boxes, encodings):
+    """Return (recall, mean IoU, largest encoding distance) of boxes against the full-resolution reference.
+
+    Every reference face is matched with the detected box overlapping it
+    most (IoU >= 0.5); the encoding distance measures how much the mapped
+    back box changes the encoding computed from it.
+    """
+    found, ious, drift = 0, [], 0.0
+    for ref_box, ref_encoding in reference:
+        overlaps = [box_iou(ref_box, box) for box in boxes]
+        if not overlaps or max(overlaps) < 0.5:
+            continue
+        best = int(np.argmax(overlaps))
+        found += 1
+        ious.append(overlaps[best])
+        drift = max(drift, float(np.linalg.norm(encodings[best] - ref_encoding)))
+    recall = found / len(reference) if reference else 1.0
+    return recall, float(np.mean(ious)) if ious else 0.0, drift
+
+
+def report(label, detect_seconds, total_seconds, faces, row):
+    recall, iou, drift = row
+    print(f"{label:<22}{1000 * detect_seconds:>12.1f}{1000 * total_seconds:>12.1f}{faces:>7}"
+          f"{recall:>9.2f}{iou:>9.3f}{drift:>12.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark face detection latency and accuracy per detection resolution.")
+    parser.add_argument("--image", default="1.jpg", help="image to detect faces in")
+    parser.add_argument("--upscale", type=float, default=1.0,
+                        help="enlarge the image first, e.g. 3 to emulate a 12 MP phone upload")
+    parser.add_argument("--max-sides", type=int, nargs="+", default=[1280, 960, 800, 640, 480, 320],
+                        help="detection resolutions (longest side) to compare with the full image")
+    parser.add_argument("--backend", default="hog", choices=list(DETECTOR_BACKENDS),
+                        help="detector backend, with its DETECTION_CONFIG options")
+    parser.add_argument("--upsample", type=int, help="upsampling passes of the hog and cnn backends")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement (median reported)")
+    parser.add_argument("--haar", action="store_true",
+                        help="also measure the Haar cascade pre-filter (recall and cost on a face-free frame)")
+    parser.add_argument("--min-neighbors", type=int, default=3, help="Haar cascade minNeighbors")
+    args = parser.parse_args()
+
+    params = dict(DETECTION_CONFIG['backends'].get(args.backend, {}))
+    if args.upsample is not None and args.backend in ('hog', 'cnn'):
+        params['upsample'] = args.upsample
+    backend = build_backend(args.backend, **params)
+
+    image = cv2.imread(args.image)
+    if image is None:
+        raise SystemExit(f"Cannot read {args.image}")
+    if args.upscale != 1.0:
+        image = cv2.resize(image, None, fx=args.upscale, fy=args.upscale, interpolation=cv2.INTER_CUBIC)
+    payload = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+    logging.info(f"{args.image}: {image.shape[1]}x{image.shape[0]}, {len(payload) / 2**20:.1f} MiB as JPEG")
+
+    decode_seconds, decoded = timed(lambda: cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR), args.repeat)
+    rgb = cv2.cvtColor(decoded, cv2.COLOR_BGR2RGB)
+    logging.info(f"Full JPEG decode takes {1000 * decode_seconds:.1f} ms")
+
+    # Encodings as the API computes them.
+    encoder = build_encoder(ENCODING_CONFIG, 'api')
+
+    def encode(boxes):
+        return encoder.encode(rgb, boxes)
+
+    # Reference: detection and encodings at full resolution, as before.
+    full_seconds, full_boxes = timed(lambda: locate_faces(rgb, None, backend), args.repeat)
+    encode_seconds, full_encodings = timed(lambda: encode(full_boxes), args.repeat)
+    reference = list(zip(full_boxes, full_encodings))
+
+    prefilter = HaarPrefilter(min_neighbors=args.min_neighbors) if args.haar else None
+    if prefilter is not None:
+        # Kiosk frames mostly hold no face: compare the detector with the cascade rejecting it.
+        empty = np.full((480, 640, 3), 128, np.uint8)
+        detector_seconds, _ = timed(lambda: locate_faces(empty, None, backend), args.repeat)
+        haar_seconds, _ = timed(lambda: locate_faces(empty, None, backend, prefilter=prefilter),
+                                args.repeat)
+        logging.info(f"Face-free 640x480 frame: {1000 * detector_seconds:.1f} ms detector only, "
+                     f"{1000 * haar_seconds:.1f} ms with the Haar pre-filter")
+
+    print(f"{'detection':<22}{'detect ms':>12}{'+encode ms':>12}{'faces':>7}{'recall':>9}{'IoU':>9}{'enc drift':>12}")
+    report(f"full {image.shape[1]}x{image.shape[0]}", full_seconds, full_seconds + encode_seconds,
+           len(full_boxes), (1.0 if full_boxes else 0.0, 1.0 if full_boxes else 0.0, 0.0))
+
+    for max_side in args.max_sides:
+        if max_side >= max(image.shape[:2]):
+            continue
+        seconds, boxes = timed(lambda: locate_faces(rgb, max_side, backend), args.repeat)
+        encode_seconds, encodings = timed(lambda: encode(boxes), args.repeat)
+        report(f"resize {max_side}", seconds, seconds + encode_seconds, len(boxes),
+               compare(reference, boxes, encodings))
+
+        if prefilter is not None:
+            seconds, boxes = timed(lambda: locate_faces(rgb, max_side, backend, prefilter=prefilter),
+                                   args.repeat)
+            encode_seconds, encodings = timed(lambda: encode(boxes), args.repeat)
+            report(f"haar + resize {max_side}", seconds, seconds + encode_seconds, len(boxes),
+                   compare(reference, boxes, encodings))
+
+        # Same resolution bound through a reduced JPEG decode instead of a resize.
+        factor = reduction_factor(image.shape, max_side)
+        if factor == 1:
+            continue
+
+        def reduced_detection():
+            reduced = cv2.cvtColor(decode_reduced(payload, factor), cv2.COLOR_BGR2RGB)
+            return locate_faces(rgb, max_side, backend, detection_image=reduced)
+
+        seconds, boxes = timed(reduced_detection, args.repeat)
+        encode_seconds, encodings = timed(lambda: encode(boxes), args.repeat)
+        report(f"reduced 1/{factor} ({max_side})", seconds, seconds + encode_seconds, len(boxes),
+               compare(reference, boxes, encodings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+
+from face_detection import build_detector
+from face_encoding import profile_encoder
+from config import DETECTION_CONFIG, ENCODING_CONFIG
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def variants(image):
+    """Return (label, BGR image) degraded copies of image, standing in for other captures of its face."""
+    height, width = image.shape[:2]
+    noise = np.random.default_rng(0).normal(0.0, 8.0, image.shape)
+    copies = [
+        ('darker', cv2.convertScaleAbs(image, alpha=0.6, beta=0)),
+        ('brighter', cv2.convertScaleAbs(image, alpha=1.3, beta=20)),
+        ('blur', cv2.GaussianBlur(image, (5, 5), 0)),
+        ('noise', np.clip(image + noise, 0, 255).astype(np.uint8)),
+        ('half size', cv2.resize(image, (width // 2, height // 2), interpolation=cv2.INTER_AREA)),
+        ('jpeg 30', cv2.imdecode(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 30])[1], cv2.IMREAD_COLOR)),
+    ]
+    for angle in (-8, 8):
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+        copies.append((f"rotated {angle}", cv2.warpAffine(image, rotation, (width, height), borderMode=cv2.BORDER_REFLECT)))
+    return copies
+
+
+def load_captures(args):
+    """Return {identity: [BGR images]}, the first image of each identity being its enrollment capture.
+
+    With --dataset every sub-directory is one person; otherwise each sample
+    image is one person, probed with degraded copies of itself.
+    """
+    captures = {}
+    if args.dataset:
+        for identity in sorted(os.listdir(args.dataset)):
+            directory = os.path.join(args.dataset, identity)
+            if not os.path.isdir(directory):
+                continue
+            for file_name in sorted(os.listdir(directory)):
+                if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                    image = cv2.imread(os.path.join(directory, file_name))
+                    if image is not None:
+                        captures.setdefault(identity, []).append(image)
+        return captures
+    for path in args.images:
+        image = cv2.imread(path)
+        if image is None:
+            raise SystemExit(f"Cannot read {path}")
+        captures[path] = [image] + [copy for _, copy in variants(image)]
+    return captures
+
+
+def largest_face(detector, rgb):
+    """Return the box of the largest face of an RGB image, or None."""
+    boxes = detector.locate(rgb)
+    if not boxes:
+        return None
+    return max(boxes, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark encoding latency and verification accuracy per encoding profile.")
+    parser.add_argument("--images", nargs="+", default=["1.jpg"],
+                        help="sample images, one person each, probed with degraded copies of themselves")
+    parser.add_argument("--dataset", metavar="DIR",
+                        help="directory with one sub-directory of images per person (first image enrolled)")
+    parser.add_argument("--profiles", nargs="+", default=list(ENCODING_CONFIG['profiles']),
+                        help="encoding profiles of the probes")
+    parser.add_argument("--template-profile", default=ENCODING_CONFIG['registration'],
+                        help="encoding profile of the enrolled templates")
+    parser.add_argument("--tolerance", type=float, default=0.6, help="verification distance threshold")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per latency measurement (median reported)")
+    args = parser.parse_args()
+
+    detector = build_detector(DETECTION_CONFIG)
+    # identity -> [(rgb, box)] of the captures where a face was found.
+    faces = {}
+    for identity, images in load_captures(args).items():
+        for image in images:
+            rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            box = largest_face(detector, rgb)
+            if box is None:
+                logging.warning(f"No face found in a capture of {identity}; skipped.")
+                continue
+            faces.setdefault(identity, []).append((rgb, box))
+    faces = {identity: found for identity, found in faces.items() if len(found) > 1}
+    if not faces:
+        raise SystemExit("Need at least one person with an enrollment capture and a probe capture.")
+
+    template_encoder = profile_encoder(ENCODING_CONFIG, args.template_profile)
+    identities = sorted(faces)
+    templates = []
+    for identity in identities:
+        rgb, box = faces[identity][0]
+        templates.append(template_encoder.encode(rgb, [box])[0])
+    templates = np.array(templates)
+    probes = sum(len(found) - 1 for found in faces.values())
+    logging.info(f"{len(identities)} enrolled with the '{args.template_profile}' profile, {probes} probes, "
+                 f"tolerance {args.tolerance}")
+
+    print(f"{'profile':<12}{'model':>7}{'jitters':>9}{'ms/face':>10}{'accept':>9}{'mean dist':>11}{'false acc':>11}")
+    for profile in args.profiles:
+        encoder = profile_encoder(ENCODING_CONFIG, profile)
+        times, genuine, impostor = [], [], []
+        for index, identity in enumerate(identities):
+            for rgb, box in faces[identity][1:]:
+                runs = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    encoding = encoder.encode(rgb, [box])[0]
+                    runs.append(time.perf_counter() - start)
+                times.append(float(np.median(runs)))
+                distances = np.linalg.norm(templates - encoding, axis=1)
+                genuine.append(distances[index])
+                impostor.extend(np.delete(distances, index))
+        genuine = np.array(genuine)
+        false_accept = f"{np.mean(np.array(impostor) <= args.tolerance):.3f}" if impostor else "n/a"
+        print(f"{profile:<12}{encoder.model:>7}{encoder.num_jitters:>9}{1000 * np.median(times):>10.1f}"
+              f"{np.mean(genuine <= args.tolerance):>9.3f}{genuine.mean():>11.3f}{false_accept:>11}")
+
+
+if __name__ == "__main__":
+    main()
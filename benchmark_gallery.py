@@ -0,0 +1,152 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from gallery import GalleryMatcher, SharedGallery, publish_shared_gallery, ENCODING_DIM
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def synthetic_gallery(size, clusters=64, seed=0):
+    """Generate clustered face-like encodings; same-person distances land around 0.3."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0.0, 0.1, (clusters, ENCODING_DIM))
+    encodings = centers[rng.integers(0, clusters, size)] + rng.normal(0.0, 0.07, (size, ENCODING_DIM))
+    names = [f"user{i}" for i in range(size)]
+    return encodings, names
+
+
+def synthetic_probes(encodings, count, seed=1):
+    """Noisy captures of randomly chosen enrolled users; returns (probes, true row ids)."""
+    rng = np.random.default_rng(seed)
+    truth = rng.integers(0, len(encodings), count)
+    probes = encodings[truth] + rng.normal(0.0, 0.02, (count, ENCODING_DIM))
+    return probes, truth
+
+
+def float64_reference(encodings, probes):
+    """Return (nearest row id, distance) per probe computed with an exact float64 scan."""
+    nearest = np.empty(len(probes), dtype=np.intp)
+    distance = np.empty(len(probes))
+    for i, probe in enumerate(probes):
+        distances = np.linalg.norm(encodings - probe, axis=1)
+        nearest[i] = np.argmin(distances)
+        distance[i] = distances[nearest[i]]
+    return nearest, distance
+
+
+def run(matcher, probes, truth, reference):
+    """Return a result row for best_match over all probes.
+
+    Besides latency and top-1 accuracy the row reports the drift against the
+    float64 reference: how often the top-1 row agrees with it, and the largest
+    distance error of the raw index scores and of the final re-ranked result.
+    """
+    reference_ids, reference_distances = reference
+    names = []
+    start = time.perf_counter()
+    for probe in probes:
+        names.append(matcher.best_match(probe)[0])
+    elapsed = time.perf_counter() - start
+
+    agree, index_drift, final_drift = 0, 0.0, 0.0
+    for probe, expected, distance in zip(probes, reference_ids, reference_distances):
+        ids, scores = matcher.index.search(probe.astype(np.float32), 1)
+        final_ids, final_distances = matcher.search(probe, k=1)
+        agree += final_ids[0] == expected
+        if ids[0] == expected:
+            index_drift = max(index_drift, abs(np.sqrt(scores[0]) - distance))
+        final_drift = max(final_drift, abs(final_distances[0] - distance))
+
+    correct = sum(name == matcher.names[expected] for name, expected in zip(names, truth))
+    return (1000 * elapsed / len(probes), correct / len(probes), agree / len(probes),
+            index_drift, final_drift)
+
+
+def report(label, row):
+    latency, accuracy, agreement, index_drift, final_drift = row
+    print(f"{label:<20}{latency:>10.3f}{accuracy:>10.3f}{agreement:>10.3f}"
+          f"{index_drift:>14.2e}{final_drift:>14.2e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gallery search backends.")
+    parser.add_argument("--size", type=int, default=100000, help="number of enrolled faces")
+    parser.add_argument("--probes", type=int, default=200, help="number of probe encodings")
+    parser.add_argument("--backends", nargs="+", default=["sharded", "quantized", "ivf", "pq"],
+                        choices=["sharded", "quantized", "ivf", "pq"],
+                        help="backends to compare with the linear scan")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32],
+                        help="IVF buckets scanned per probe")
+    parser.add_argument("--pq-m", type=int, nargs="+", default=[16, 32],
+                        help="PQ bytes per face")
+    parser.add_argument("--pq-rerank", type=int, default=64,
+                        help="PQ candidates re-scored with exact distances")
+    parser.add_argument("--shards", type=int, nargs="+", default=[2, 4],
+                        help="worker processes for the sharded backend")
+    parser.add_argument("--snapshot", metavar="DIR",
+                        help="also time writing a warm-start snapshot to DIR and mapping it back")
+    args = parser.parse_args()
+
+    encodings, names = synthetic_gallery(args.size)
+    probes, truth = synthetic_probes(encodings, args.probes)
+    reference = float64_reference(encodings, probes)
+
+    print(f"{'backend':<20}{'ms/probe':>10}{'top-1':>10}{'agree64':>10}"
+          f"{'index drift':>14}{'final drift':>14}")
+    linear = GalleryMatcher(encodings, names, index='linear')
+    report('linear', run(linear, probes, truth, reference))
+
+    if 'sharded' in args.backends:
+        for shards in args.shards:
+            sharded = GalleryMatcher(encodings, names, index='sharded', index_params={'shards': shards, 'min_rows': 0})
+            report(f'sharded x{shards}', run(sharded, probes, truth, reference))
+            sharded.index.close()
+
+    if 'quantized' in args.backends:
+        for dtype in ('float16', 'int8'):
+            quantized = GalleryMatcher(encodings, names, index='quantized', index_params={'dtype': dtype})
+            logging.info(f"{dtype} scan copy uses {quantized.index.codes.nbytes / 2**20:.1f} MiB "
+                         f"vs {linear.matrix.nbytes / 2**20:.1f} MiB for the float32 matrix")
+            report(f'quantized {dtype}', run(quantized, probes, truth, reference))
+
+    if 'ivf' in args.backends:
+        start = time.perf_counter()
+        ivf = GalleryMatcher(encodings, names, index='ivf')
+        logging.info(f"IVF build took {time.perf_counter() - start:.2f}s")
+        for nprobe in args.nprobe:
+            ivf.index.nprobe = nprobe
+            report(f'ivf nprobe={nprobe}', run(ivf, probes, truth, reference))
+
+    if 'pq' in args.backends:
+        for m in args.pq_m:
+            start = time.perf_counter()
+            pq = GalleryMatcher(encodings, names, index='pq', index_params={'m': m}, rerank=args.pq_rerank)
+            logging.info(f"PQ m={m} build took {time.perf_counter() - start:.2f}s, "
+                         f"codes use {pq.index.codes.nbytes / 2**20:.1f} MiB "
+                         f"vs {linear.matrix.nbytes / 2**20:.1f} MiB for the float32 matrix")
+            report(f'pq m={m}', run(pq, probes, truth, reference))
+
+    if args.snapshot:
+        start = time.perf_counter()
+        publish_shared_gallery(args.snapshot, encodings, names)
+        logging.info(f"Snapshot write took {time.perf_counter() - start:.2f}s")
+        start = time.perf_counter()
+        snapshot = SharedGallery(args.snapshot)
+        snapshot.refresh()
+        logging.info(f"Warm start (map snapshot and build matcher) took {time.perf_counter() - start:.2f}s")
+        report('snapshot', run(snapshot.matcher, probes, truth, reference))
+        if 'quantized' in args.backends:
+            # As served with SNAPSHOT_CONFIG['serve_mapped']: the int8 codes on the heap, the
+            # float32 rows read from the mapped file only for the re-ranked shortlist.
+            mapped = SharedGallery(args.snapshot, index='quantized')
+            mapped.refresh()
+            logging.info(f"Mapped int8 gallery keeps {mapped.matcher.index.codes.nbytes / 2**20:.1f} MiB of codes "
+                         f"in memory, its {mapped.matcher.matrix.nbytes / 2**20:.1f} MiB matrix stays mapped")
+            report('snapshot int8', run(mapped.matcher, probes, truth, reference))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,157 @@
 MONGODB_CONFIG = {
     'host': 'mongodb://localhost:27017/',
     'database': 'face_recognition_db',
-    'collection': 'users'
-}
\ No newline at end of file
+    'collection': 'users',
+    # Optional collection of packed gallery chunks (see gallery_chunks.py), e.g. 'gallery_chunks':
+    # the gallery is then loaded a few thousand users per document. None reads every user.
+    'chunk_collection': None
+}
+
+GALLERY_CONFIG = {
+    # Search backend: 'linear' (exact scan), 'ivf' (inverted file, approximate),
+    # 'pq' (product quantization, m bytes per face, approximate),
+    # 'quantized' (scan over an int8 or float16 copy of the gallery, approximate),
+    # 'sharded' (scatter/gather over worker processes, one shard each) or
+    # 'centroid' (per-person centroids first, then the templates of the nearest people).
+    # 'auto' picks 'centroid' when anyone has several templates and 'linear' otherwise.
+    'index': 'auto',
+    # Parameters of the chosen backend, for example:
+    # 'ivf': {'nlist': None, 'nprobe': 8} - nlist buckets (default 4 * sqrt(N)) and nprobe
+    #        buckets scanned per probe; raising nprobe improves recall at the cost of latency.
+    #        Reloads keep the trained buckets and only assign changed faces; they train again
+    #        every 'retrain_every' (100) reloads or when faces drift 'max_drift' (1.5) times
+    #        further from their bucket than at training.
+    # 'pq': {'m': 16} or {'m': 32} bytes per face. The float32 rows are still needed for the
+    #       re-ranking; by default (SNAPSHOT_CONFIG['serve_mapped']) they stay memory-mapped and
+    #       only the re-ranked rows are read. A memory option for very large galleries: a probe
+    #       costs more than with 'linear' below about 100k faces (0.8 vs 0.25 ms at 5k faces,
+    #       13.5 vs 35 ms at 500k on one core).
+    # 'quantized': {'dtype': 'int8'} (per-dimension scale, 1 byte per dimension) or {'dtype': 'float16'}
+    #              (2 bytes) - a memory option like 'pq': int8 only scans faster than 'linear' from
+    #              about 100k faces, and float16 scans about three times slower.
+    # 'sharded': {'shards': 4, 'shard_index': 'linear', 'shard_params': {}, 'min_rows': 100000} -
+    #            below min_rows faces the gallery is scanned in-process, as a round trip to the
+    #            workers (about 1 ms) costs more than the scan; reloads reuse the workers.
+    # 'centroid': {'users': 8, 'centroid_index': 'linear', 'centroid_params': {}} - only the
+    #             templates of the users with the nearest centroids are compared with the probe.
+    'index_params': {},
+    # Number of index candidates re-scored with exact distances before the tolerance check.
+    # Use 64 or more with 'pq'.
+    'rerank': 16
+}
+
+# Memory-mapped gallery shared by several API worker processes. Each worker picks its
+# role from the VELORA_GALLERY_ROLE environment variable: exactly one 'writer' loads
+# from MongoDB and publishes, every 'reader' maps the published files read-only, and
+# 'standalone' (the default) keeps a private gallery.
+SHARED_GALLERY_CONFIG = {
+    'directory': './shared_gallery',
+    # Seconds between checks of the published generation by readers.
+    'poll_interval': 1
+}
+
+# Local copy of the gallery used for warm starts: the API and the camera tools map it at
+# startup and serve from it while reconciling with MongoDB in the background.
+SNAPSHOT_CONFIG = {
+    'directory': './gallery_snapshot',
+    # Minimum seconds between two snapshot writes; changes in between are saved together.
+    'min_interval': 60,
+    # Serve the galleries from the snapshot files instead of the heap: every reload saves the
+    # changed partitions right away and maps them. None turns it on for the 'pq' and 'quantized'
+    # indexes, whose searches only read the re-ranked rows of the mapped matrix, so the float32
+    # rows are not kept in memory next to the codes; True or False forces it either way.
+    'serve_mapped': None
+}
+
+# Conversion of legacy records that store a JS/base64 image instead of an encoding.
+CONVERSION_CONFIG = {
+    # Worker processes running face detection and encoding.
+    'workers': 2,
+    # Most conversions in flight at once; the rest wait their turn.
+    'max_pending': 8
+}
+
+# Where the API and the camera tools read the gallery from (see gallery_service.py):
+# 'mongo' (MONGODB_CONFIG), 'sqlite' (one local file, e.g. {'path': './gallery.db'}) or
+# 'file' (galleries published by a writer, e.g. {'directory': './shared_gallery'}).
+STORAGE_CONFIG = {
+    'backend': 'mongo',
+    'params': {**MONGODB_CONFIG, 'conversion': CONVERSION_CONFIG},
+    # Seconds between incremental syncs of the in-memory gallery with the store.
+    'sync_interval': 10
+}
+
+# Requests arriving while the gallery is still loading wait up to 'max_wait' seconds for
+# it, then get a 503 with a Retry-After of 'retry_after' seconds. GET /ready reports the
+# loading progress and only answers 200 once the gallery is served.
+READINESS_CONFIG = {
+    'max_wait': 2,
+    'retry_after': 5
+}
+
+# Face detection on uploaded images (see face_detection.py and benchmark_detection.py).
+DETECTION_CONFIG = {
+    # Longest side, in pixels, of the copy faces are searched on; the boxes are mapped back
+    # so landmarks and encodings use the full resolution. None searches the full image.
+    # Smaller values (e.g. 640) are faster but miss small faces: measure the recall on your
+    # own images with benchmark_detection.py before lowering it.
+    'max_side': None,
+    # Also decode binary uploads at 1/2, 1/4 or 1/8 size (cv2.IMREAD_REDUCED_COLOR_*) for the
+    # search instead of resizing the full decode; cheaper for large JPEGs.
+    'reduced_decode': False,
+    # Face detector of every call site (API, registration, identification, legacy conversion):
+    # 'hog' or 'cnn' (dlib), 'haar' (OpenCV cascade), 'dnn' (OpenCV ResNet-SSD), or 'auto'
+    # to choose one at startup (see 'selection'). 'auto' only judges recall on the
+    # 'selection' images: give it a representative set before relying on it.
+    'backend': 'hog',
+    # Options of each backend; 'upsample' passes find smaller faces, slower. The DNN model is
+    # not shipped: put deploy.prototxt and res10_300x300_ssd_iter_140000.caffemodel (OpenCV
+    # face detector sample) in models/, otherwise the backend is unavailable.
+    'backends': {
+        'hog': {'upsample': 1},
+        'cnn': {'upsample': 1},
+        'haar': {'min_neighbors': 5, 'min_size': 40},
+        'dnn': {'prototxt': 'models/deploy.prototxt',
+                'model': 'models/res10_300x300_ssd_iter_140000.caffemodel', 'confidence': 0.5}
+    },
+    # Haar cascade stage (haarcascade_frontalface_default.xml) run before 'hog' and 'cnn':
+    # images without a plausible face skip the detector, which only searches around the
+    # cascade's candidates (enlarged by 'margin' times their size). Lower 'min_neighbors'
+    # for recall; None disables it. Faces the cascade misses are not detected at all, so
+    # measure the recall with benchmark_detection.py before enabling it, e.g. with
+    # {'min_neighbors': 3, 'min_size': 40, 'margin': 0.5}.
+    'prefilter': None,
+    # 'auto' times each candidate on the sample images and keeps the fastest whose recall and
+    # precision against the reference backend (run at full resolution) reach the floors;
+    # the fallback is used otherwise. Add 'cnn' to the candidates on CUDA hosts.
+    'selection': {
+        'candidates': ['hog', 'haar', 'dnn'],
+        'images': ['1.jpg'],
+        'reference': 'hog',
+        'min_recall': 0.9,
+        'min_precision': 0.8,
+        'repeat': 3,
+        'fallback': 'hog'
+    }
+}
+
+# Face encoding profiles: 'model' is the landmark model aligning the face ('small': 5 points,
+# faster; 'large': 68 points) and 'num_jitters' the number of randomly re-sampled copies
+# averaged into each encoding (cost grows linearly). Each use has its own profile: stored
+# templates (registration and legacy conversions) can afford 'accurate', per-frame camera
+# identification cannot. Compare them with benchmark_encoding.py.
+# Cost: dlib runs the encoding network once per jitter, so 'accurate' spends about ten times
+# the encoding time of 'balanced' on every registration and every legacy conversion (the
+# conversion pool's throughput drops accordingly; use 'balanced' for a bulk migration).
+# The API stays on the 5-point model it always used: moving it to 'balanced' changes the
+# probes of every request and should be validated with benchmark_encoding.py first.
+ENCODING_CONFIG = {
+    'profiles': {
+        'fast': {'model': 'small', 'num_jitters': 1},
+        'balanced': {'model': 'large', 'num_jitters': 1},
+        'accurate': {'model': 'large', 'num_jitters': 10}
+    },
+    'api': 'fast',
+    'registration': 'accurate',
+    'camera': 'fast'
+}
@@ -0,0 +1,63 @@
+import pickle
+
+import numpy as np
+from bson.binary import Binary
+
+from gallery import ENCODING_DIM
+
+# Tag stored next to the encodings: dtype, byte order and layout version.
+ENCODING_FORMAT = "float32-le/1"
+# Raw little-endian float32, ENCODING_DIM values per template, templates back to back.
+ENCODING_DTYPE = np.dtype('<f4')
+ENCODING_BYTES = ENCODING_DIM * ENCODING_DTYPE.itemsize
+
+# Fields of the pickle-based format, removed once a record is migrated.
+LEGACY_FIELDS = ('face_encoding', 'face_encodings')
+
+
+def pack_encodings(encodings):
+    """Return the templates as raw little-endian float32 bytes."""
+    matrix = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_DIM)
+    return matrix.tobytes()
+
+
+def unpack_encodings(data):
+    """Return a read-only (N, 128) float32 view of bytes written by pack_encodings."""
+    if len(data) % ENCODING_BYTES:
+        raise ValueError(f"Encoding data of {len(data)} bytes is not a whole number of templates")
+    return np.frombuffer(data, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_DIM)
+
+
+def gallery_matrix(blobs):
+    """Build the (N, 128) matrix of many users with one np.frombuffer over their joined bytes."""
+    return unpack_encodings(b''.join(blobs))
+
+
+def encoding_fields(encodings):
+    """Return the document fields storing the templates in the typed format."""
+    return {'encodings': Binary(pack_encodings(encodings)), 'encoding_format': ENCODING_FORMAT}
+
+
+def stored_encodings(user):
+    """Return the packed templates of a user document, or None if it holds no encoding.
+
+    Typed records are returned as they are, without parsing. Records still in
+    the pickle format are unpickled and packed; run migrate_encodings.py so
+    that untrusted pickles are no longer loaded. Records holding a JS/base64
+    image rather than an encoding also return None and must be converted.
+    """
+    if 'encoding_format' in user:
+        if user['encoding_format'] != ENCODING_FORMAT:
+            raise ValueError(f"Unsupported encoding format {user['encoding_format']!r}")
+        data = bytes(user['encodings'])
+        unpack_encodings(data)
+        return data
+
+    stored_templates = user.get('face_encodings')
+    if stored_templates:
+        # Users enrolled with several templates get one gallery row per template.
+        return pack_encodings([pickle.loads(template) for template in stored_templates])
+    try:
+        return pack_encodings(pickle.loads(user['face_encoding']))
+    except Exception:
+        return None
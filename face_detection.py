@@ -0,0 +1,407 @@
+import json
+import logging
+import os
+import queue
+import time
+
+import cv2
+import face_recognition
+import numpy as np
+
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# The OpenCV frontal face cascade shipped with the repository.
+HAAR_CASCADE_PATH = os.path.join(MODULE_DIRECTORY, "haarcascade_frontalface_default.xml")
+
+# cv2.imdecode flags decoding a JPEG directly at 1/2, 1/4 or 1/8 of its size (DCT scaling).
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def detection_scale(shape, max_side):
+    """Return the factor (at most 1) bringing the longer side of an image of this shape down to max_side."""
+    if not max_side:
+        return 1.0
+    return min(1.0, max_side / max(shape[:2]))
+
+
+def reduction_factor(shape, max_side):
+    """Return the largest reduced-decode factor (2, 4 or 8) keeping the longer side at least max_side, or 1."""
+    if not max_side:
+        return 1
+    longest = max(shape[:2])
+    factors = [factor for factor in REDUCED_DECODE_FLAGS if longest / factor >= max_side]
+    return max(factors) if factors else 1
+
+
+def decode_reduced(buffer, factor):
+    """Decode an encoded image at 1/factor of its size; JPEGs skip most of the full-size decode."""
+    return cv2.imdecode(np.frombuffer(buffer, np.uint8), REDUCED_DECODE_FLAGS[factor])
+
+
+def scale_box(box, factor, shape):
+    """Scale a (top, right, bottom, left) box by factor and clip it to an image of this shape."""
+    top, right, bottom, left = (int(round(value * factor)) for value in box)
+    height, width = shape[:2]
+    return max(top, 0), min(right, width), min(bottom, height), max(left, 0)
+
+
+def merge_regions(regions):
+    """Merge overlapping (top, right, bottom, left) regions into their bounding boxes."""
+    merged = []
+    for region in regions:
+        region = list(region)
+        changed = True
+        while changed:
+            changed = False
+            for other in merged:
+                if region[0] < other[2] and other[0] < region[2] and region[3] < other[1] and other[3] < region[1]:
+                    merged.remove(other)
+                    region = [min(region[0], other[0]), max(region[1], other[1]),
+                              max(region[2], other[2]), min(region[3], other[3])]
+                    changed = True
+                    break
+        merged.append(region)
+    return [tuple(region) for region in merged]
+
+
+def resolve_path(path):
+    """Return path, relative paths being taken from the repository directory."""
+    return os.path.join(MODULE_DIRECTORY, path)
+
+
+class ModelPool:
+    """Loaded OpenCV models shared by request threads, each used by one thread at a time.
+
+    OpenCV detectors are not safe to share between threads, and the API
+    serves every request on a new thread, so a model per thread would be
+    loaded again for every request. get() hands out an idle model and only
+    loads another one when all are busy; put() returns it.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.idle = queue.Queue()
+        # Loaded once up front so a broken model fails at startup.
+        self.idle.put(load())
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.load()
+
+    def put(self, model):
+        self.idle.put(model)
+
+
+class HogBackend:
+    """dlib HOG detector (face_recognition's default): frontal faces, moderate CPU cost."""
+
+    name = "hog"
+    # Costly enough for the Haar pre-filter to pay off.
+    screened = True
+
+    def __init__(self, upsample=1):
+        self.upsample = upsample
+
+    def detect(self, rgb_image):
+        """Return the (top, right, bottom, left) face boxes of an RGB image."""
+        return face_recognition.face_locations(rgb_image, number_of_times_to_upsample=self.upsample, model=self.name)
+
+
+class CnnBackend(HogBackend):
+    """dlib CNN (MMOD) detector: finds turned and small faces, but slow without CUDA."""
+
+    name = "cnn"
+
+
+class HaarBackend:
+    """OpenCV Haar cascade: the cheapest detector, with the most false positives."""
+
+    name = "haar"
+    screened = False
+
+    def __init__(self, path=HAAR_CASCADE_PATH, scale_factor=1.1, min_neighbors=5, min_size=40):
+        self.path = resolve_path(path)
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        self.cascades = ModelPool(self._load_cascade)
+
+    def _load_cascade(self):
+        if not hasattr(cv2, 'CascadeClassifier'):
+            raise RuntimeError("This OpenCV build has no CascadeClassifier")
+        cascade = cv2.CascadeClassifier(self.path)
+        if cascade.empty():
+            raise RuntimeError(f"Unable to load the Haar cascade {self.path}")
+        return cascade
+
+    def rectangles(self, rgb_image):
+        """Return the (x, y, width, height) rectangles of the cascade's face candidates."""
+        gray = cv2.equalizeHist(cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY))
+        cascade = self.cascades.get()
+        try:
+            candidates = cascade.detectMultiScale(gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+                                                  minSize=(self.min_size, self.min_size))
+        finally:
+            self.cascades.put(cascade)
+        return [tuple(map(int, candidate)) for candidate in candidates]
+
+    def detect(self, rgb_image):
+        """Return the (top, right, bottom, left) face boxes of an RGB image."""
+        return [(y, x + w, y + h, x) for x, y, w, h in self.rectangles(rgb_image)]
+
+
+class DnnBackend:
+    """OpenCV DNN ResNet-10 SSD (res10_300x300): fast on CPU, tolerant of pose and lighting.
+
+    The Caffe model files are not shipped with the repository; see DETECTION_CONFIG.
+    """
+
+    name = "dnn"
+    screened = False
+
+    def __init__(self, prototxt, model, confidence=0.5, input_size=300):
+        self.prototxt = resolve_path(prototxt)
+        self.model = resolve_path(model)
+        for path in (self.prototxt, self.model):
+            if not os.path.isfile(path):
+                raise RuntimeError(f"DNN face detector file {path} not found")
+        self.confidence = confidence
+        self.input_size = input_size
+        self.nets = ModelPool(self._load_net)
+
+    def _load_net(self):
+        try:
+            return cv2.dnn.readNetFromCaffe(self.prototxt, self.model)
+        except cv2.error as e:
+            raise RuntimeError(f"Unable to load the DNN face detector {self.model}: {e}")
+
+    def detect(self, rgb_image):
+        """Return the (top, right, bottom, left) face boxes of an RGB image."""
+        height, width = rgb_image.shape[:2]
+        size = (self.input_size, self.input_size)
+        bgr = cv2.resize(cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR), size)
+        net = self.nets.get()
+        try:
+            net.setInput(cv2.dnn.blobFromImage(bgr, 1.0, size, (104.0, 177.0, 123.0)))
+            detections = net.forward()[0, 0]
+        finally:
+            self.nets.put(net)
+        boxes = []
+        for detection in detections:
+            if detection[2] < self.confidence:
+                continue
+            left, top, right, bottom = (detection[3:7] * [width, height, width, height]).round().astype(int)
+            top, right, bottom, left = max(int(top), 0), min(int(right), width), min(int(bottom), height), max(int(left), 0)
+            if right > left and bottom > top:
+                boxes.append((top, right, bottom, left))
+        return boxes
+
+
+DETECTOR_BACKENDS = {
+    'hog': HogBackend,
+    'cnn': CnnBackend,
+    'haar': HaarBackend,
+    'dnn': DnnBackend,
+}
+
+
+def build_backend(name, **params):
+    """Create the face detector backend registered under name with its parameters."""
+    try:
+        backend = DETECTOR_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown detector backend '{name}'. Choose from: {', '.join(DETECTOR_BACKENDS)}")
+    return backend(**params)
+
+
+class HaarPrefilter:
+    """Cheap Haar cascade stage in front of the HOG/CNN detector.
+
+    propose() returns the regions around the cascade's face candidates,
+    enlarged by margin times the face size on every side so the detector
+    sees some context, or nothing when no plausible face is in the image:
+    empty frames then skip the detector altogether. A lower min_neighbors
+    proposes more regions (higher recall, less saving).
+    """
+
+    def __init__(self, path=HAAR_CASCADE_PATH, scale_factor=1.1, min_neighbors=3, min_size=40, margin=0.5):
+        self.cascade = HaarBackend(path, scale_factor, min_neighbors, min_size)
+        self.margin = margin
+
+    def propose(self, rgb_image):
+        """Return the (top, right, bottom, left) regions of rgb_image that may hold a face."""
+        height, width = rgb_image.shape[:2]
+        regions = []
+        for x, y, w, h in self.cascade.rectangles(rgb_image):
+            pad_x, pad_y = int(w * self.margin), int(h * self.margin)
+            regions.append((max(0, y - pad_y), min(width, x + w + pad_x), min(height, y + h + pad_y), max(0, x - pad_x)))
+        return merge_regions(regions)
+
+
+def locate_faces(rgb_image, max_side=None, backend=None, detection_image=None, prefilter=None):
+    """Find faces on a copy of rgb_image reduced to max_side pixels; boxes are in rgb_image coordinates.
+
+    HOG cost grows with the pixel count, so multi-megapixel uploads are
+    searched at a bounded resolution and only the boxes are mapped back:
+    landmarks and encodings are then computed on the full-resolution image.
+    detection_image is an optional reduced RGB copy made by the caller (for
+    example with decode_reduced), used instead of rgb_image as the source of
+    that copy; either is resized here when still larger than max_side.
+
+    backend is a detector backend (HOG by default). With a HaarPrefilter
+    the detector only searches the regions it proposes
+    and images without any are rejected at the cost of the cascade alone.
+    """
+    if detection_image is None:
+        detection_image = rgb_image
+    # A reduced decode only divides by 2, 4 or 8, so it can still be up to twice max_side.
+    scale = detection_scale(detection_image.shape, max_side)
+    if scale < 1.0:
+        size = (max(1, round(detection_image.shape[1] * scale)), max(1, round(detection_image.shape[0] * scale)))
+        detection_image = cv2.resize(detection_image, size, interpolation=cv2.INTER_AREA)
+    if backend is None:
+        backend = HogBackend()
+    factor = rgb_image.shape[1] / detection_image.shape[1]
+    if prefilter is None:
+        boxes = backend.detect(detection_image)
+    else:
+        boxes = []
+        for top, right, bottom, left in prefilter.propose(detection_image):
+            crop = np.ascontiguousarray(detection_image[top:bottom, left:right])
+            for t, r, b, l in backend.detect(crop):
+                boxes.append((t + top, r + left, b + top, l + left))
+    if factor == 1.0:
+        return boxes
+    return [scale_box(box, factor, rgb_image.shape) for box in boxes]
+
+
+class FaceDetector:
+    """The face detection pipeline configured by DETECTION_CONFIG, shared by the API and the camera tools.
+
+    Create it with build_detector(); the Haar pre-filter only applies to
+    the backends it is worth running for (HOG and CNN).
+    """
+
+    def __init__(self, max_side=None, backend=None, reduced_decode=False, prefilter=None):
+        self.max_side = max_side
+        self.backend = backend if backend is not None else HogBackend()
+        self.reduced_decode = reduced_decode
+        self.prefilter = HaarPrefilter(**prefilter) if prefilter is not None and self.backend.screened else None
+
+    def locate(self, rgb_image, detection_image=None):
+        """Return the (top, right, bottom, left) face boxes of an RGB image in its own coordinates."""
+        return locate_faces(rgb_image, self.max_side, self.backend, detection_image, self.prefilter)
+
+    def reduced_copy(self, shape, payload):
+        """Return an RGB copy of an encoded upload decoded at reduced size for detection, or None.
+
+        Only used with reduced_decode, for binary payloads of an image of this shape.
+        """
+        if not self.reduced_decode or payload is None or isinstance(payload, str):
+            return None
+        factor = reduction_factor(shape, self.max_side)
+        if factor == 1:
+            return None
+        reduced = decode_reduced(payload, factor)
+        return cv2.cvtColor(reduced, cv2.COLOR_BGR2RGB) if reduced is not None else None
+
+
+def same_face(reference, box):
+    """Return True if two (top, right, bottom, left) boxes each contain the other's center.
+
+    Looser than an IoU threshold: backends frame the same face differently.
+    """
+    def contains(outer, inner):
+        return outer[0] <= (inner[0] + inner[2]) / 2 <= outer[2] and outer[3] <= (inner[1] + inner[3]) / 2 <= outer[1]
+    return contains(reference, box) and contains(box, reference)
+
+
+def configured_detector(config, name):
+    """Return the FaceDetector of a DETECTION_CONFIG dict using the backend registered under name."""
+    backend = build_backend(name, **config['backends'].get(name, {}))
+    return FaceDetector(config['max_side'], backend, config['reduced_decode'], config['prefilter'])
+
+
+def select_backend(config):
+    """Return the name of the fastest candidate backend meeting the recall and precision floors.
+
+    Each candidate runs the whole pipeline of config (resolution bound,
+    pre-filter) on the sample images, once to warm up and then 'repeat'
+    times; its faces are compared with those the reference backend finds
+    at full resolution. Unavailable backends are skipped; the fallback is
+    returned if no candidate qualifies or no sample face is found.
+    """
+    selection = config['selection']
+    images = []
+    for path in selection['images']:
+        image = cv2.imread(resolve_path(path))
+        if image is None:
+            logging.warning(f"Detector selection: cannot read sample image {path}")
+            continue
+        images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    reference = build_backend(selection['reference'], **config['backends'].get(selection['reference'], {}))
+    expected = [reference.detect(image) for image in images]
+    if not any(expected):
+        logging.warning(f"Detector selection: no reference face in the samples, using {selection['fallback']}")
+        return selection['fallback']
+
+    qualified = []
+    for name in selection['candidates']:
+        try:
+            detector = configured_detector(config, name)
+        except RuntimeError as e:
+            logging.warning(f"Detector backend {name} unavailable: {e}")
+            continue
+        seconds, found, matched, detected = 0.0, 0, 0, 0
+        for image, faces in zip(images, expected):
+            detector.locate(image)
+            times = []
+            for _ in range(selection['repeat']):
+                start = time.perf_counter()
+                boxes = detector.locate(image)
+                times.append(time.perf_counter() - start)
+            seconds += float(np.median(times))
+            found += sum(any(same_face(face, box) for box in boxes) for face in faces)
+            matched += sum(any(same_face(face, box) for face in faces) for box in boxes)
+            detected += len(boxes)
+        recall = found / sum(len(faces) for faces in expected)
+        precision = matched / detected if detected else 0.0
+        logging.info(f"Detector backend {name}: {1000 * seconds / len(images):.1f} ms per image, "
+                     f"recall {recall:.2f}, precision {precision:.2f}")
+        if recall >= selection['min_recall'] and precision >= selection['min_precision']:
+            qualified.append((seconds, name))
+    if not qualified:
+        logging.warning(f"Detector selection: no backend meets the floors, using {selection['fallback']}")
+        return selection['fallback']
+    name = min(qualified)[1]
+    logging.info(f"Selected detector backend {name}")
+    return name
+
+
+# Backends chosen by select_backend in this process, by configuration; see build_detector.
+SELECTED_BACKENDS = {}
+
+
+def remember_selections(selections):
+    """Record backends already selected elsewhere (a worker process initializer)."""
+    SELECTED_BACKENDS.update(selections)
+
+
+def build_detector(config):
+    """Return the FaceDetector of a DETECTION_CONFIG dict.
+
+    An 'auto' backend is chosen with select_backend() once per process and
+    configuration, so every call site ends up on the same backend.
+    """
+    name = config['backend']
+    if name == 'auto':
+        key = json.dumps(config, sort_keys=True, default=str)
+        if key not in SELECTED_BACKENDS:
+            SELECTED_BACKENDS[key] = select_backend(config)
+        name = SELECTED_BACKENDS[key]
+    return configured_detector(config, name)
@@ -1,38 +1,51 @@
 import cv2
-import numpy as np
-import face_recognition
-from pymongo import MongoClient
-from datetime import datetime
-import pickle
 import time
 import logging
 import threading
-import re
-import base64
+import os
+from gallery import DEFAULT_PARTITION, is_valid_partition
+from gallery_service import GalleryService, build_store
+from face_detection import build_detector
+from face_encoding import build_encoder
+from config import GALLERY_CONFIG, SNAPSHOT_CONFIG, STORAGE_CONFIG, DETECTION_CONFIG, ENCODING_CONFIG
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 class FaceRecognitionSystem:
-    def __init__(self):
-        """Initialize MongoDB, video capture, and load known faces."""
-        try:
-            self.client = MongoClient('mongodb://localhost:27017/')
-            self.db = self.client['face_recognition_db']
-            self.users_collection = self.db['users']
-            self.users_collection.create_index("name", unique=True)  # Ensure fast lookups
-            logging.info("MongoDB connection successful")
-        except Exception as e:
-            raise RuntimeError(f"MongoDB connection failed: {e}")
-            
-        self.video_capture = self._initialize_camera()
-        self.known_face_encodings = []
-        self.known_face_names = []
-        self.load_known_faces()
+    def __init__(self, partition=DEFAULT_PARTITION):
+        """Connect to the user store and start loading the known faces of one partition and the camera.
+
+        Neither the gallery load nor the camera warm-up blocks: both run in
+        background threads. Use wait_until_ready() before identifying users;
+        register_new_face() waits for the camera itself.
+        """
+        if not is_valid_partition(partition):
+            raise ValueError(f"Invalid partition name: {partition!r}")
+        self.partition = partition
+        # Same detection pipeline and backend as the API. Chosen before the gallery starts
+        # loading, so legacy-conversion workers inherit the choice instead of timing again.
+        self.detector = build_detector(DETECTION_CONFIG)
+        self.store = build_store(STORAGE_CONFIG['backend'], **STORAGE_CONFIG['params'], scope=[partition])
+        # Same gallery subsystem as the API, restricted to this partition: loaded from the
+        # snapshot or the store in the background and kept current there.
+        self.gallery_service = GalleryService(
+            self.store, GALLERY_CONFIG,
+            snapshot_directory=os.path.join(SNAPSHOT_CONFIG['directory'], 'camera'),
+            snapshot_interval=SNAPSHOT_CONFIG['min_interval'],
+            serve_mapped=SNAPSHOT_CONFIG['serve_mapped'])
+        self.gallery_service.start(STORAGE_CONFIG['sync_interval'])
+        # Stored templates get the expensive encoding profile, live frames the cheap one.
+        self.registration_encoder = build_encoder(ENCODING_CONFIG, 'registration')
+        self.camera_encoder = build_encoder(ENCODING_CONFIG, 'camera')
+
+        self.video_capture = None
+        self.camera_ready = threading.Event()
+        self.camera_error = None
         self.frame = None
         self.running = True
 
-        # Start a separate thread for video capture
+        # Start a separate thread for camera initialization and video capture
         self.capture_thread = threading.Thread(target=self._capture_frames, daemon=True)
         self.capture_thread.start()
         
@@ -51,7 +64,14 @@ class FaceRecognitionSystem:
         return capture
     
     def _capture_frames(self):
-        """Continuously capture frames in a separate thread for better performance."""
+        """Initialize the camera, then continuously capture frames in a separate thread for better performance."""
+        try:
+            self.video_capture = self._initialize_camera()
+        except RuntimeError as e:
+            self.camera_error = str(e)
+            return
+        finally:
+            self.camera_ready.set()
         while self.running:
             ret, frame = self.video_capture.read()
             if ret:
@@ -59,79 +79,54 @@ class FaceRecognitionSystem:
             time.sleep(0.05)
 
 
+    def wait_for_camera(self, timeout=None):
+        """Block until the camera is initialized or timeout seconds passed; returns True if ready.
+
+        Raises RuntimeError if the camera could not be opened.
+        """
+        if not self.camera_ready.wait(timeout):
+            return False
+        if self.camera_error is not None:
+            raise RuntimeError(self.camera_error)
+        return True
+
+    def wait_until_ready(self, timeout=None):
+        """Block until both the camera and the known faces are ready, at most timeout seconds; returns True if ready."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self.wait_for_camera(timeout):
+            return False
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        return self.gallery_service.wait_ready(remaining)
+
+    @property
+    def gallery(self):
+        """The matcher of this system's partition in the current gallery snapshot."""
+        return self.gallery_service.get(self.partition) or self.gallery_service.empty
+
     def load_known_faces(self):
-        """Load face encodings from the database.
-        
-        If the stored face_encoding is in a JS format (i.e. base64 or binary image)
-        rather than a Python pickle, decode it, compute the face encoding using the
-        same OpenCV logic as register_new_face, pickle it, and update the DB.
+        """Load face encodings from the user store.
+
+        Only the users changed since the last call, or since the snapshot this
+        system started from, are fetched (see gallery_service.py). Legacy JS
+        records are converted in the background and added as they finish.
         """
         try:
-            users = self.users_collection.find({})
-            for user in users:
-                stored_data = user['face_encoding']
-                try:
-                    # Try to load as a pickled face encoding (Python format)
-                    face_encoding = pickle.loads(stored_data)
-                except Exception as pickle_error:
-                    logging.warning(f"Pickle load failed for user {user['name']} (likely stored from JS). Attempting to compute face encoding using CV logic.")
-                    try:
-                        # Determine if stored_data is a string (base64) or already binary
-                        if isinstance(stored_data, str):
-                            # Remove potential data URI header if present
-                            base64_str = re.sub(r"^data:image\/\w+;base64,", "", stored_data)
-                            image_data = base64.b64decode(base64_str)
-                        else:
-                            image_data = stored_data
-
-                        # Convert binary data to a NumPy array and decode the image using OpenCV
-                        np_arr = np.frombuffer(image_data, np.uint8)
-                        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-                        if img is None:
-                            logging.error(f"Failed to decode image for user {user['name']}.")
-                            continue
-
-                        # Convert to RGB for face_recognition
-                        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-                        # Detect face locations using the same 'hog' model
-                        face_locations = face_recognition.face_locations(rgb_img, model="hog")
-                        if not face_locations:
-                            logging.warning(f"No face detected in the image for user {user['name']}.")
-                            continue
-
-                        # Compute face encoding
-                        face_encodings = face_recognition.face_encodings(rgb_img, face_locations)
-                        if not face_encodings:
-                            logging.warning(f"Face encoding failed for user {user['name']}.")
-                            continue
-                        face_encoding = face_encodings[0]
-
-                        # Pickle the computed encoding
-                        pickled_encoding = pickle.dumps(face_encoding)
-
-                        # Update the database record with the pickled encoding
-                        self.users_collection.update_one(
-                            {'_id': user['_id']},
-                            {'$set': {'face_encoding': pickled_encoding}}
-                        )
-                        logging.info(f"Updated user {user['name']} with pickled face encoding from JS data.")
-
-                    except Exception as js_error:
-                        logging.error(f"Error processing JS face data for user {user['name']}: {js_error}")
-                        continue
-
-                self.known_face_encodings.append(face_encoding)
-                self.known_face_names.append(user['name'])
-            
-            logging.info(f"Loaded {len(self.known_face_encodings)} known faces from database")
+            self.gallery_service.refresh()
+            logging.info(f"Loaded {len(self.gallery)} known faces of partition {self.partition} from database")
         except Exception as e:
             raise RuntimeError(f"Error loading known faces: {e}")
 
 
-    def register_new_face(self, name, max_attempts=5):
-        """Capture face and store encoding in the database."""
-        for attempt in range(max_attempts):
+    def register_new_face(self, name, max_attempts=5, templates=5):
+        """Capture several face encodings of one person and store them in the database.
+
+        Up to `templates` encodings are taken from different frames, allowing
+        max_attempts failed captures per template. Enrolling several templates
+        reduces false rejects when the pose or lighting changes at login.
+        """
+        self.wait_for_camera()
+        captured = []
+        for attempt in range(max_attempts * templates):
             time.sleep(1)  # Allow time for the camera to stabilize
             
             frame = self.frame
@@ -143,7 +138,7 @@ class FaceRecognitionSystem:
             rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
             
             # Detect face locations
-            face_locations = face_recognition.face_locations(rgb_frame, model="hog")
+            face_locations = self.detector.locate(rgb_frame)
 
             if len(face_locations) == 0:
                 logging.warning(f"Attempt {attempt + 1}: No face detected.")
@@ -154,37 +149,36 @@ class FaceRecognitionSystem:
                 return False, "Multiple faces detected."
 
             # Extract the face encoding
-            face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+            face_encodings = self.registration_encoder.encode(rgb_frame, face_locations)
             if not face_encodings:
                 logging.warning(f"Attempt {attempt + 1}: Face encoding failed.")
                 continue
                 
-            face_encoding = face_encodings[0]
-
-            # Save to database
-            try:
-                if self.users_collection.find_one({'name': name}):
-                    return False, f"User {name} already exists."
+            captured.append(face_encodings[0])
+            logging.info(f"Captured template {len(captured)} of {templates}.")
+            if len(captured) == templates:
+                break
 
-                self.users_collection.insert_one({
-                    'name': name,
-                    'face_encoding': pickle.dumps(face_encoding),
-                    'created_at': datetime.now()
-                })
-                return True, f"User {name} registered successfully."
-            except Exception as e:
-                logging.error(f"Error saving to database: {e}")
-                return False, "Database error."
+        if not captured:
+            return False, "Failed to capture a clear face encoding."
+        if len(captured) < templates:
+            logging.warning(f"Only {len(captured)} of {templates} templates captured for {name}.")
 
-        return False, "Failed to capture a clear face encoding."
+        # Save to database
+        try:
+            self.store.add_user(name, captured, self.partition)
+            return True, f"User {name} registered successfully with {len(captured)} templates."
+        except ValueError as e:
+            return False, str(e)
+        except Exception as e:
+            logging.error(f"Error saving to database: {e}")
+            return False, "Database error."
 
     def cleanup(self):
         """Release resources and stop video capture."""
         self.running = False
         self.capture_thread.join()
-        if self.video_capture.isOpened():
+        if self.video_capture is not None and self.video_capture.isOpened():
             self.video_capture.release()
             logging.info("Camera released.")
-        if self.client:
-            self.client.close()
-            logging.info("MongoDB connection closed.")
+        self.store.close()
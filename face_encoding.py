@@ -0,0 +1,41 @@
+import face_recognition
+
+# Landmark models aligning a face before encoding: 5 points (faster) or 68 points.
+LANDMARK_MODELS = ('small', 'large')
+
+
+class FaceEncoder:
+    """face_recognition.face_encodings with the settings of one encoding profile.
+
+    model is the landmark model ('small' or 'large') and num_jitters the
+    number of randomly re-sampled copies of each face averaged into its
+    encoding; the cost grows linearly with it.
+    """
+
+    def __init__(self, model='small', num_jitters=1):
+        if model not in LANDMARK_MODELS:
+            raise ValueError(f"Unknown landmark model '{model}'. Choose from: {', '.join(LANDMARK_MODELS)}")
+        if num_jitters < 1:
+            raise ValueError(f"num_jitters must be at least 1, got {num_jitters}")
+        self.model = model
+        self.num_jitters = num_jitters
+
+    def encode(self, rgb_image, boxes):
+        """Return the encodings of the faces at the (top, right, bottom, left) boxes of an RGB image."""
+        return face_recognition.face_encodings(rgb_image, boxes, num_jitters=self.num_jitters, model=self.model)
+
+
+def profile_encoder(config, profile):
+    """Return the FaceEncoder of a named profile of an ENCODING_CONFIG dict."""
+    try:
+        settings = config['profiles'][profile]
+    except KeyError:
+        raise ValueError(f"Unknown encoding profile '{profile}'. Choose from: {', '.join(config['profiles'])}")
+    return FaceEncoder(**settings)
+
+
+def build_encoder(config, use):
+    """Return the FaceEncoder of the profile an ENCODING_CONFIG dict assigns to use ('api', 'registration', 'camera')."""
+    if use not in config:
+        raise ValueError(f"No encoding profile configured for '{use}'")
+    return profile_encoder(config, config[use])
@@ -0,0 +1,539 @@
+import itertools
+import logging
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def squared_distances(matrix, probe, sq_norms=None):
+    """Return the squared euclidean distance from probe to every row of matrix."""
+    if sq_norms is None:
+        sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+    # ||a - b||^2 = ||a||^2 - 2 a.b + ||b||^2
+    sq_dist = matrix @ probe
+    sq_dist *= -2.0
+    sq_dist += sq_norms
+    sq_dist += probe @ probe
+    return np.maximum(sq_dist, 0.0, out=sq_dist)
+
+
+def smallest(values, k):
+    """Return the indices of the k smallest values in ascending order."""
+    k = min(k, len(values))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(values):
+        candidates = np.argpartition(values, k - 1)[:k]
+    else:
+        candidates = np.arange(len(values))
+    return candidates[np.argsort(values[candidates], kind='stable')]
+
+
+def assign_to_centroids(data, centroids, chunk_size=65536):
+    """Return the index of the nearest centroid for every row of data."""
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignment = np.empty(len(data), dtype=np.intp)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        # The ||row||^2 term is constant per row and does not change the argmin.
+        scores = centroid_norms - 2.0 * (chunk @ centroids.T)
+        assignment[start:start + chunk_size] = np.argmin(scores, axis=1)
+    return assignment
+
+
+def row_keys(matrix):
+    """Return a 64-bit FNV-1a hash of the bytes of every row of a float32 matrix."""
+    words = np.ascontiguousarray(matrix, dtype=np.float32).view(np.uint64)
+    keys = np.full(len(words), 14695981039346656037, dtype=np.uint64)
+    for column in words.T:
+        keys ^= column
+        keys *= np.uint64(1099511628211)
+    return keys
+
+
+def kmeans(data, k, iterations=10, seed=0):
+    """Plain Lloyd's k-means; returns (centroids, assignment)."""
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    k = max(1, min(k, len(data)))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign_to_centroids(data, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        order = np.argsort(assignment, kind='stable')
+        non_empty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            # Re-seed empty clusters on random points so every list stays useful.
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids, assign_to_centroids(data, centroids)
+
+
+class LinearIndex:
+    """Exact 1:N scan over the whole gallery matrix."""
+
+    def __init__(self, matrix, sq_norms=None):
+        self.matrix = matrix
+        self.sq_norms = np.einsum('ij,ij->i', matrix, matrix) if sq_norms is None else sq_norms
+
+    def search(self, probe, k):
+        """Return (row ids, squared distances) of the k nearest rows."""
+        sq_dist = squared_distances(self.matrix, probe, self.sq_norms)
+        ids = smallest(sq_dist, k)
+        return ids, sq_dist[ids]
+
+
+class IVFFlatIndex:
+    """Inverted-file index: rows are bucketed by their nearest k-means centroid.
+
+    A probe only scans the rows of the nprobe buckets whose centroids are
+    closest to it. nprobe is the recall/latency knob: nprobe == nlist is an
+    exact scan, small values trade recall for speed.
+
+    Training is most of the cost of a build, so an index given previous (the
+    index of the gallery it replaces) keeps its centroids: rows found
+    unchanged in the previous gallery keep their list and only new or changed
+    rows are assigned. It trains again every retrain_every rebuilds, when
+    nlist should change by more than a factor of two, or when drift is
+    detected: the rows assigned since training are on average more than
+    max_drift times further from their centroid than the training rows.
+    """
+
+    # build_index hands over the index being replaced as previous.
+    reuses_previous = True
+
+    def __init__(self, matrix, sq_norms=None, nlist=None, nprobe=8, iterations=10,
+                 max_train_size=100000, seed=0, previous=None, retrain_every=100, max_drift=1.5):
+        self.matrix = matrix
+        self.sq_norms = np.einsum('ij,ij->i', matrix, matrix) if sq_norms is None else sq_norms
+        self.nprobe = nprobe
+        # Used by the next rebuild to recognize unchanged rows.
+        self.keys = row_keys(matrix)
+        if not len(matrix):
+            self.centroids = np.empty((0, matrix.shape[1]), dtype=np.float32)
+            self.list_ids = np.empty(0, dtype=np.intp)
+            self.list_offsets = np.zeros(1, dtype=np.intp)
+            self._trained(0.0)
+            return
+
+        if nlist is None:
+            nlist = int(4 * np.sqrt(len(matrix)))
+        nlist = max(1, min(nlist, len(matrix)))
+        assignment = None
+        if (previous is not None and len(previous.centroids) and previous.rebuilds + 1 < retrain_every
+                and 0.5 <= nlist / len(previous.centroids) <= 2):
+            assignment, added_rows, added_error = previous.reassign(matrix, self.keys)
+            if added_rows >= len(previous.centroids) and added_error > max_drift * previous.train_error * added_rows:
+                logging.info(f"IVF lists drifted ({added_error / added_rows:.4f} vs {previous.train_error:.4f} "
+                             f"when trained); training again.")
+                assignment = None
+        if assignment is not None:
+            self.centroids = previous.centroids
+            self.train_error = previous.train_error
+            self.rebuilds = previous.rebuilds + 1
+            self.added_rows, self.added_error = added_rows, added_error
+            built = f"kept the trained lists, {added_rows - previous.added_rows} rows assigned"
+        else:
+            rng = np.random.default_rng(seed)
+            if len(matrix) > max_train_size:
+                training = matrix[np.sort(rng.choice(len(matrix), max_train_size, replace=False))]
+            else:
+                training = np.asarray(matrix, dtype=np.float32)
+            self.centroids, training_assignment = kmeans(training, nlist, iterations=iterations, seed=seed)
+            self._trained(float(np.mean(np.sum((training - self.centroids[training_assignment]) ** 2, axis=1))))
+            assignment = assign_to_centroids(matrix, self.centroids)
+            built = "trained"
+
+        # Rows grouped by list; list i holds list_ids[list_offsets[i]:list_offsets[i + 1]].
+        self.list_ids = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=len(self.centroids))
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+        logging.info(f"Built IVF index with {len(self.centroids)} lists over {len(matrix)} faces ({built}).")
+
+    def _trained(self, train_error):
+        # Mean squared distance of the training rows to their centroid, and the
+        # rebuilds and rows assigned (with their summed squared distance) since.
+        self.train_error = train_error
+        self.rebuilds = 0
+        self.added_rows = 0
+        self.added_error = 0.0
+
+    def reassign(self, matrix, keys, chunk_size=65536):
+        """Assign the rows of a new gallery to these centroids.
+
+        Rows also in this index's gallery keep their list; only the others are
+        compared with the centroids. keys are the row_keys() of matrix. Returns
+        (assignment, rows assigned since training, their summed squared distance
+        to their centroid).
+        """
+        assignment = np.full(len(matrix), -1, dtype=np.intp)
+        if len(self.keys):
+            previous = np.empty(len(self.list_ids), dtype=np.intp)
+            previous[self.list_ids] = np.repeat(np.arange(len(self.centroids)), np.diff(self.list_offsets))
+            order = np.argsort(self.keys, kind='stable')
+            candidates = order[np.minimum(np.searchsorted(self.keys[order], keys), len(order) - 1)]
+            same = self.keys[candidates] == keys
+            # Hashes only nominate rows: confirm them byte for byte, a chunk at a time.
+            for start in range(0, len(matrix), chunk_size):
+                rows = np.flatnonzero(same[start:start + chunk_size]) + start
+                same[rows] = np.all(self.matrix[candidates[rows]] == matrix[rows], axis=1)
+            assignment[same] = previous[candidates[same]]
+        new = np.flatnonzero(assignment < 0)
+        error = 0.0
+        if len(new):
+            rows = np.asarray(matrix[new], dtype=np.float32)
+            assignment[new] = assign_to_centroids(rows, self.centroids)
+            error = float(np.sum((rows - self.centroids[assignment[new]]) ** 2))
+        return assignment, self.added_rows + len(new), self.added_error + error
+
+    def search(self, probe, k):
+        """Return (row ids, squared distances) of the k nearest rows in the probed lists."""
+        if not len(self.centroids):
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        probed = smallest(squared_distances(self.centroids, probe), self.nprobe)
+        ids = np.concatenate([
+            self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed
+        ])
+        sq_dist = squared_distances(self.matrix[ids], probe, self.sq_norms[ids])
+        best = smallest(sq_dist, k)
+        return ids[best], sq_dist[best]
+
+
+class PQIndex:
+    """Product-quantization index storing m bytes per face instead of 512.
+
+    Each encoding is split into m sub-vectors and every sub-vector is replaced
+    by the id of its nearest centroid in a 256-entry codebook trained on the
+    gallery. A probe is scored with asymmetric distance tables: the exact
+    distance from each probe sub-vector to every centroid, summed over the
+    codes of each face. Scores are approximate, so the matcher re-ranks the
+    shortlist against the full-precision rows.
+
+    Codes of adjacent sub-quantizers are packed in pairs into uint16, which
+    halves the number of table lookups per face without using more memory.
+    """
+
+    # Searches only read the codes: the matrix is not kept and needs no norms.
+    scans_matrix = False
+
+    def __init__(self, matrix, sq_norms=None, m=16, iterations=10, max_train_size=32768, seed=0):
+        dim = matrix.shape[1]
+        if dim % m or m % 2:
+            raise ValueError(f"PQ sub-quantizer count {m} must be even and divide the encoding size {dim}")
+        self.m = m
+        self.sub_dim = dim // m
+        self.codebooks = np.zeros((m, 256, self.sub_dim), dtype=np.float32)
+        # Codes are stored pair major so each scoring pass reads one contiguous row.
+        self.codes = np.zeros((m // 2, len(matrix)), dtype=np.uint16)
+        if not len(matrix):
+            return
+
+        rng = np.random.default_rng(seed)
+        if len(matrix) > max_train_size:
+            training = matrix[np.sort(rng.choice(len(matrix), max_train_size, replace=False))]
+        else:
+            training = matrix
+        for j in range(m):
+            columns = slice(j * self.sub_dim, (j + 1) * self.sub_dim)
+            centroids, _ = kmeans(training[:, columns], 256, iterations=iterations, seed=seed + j)
+            self.codebooks[j, :len(centroids)] = centroids
+            # Unused entries (galleries smaller than 256) are never assigned.
+            codes = assign_to_centroids(np.ascontiguousarray(matrix[:, columns]), centroids)
+            self.codes[j // 2] |= codes.astype(np.uint16) << (8 * (1 - j % 2))
+        logging.info(f"Built PQ index with {m} bytes per face over {len(matrix)} faces.")
+
+    def distance_tables(self, probe):
+        """Return the (m / 2, 65536) squared distances for every packed code pair."""
+        sub_probes = probe.reshape(self.m, 1, self.sub_dim)
+        tables = np.sum((self.codebooks - sub_probes) ** 2, axis=2)
+        return (tables[0::2, :, None] + tables[1::2, None, :]).reshape(self.m // 2, -1)
+
+    def search(self, probe, k):
+        """Return (row ids, approximate squared distances) of the k nearest rows."""
+        tables = self.distance_tables(probe)
+        sq_dist = np.take(tables[0], self.codes[0])
+        lookup = np.empty_like(sq_dist)
+        for j in range(1, len(tables)):
+            np.take(tables[j], self.codes[j], out=lookup)
+            sq_dist += lookup
+        ids = smallest(sq_dist, k)
+        return ids, sq_dist[ids]
+
+
+class QuantizedIndex:
+    """Scan over a float16 or int8 copy of the gallery, for galleries that do not fit in memory.
+
+    The copy takes 2 (float16) or 1 (int8) bytes per dimension instead of 4,
+    and the matcher re-scores the shortlist in full precision, reading only
+    those rows of the float32 matrix: served from a mapped snapshot (see
+    GalleryService) the matrix stays on disk. int8 uses a per-dimension scale
+    so every dimension keeps its full range. The scan runs in blocks that are
+    widened to float32 while still in cache.
+
+    It is a memory option, not a speed one: the int8 scan only beats the
+    float32 one on large galleries (22 vs 38 ms at 500k faces, but slower
+    below about 100k), and numpy widens float16 so slowly that a float16
+    scan costs about three times a float32 one.
+    """
+
+    # Searches only read the codes: the matrix is not kept and needs no norms.
+    scans_matrix = False
+
+    def __init__(self, matrix, sq_norms=None, dtype='int8', block_size=1024):
+        self.block_size = block_size
+        if dtype == 'float16':
+            self.scale = None
+            self.codes = matrix.astype(np.float16)
+        elif dtype == 'int8':
+            self.scale = np.ones(matrix.shape[1], dtype=np.float32)
+            if len(matrix):
+                self.scale = np.abs(matrix).max(axis=0).astype(np.float32) / 127.0
+            self.scale[self.scale == 0] = 1.0
+            self.codes = np.clip(np.rint(matrix / self.scale), -127, 127).astype(np.int8)
+        else:
+            raise ValueError(f"Unsupported quantized dtype '{dtype}'. Use 'float16' or 'int8'.")
+        # Norms of the dequantized rows keep the scan self-consistent.
+        self.sq_norms = np.empty(len(matrix), dtype=np.float32)
+        for start, block in self._blocks():
+            self.sq_norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+
+    def _blocks(self):
+        """Yield (start, float32 block) pairs of the dequantized gallery."""
+        for start in range(0, len(self.codes), self.block_size):
+            block = self.codes[start:start + self.block_size].astype(np.float32)
+            if self.scale is not None:
+                block *= self.scale
+            yield start, block
+
+    def search(self, probe, k):
+        """Return (row ids, approximate squared distances) of the k nearest rows."""
+        scaled_probe = probe if self.scale is None else probe * self.scale
+        sq_dist = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), self.block_size):
+            block = self.codes[start:start + self.block_size].astype(np.float32)
+            # For int8 the scale is folded into the probe: (q * s) . p == q . (s * p)
+            sq_dist[start:start + len(block)] = block @ scaled_probe
+        sq_dist *= -2.0
+        sq_dist += self.sq_norms
+        sq_dist += probe @ probe
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        ids = smallest(sq_dist, k)
+        return ids, sq_dist[ids]
+
+
+class CentroidIndex:
+    """Two-stage search for galleries with several templates per person.
+
+    A probe is first compared with one centroid per person (the mean of that
+    person's templates) and then only with the templates of the users nearest
+    centroids, so enrolling more templates barely changes the cost of a probe.
+    The centroid stage can itself use any other backend, e.g. 'ivf'.
+    """
+
+    def __init__(self, matrix, sq_norms=None, labels=None, users=8, centroid_index='linear',
+                 centroid_params=None):
+        self.matrix = matrix
+        self.sq_norms = np.einsum('ij,ij->i', matrix, matrix) if sq_norms is None else sq_norms
+        labels = np.arange(len(matrix)) if labels is None else np.asarray(labels)
+        self.users = users
+        counts = np.bincount(labels)
+
+        # Templates grouped by person; person i owns rows[offsets[i]:offsets[i + 1]].
+        self.rows = np.argsort(labels, kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        # Summed one template slot at a time: a few large gathers instead of
+        # np.add.reduceat, which is very slow on many tiny segments.
+        sums = np.zeros((len(counts), matrix.shape[1]), dtype=np.float32)
+        for slot in range(counts.max() if len(counts) else 0):
+            people = np.flatnonzero(counts > slot)
+            templates = np.take(matrix, self.rows[self.offsets[people] + slot], axis=0)
+            if len(people) == len(counts):
+                sums += templates
+            else:
+                sums[people] += templates
+        self.centroids = sums / np.maximum(counts, 1)[:, None].astype(np.float32)
+        self.centroid_index = build_index(centroid_index, self.centroids, **(centroid_params or {}))
+
+    def search(self, probe, k, identities=None):
+        """Return (row ids, squared distances) of the k nearest templates of the nearest users.
+
+        identities is the number of people the caller needs (k by default):
+        at least that many, and never fewer than users, centroids are searched.
+        """
+        people, _ = self.centroid_index.search(probe, max(self.users, k if identities is None else identities))
+        if not len(people):
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        ids = np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in people])
+        sq_dist = squared_distances(self.matrix[ids], probe, self.sq_norms[ids])
+        best = smallest(sq_dist, k)
+        return ids[best], sq_dist[best]
+
+
+# Shard indexes loaded in a ShardedIndex worker process, by the key of the index owning them.
+_shard_indexes = {}
+
+
+def _load_shard(key, shard, backend, params):
+    _shard_indexes[key] = build_index(backend, shard, **params)
+
+
+def _alias_shard(key, source):
+    _shard_indexes[key] = _shard_indexes[source]
+
+
+def _drop_shard(key):
+    _shard_indexes.pop(key, None)
+
+
+def _search_shard(key, probe, k):
+    return _shard_indexes[key].search(probe, k)
+
+
+def _shutdown_executors(executors):
+    for executor in executors:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _release_shards(executors, key):
+    for executor in executors:
+        try:
+            executor.submit(_drop_shard, key)
+        except RuntimeError:
+            # Already shut down.
+            pass
+
+
+class ShardWorkers:
+    """One single-process executor per shard, shut down when no ShardedIndex uses them any more."""
+
+    def __init__(self, shards):
+        self.executors = [ProcessPoolExecutor(max_workers=1) for _ in range(shards)]
+        self.keys = itertools.count()
+        self._finalizer = weakref.finalize(self, _shutdown_executors, self.executors)
+
+    def __len__(self):
+        return len(self.executors)
+
+    def close(self):
+        self._finalizer()
+
+
+class ShardedIndex:
+    """Scatter/gather search over row shards, each owned by its own worker process.
+
+    The probe is sent to every shard, each worker searches its rows with the
+    configured per-shard backend and the per-shard top-k lists are merged.
+
+    The workers outlive the index: a rebuild given previous (the index of the
+    gallery it replaces) sends the new shards to the same processes, and
+    shards whose rows did not change are not sent again. New rows go to the
+    last shard until it is twice its share, then the rows are split evenly
+    again. The shards of an index are dropped from the workers once no
+    request holds its gallery any more, and the workers are shut down with
+    the last index using them.
+
+    Below min_rows faces (empty galleries included) no worker is started and
+    the shard backend searches the whole matrix in-process: the round trip to
+    the workers costs more than the scan.
+    """
+
+    # build_index hands over the index being replaced as previous.
+    reuses_previous = True
+
+    def __init__(self, matrix, sq_norms=None, shards=4, shard_index='linear', shard_params=None, min_rows=100000,
+                 previous=None):
+        self.matrix = matrix
+        self.shard_index = shard_index
+        self.shard_params = dict(shard_params or {})
+        self.workers = None
+        if len(matrix) < max(min_rows, 1):
+            self.local = build_index(shard_index, matrix, sq_norms=sq_norms, **self.shard_params)
+            return
+        self.local = None
+        shards = max(1, min(shards, len(matrix)))
+        if previous is not None and previous.workers is not None and len(previous.workers) == shards:
+            self.workers = previous.workers
+        else:
+            previous = None
+            self.workers = ShardWorkers(shards)
+        self.bounds = self._bounds(len(matrix), shards, previous)
+        self.offsets = self.bounds[:-1]
+        self.key = next(self.workers.keys)
+        executors = self.workers.executors
+        self._finalizer = weakref.finalize(self, _release_shards, executors, self.key)
+        self._finalizer.atexit = False
+        futures, sent = [], 0
+        for shard, executor in enumerate(executors):
+            start, stop = self.bounds[shard], self.bounds[shard + 1]
+            if previous is not None and self._unchanged(previous, shard):
+                futures.append(executor.submit(_alias_shard, self.key, previous.key))
+            else:
+                futures.append(executor.submit(_load_shard, self.key, np.ascontiguousarray(matrix[start:stop]),
+                                               shard_index, self.shard_params))
+                sent += 1
+        for future in futures:
+            future.result()
+        logging.info(f"Loaded {sent} of {shards} shards over {len(matrix)} faces into the shard workers.")
+
+    @staticmethod
+    def _bounds(rows, shards, previous):
+        if previous is not None:
+            bounds = previous.bounds.copy()
+            bounds[-1] = rows
+            # Keep the shards of the previous index while the last one absorbs the new rows.
+            if bounds[-2] <= rows and rows - bounds[-2] <= 2 * rows / shards:
+                return bounds
+        return np.linspace(0, rows, shards + 1).astype(np.intp)
+
+    def _unchanged(self, previous, shard):
+        start, stop = self.bounds[shard], self.bounds[shard + 1]
+        if (start, stop) != (previous.bounds[shard], previous.bounds[shard + 1]):
+            return False
+        if (self.shard_index, self.shard_params) != (previous.shard_index, previous.shard_params):
+            return False
+        return np.array_equal(self.matrix[start:stop], previous.matrix[start:stop])
+
+    def search(self, probe, k):
+        """Return (row ids, squared distances) of the k nearest rows across all shards."""
+        if self.local is not None:
+            return self.local.search(probe, k)
+        futures = [executor.submit(_search_shard, self.key, probe, k) for executor in self.workers.executors]
+        results = [future.result() for future in futures]
+        ids = np.concatenate([shard_ids + offset for (shard_ids, _), offset in zip(results, self.offsets)])
+        sq_dist = np.concatenate([shard_dist for _, shard_dist in results])
+        best = smallest(sq_dist, k)
+        return ids[best], sq_dist[best]
+
+    def close(self):
+        """Stop the shard workers now instead of waiting for garbage collection."""
+        if self.workers is not None:
+            self.workers.close()
+
+
+INDEX_BACKENDS = {
+    'linear': LinearIndex,
+    'ivf': IVFFlatIndex,
+    'pq': PQIndex,
+    'quantized': QuantizedIndex,
+    'sharded': ShardedIndex,
+    'centroid': CentroidIndex,
+}
+
+
+def build_index(name, matrix, sq_norms=None, previous=None, **params):
+    """Build the search backend registered under name for the given matrix.
+
+    previous is the index being replaced, if any; backends that can reuse
+    its training or its workers (reuses_previous) get it.
+    """
+    try:
+        backend = INDEX_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown index backend '{name}'. Choose from: {', '.join(INDEX_BACKENDS)}")
+    if isinstance(previous, backend) and getattr(backend, 'reuses_previous', False):
+        params['previous'] = previous
+    return backend(matrix, sq_norms=sq_norms, **params)
@@ -0,0 +1,402 @@
+import bisect
+import logging
+import os
+import re
+from types import MappingProxyType
+
+import numpy as np
+
+from face_index import INDEX_BACKENDS, build_index, smallest
+
+# face_recognition produces 128-dimensional encodings.
+ENCODING_DIM = 128
+
+# File in a shared gallery directory holding the generation currently published.
+GENERATION_FILE = "CURRENT"
+
+# Partition (tenant/site/group) of users whose documents have no 'partition' field.
+DEFAULT_PARTITION = "default"
+# Partitions name directories of the shared gallery, so keep them path-safe.
+PARTITION_PATTERN = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$")
+
+# Longest name NameTable.grouped() pads every name to; longer ones are grouped as str.
+MAX_GROUPED_NAME_BYTES = 256
+
+
+def is_valid_partition(partition):
+    """Return True if partition is a usable partition name."""
+    return isinstance(partition, str) and PARTITION_PATTERN.match(partition) is not None
+
+
+def partition_filter(partition):
+    """Return the MongoDB filter selecting the users of one partition."""
+    if partition == DEFAULT_PARTITION:
+        # Users enrolled before partitions existed belong to the default partition.
+        return {'partition': {'$in': [None, DEFAULT_PARTITION]}}
+    return {'partition': partition}
+
+
+class NameTable:
+    """Read-only sequence of names stored as one UTF-8 blob plus an offsets array.
+
+    Both arrays can be memory-mapped, so worker processes share the names of
+    a published gallery instead of each holding a list of Python strings.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_names(cls, names):
+        encoded = [name.encode('utf-8') for name in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(f"name index {index} out of range")
+        index %= len(self)
+        return bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Return one NameTable holding the names of several tables in order."""
+        blobs, offsets, base = [np.empty(0, dtype=np.uint8)], [np.zeros(1, dtype=np.int64)], 0
+        for table in tables:
+            start, end = int(table.offsets[0]), int(table.offsets[-1])
+            blobs.append(np.asarray(table.blob[start:end], dtype=np.uint8))
+            offsets.append(np.asarray(table.offsets[1:], dtype=np.int64) - start + base)
+            base += end - start
+        return cls(np.concatenate(blobs), np.concatenate(offsets))
+
+    def take(self, indices):
+        """Return a NameTable of the names at indices, copying their bytes without decoding them."""
+        indices = np.asarray(indices, dtype=np.intp)
+        starts = np.asarray(self.offsets[:-1])[indices]
+        lengths = np.asarray(self.offsets[1:])[indices] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position in blob of every byte of the new table.
+        positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        return NameTable(np.asarray(self.blob)[positions], offsets)
+
+    def grouped(self):
+        """identity_labels() of the names, grouping their UTF-8 bytes instead of decoded strings.
+
+        Bytewise order of UTF-8 is code point order, so the identities come out
+        sorted exactly like str. Returns None for names too long to pad.
+        """
+        lengths = np.diff(np.asarray(self.offsets))
+        width = max(int(lengths.max()), 1) if len(lengths) else 1
+        if width > MAX_GROUPED_NAME_BYTES:
+            return None
+        # Every name zero-padded to width bytes, so names compare as fixed-size strings.
+        padded = np.zeros((len(self), width), dtype=np.uint8)
+        start = int(self.offsets[0])
+        columns = np.arange(int(self.offsets[-1]) - start) - np.repeat(np.asarray(self.offsets[:-1]) - start, lengths)
+        padded[np.repeat(np.arange(len(self)), lengths), columns] = np.asarray(self.blob[start:int(self.offsets[-1])])
+        keys, labels = np.unique(padded.view(f'S{width}').ravel(), return_inverse=True)
+        key_lengths = np.char.str_len(keys)
+        keys = keys.view(np.uint8).reshape(-1, width)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(key_lengths, out=offsets[1:])
+        return NameTable(keys[np.arange(width) < key_lengths[:, None]], offsets), labels.reshape(-1).astype(np.intp)
+
+
+def identity_labels(names):
+    """Return (identities, labels): the sorted distinct names and the position of each row's name in them.
+
+    The names of a NameTable are grouped without decoding them and the
+    identities returned as a NameTable.
+    """
+    if isinstance(names, NameTable):
+        grouped = names.grouped()
+        if grouped is not None:
+            return grouped
+    identities, labels = np.unique(np.array(list(names), dtype=object), return_inverse=True)
+    return identities, labels.astype(np.intp)
+
+
+class GalleryMatcher:
+    """Match a probe encoding against every known face.
+
+    All encodings are kept in one contiguous (N, 128) float32 matrix together
+    with their squared norms. Candidates come from a pluggable search index
+    (see face_index.py) and are always re-scored with exact distances, so the
+    tolerance decision is the same whichever index is used.
+
+    A person may be enrolled with several templates: every template is one row
+    and the rows of one person share a name. Searches return the nearest
+    template of each identity, and index='auto' uses the 'centroid' backend to
+    pre-filter on per-person centroids as soon as anyone has several templates.
+
+    A float32 memory-mapped matrix and a NameTable are used as they are, without
+    copying, which is how SharedGallery shares one gallery between processes.
+
+    A matcher is immutable once built: names are a tuple and every array is
+    read-only, so it can be shared by request threads without locks.
+
+    identities and labels as returned by identity_labels() may be passed in
+    (SharedGallery stores them with every generation) to skip grouping names.
+
+    previous is the matcher this one replaces, e.g. the partition's matcher
+    before a reload; indexes that can (IVF) reuse the training of its index.
+    """
+
+    def __init__(self, encodings, names, index='auto', index_params=None, rerank=16, identities=None, labels=None,
+                 previous=None):
+        self.names = names if isinstance(names, NameTable) else tuple(names)
+        if len(self.names):
+            matrix = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        else:
+            matrix = np.empty((0, ENCODING_DIM), dtype=np.float32)
+        if len(matrix) != len(self.names):
+            raise ValueError(f"Got {len(matrix)} encodings for {len(self.names)} names")
+        # A read-only view, so the caller's array keeps its own flags.
+        self.matrix = np.ascontiguousarray(matrix).view()
+        self.matrix.flags.writeable = False
+        self.rerank = rerank
+
+        # labels[row] is the position of the row's name in the sorted identities.
+        if labels is None:
+            identities, labels = identity_labels(self.names)
+        self.identities = identities
+        self.labels = np.asarray(labels, dtype=np.intp).view()
+        self.max_templates = int(np.bincount(self.labels).max()) if len(self.labels) else 1
+        # Templates grouped by identity for 1:1 verification; identity i owns
+        # template_rows[template_offsets[i]:template_offsets[i + 1]].
+        self.template_rows = np.argsort(self.labels, kind='stable')
+        self.template_offsets = np.concatenate(([0], np.cumsum(np.bincount(self.labels))))
+        for array in (self.labels, self.template_rows, self.template_offsets):
+            array.flags.writeable = False
+
+        index_params = dict(index_params or {})
+        if index == 'auto':
+            index = 'centroid' if self.max_templates > 1 else 'linear'
+        # Backends scanning only their own codes (pq, quantized) read the matrix just for
+        # the re-ranked rows, so a memory-mapped matrix is never paged in as a whole.
+        self.sq_norms = None
+        if getattr(INDEX_BACKENDS.get(index), 'scans_matrix', True):
+            self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+            self.sq_norms.flags.writeable = False
+        # The centroid backend is told how many identities a search needs.
+        self.grouped = index == 'centroid'
+        if self.grouped:
+            index_params['labels'] = self.labels
+        self.index = build_index(index, self.matrix, sq_norms=self.sq_norms,
+                                 previous=previous.index if previous is not None else None, **index_params)
+
+    def __len__(self):
+        return len(self.names)
+
+    def distances(self, face_encoding):
+        """Return the exact euclidean distance from the probe to every known face."""
+        probe = np.asarray(face_encoding, dtype=np.float64).reshape(ENCODING_DIM)
+        return np.linalg.norm(self.matrix - probe, axis=1)
+
+    def search(self, face_encoding, k=1):
+        """Return (row ids, exact distances) for the k nearest identities, nearest first.
+
+        Each identity is represented by its nearest template. The index proposes
+        enough candidate rows to cover k identities (at least rerank), which are
+        then re-ranked with exact float64 distances.
+        """
+        probe = np.asarray(face_encoding, dtype=np.float32).reshape(ENCODING_DIM)
+        candidates = max(k * self.max_templates, self.rerank)
+        if self.grouped:
+            ids, _ = self.index.search(probe, candidates, identities=k)
+        else:
+            ids, _ = self.index.search(probe, candidates)
+        exact = np.linalg.norm(self.matrix[ids] - probe.astype(np.float64), axis=1)
+        order = smallest(exact, len(exact))
+        # Keep only the nearest template of every identity.
+        _, first = np.unique(self.labels[ids[order]], return_index=True)
+        order = order[np.sort(first)[:k]]
+        return ids[order], exact[order]
+
+    def top_k(self, face_encoding, k=5):
+        """Return the k nearest identities as a list of (name, distance), nearest first."""
+        ids, distances = self.search(face_encoding, k=k)
+        return [(self.names[i], float(d)) for i, d in zip(ids, distances)]
+
+    def template_rows_of(self, name):
+        """Return the matrix rows holding the templates of name, or None if name is not in the gallery."""
+        # identities are sorted, so a binary search finds the name.
+        label = bisect.bisect_left(self.identities, name)
+        if label == len(self.identities) or self.identities[label] != name:
+            return None
+        return self.template_rows[self.template_offsets[label]:self.template_offsets[label + 1]]
+
+    def verify(self, name, face_encoding, tolerance=0.6):
+        """Compare the probe only with the templates of the claimed identity.
+
+        Returns (match, distance) where distance is that of the nearest template,
+        or (None, None) when name is not in the gallery.
+        """
+        rows = self.template_rows_of(name)
+        if rows is None:
+            return None, None
+        probe = np.asarray(face_encoding, dtype=np.float64).reshape(ENCODING_DIM)
+        distance = float(np.linalg.norm(self.matrix[rows] - probe, axis=1).min())
+        return distance <= tolerance, distance
+
+    def best_match(self, face_encoding, tolerance=0.6):
+        """Return (name, distance) of the closest known face.
+
+        name is None when the gallery is empty or the closest face is further
+        away than tolerance; distance is None only for an empty gallery.
+        """
+        ids, distances = self.search(face_encoding, k=1)
+        if not len(ids):
+            return None, None
+        distance = float(distances[0])
+        if distance <= tolerance:
+            return self.names[ids[0]], distance
+        return None, distance
+
+
+class GallerySnapshot:
+    """Immutable set of per-partition matchers, published by swapping one reference.
+
+    The updater builds the next snapshot off to the side with with_partition()
+    and assigns it to a single variable. A request reads that variable once
+    and uses the snapshot it got until it is done, so it never sees a
+    half-built gallery or names out of step with encodings, without locks.
+    """
+
+    def __init__(self, matchers=None, version=0):
+        self.matchers = MappingProxyType(dict(matchers or {}))
+        self.version = version
+
+    def get(self, partition):
+        """Return the matcher of a partition, or None if the partition is unknown."""
+        return self.matchers.get(partition)
+
+    def with_partition(self, partition, matcher):
+        """Return the next snapshot with partition set to matcher, or removed if matcher is None."""
+        matchers = {p: m for p, m in self.matchers.items() if p != partition}
+        if matcher is not None:
+            matchers[partition] = matcher
+        return GallerySnapshot(matchers, self.version + 1)
+
+
+def _generation_paths(directory, generation):
+    """Return the (matrix, offsets, names, identities, metadata) file paths of one published generation."""
+    prefix = os.path.join(directory, f"gallery-{generation}")
+    return (f"{prefix}.npy", f"{prefix}.offsets.npy", f"{prefix}.names",
+            f"{prefix}.identities.npz", f"{prefix}.meta.npz")
+
+
+def read_generation(directory):
+    """Return the generation currently published in directory, or 0 if there is none."""
+    try:
+        with open(os.path.join(directory, GENERATION_FILE)) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def publish_shared_gallery(directory, encodings, names, metadata=None):
+    """Write the gallery as a new generation and atomically make it the current one.
+
+    Every file is written under a temporary name and moved into place before
+    the generation file is replaced, so readers never map a partial gallery.
+    Only the current and the previous generation are kept on disk.
+
+    metadata is an optional dict of numeric arrays stored with the generation
+    (see read_shared_metadata), e.g. what GallerySync needs to resume.
+    """
+    os.makedirs(directory, exist_ok=True)
+    generation = read_generation(directory) + 1
+    matrix_path, offsets_path, names_path, identities_path, metadata_path = _generation_paths(directory, generation)
+    table = names if isinstance(names, NameTable) else NameTable.from_names(names)
+    matrix = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    # Grouped once here so readers do not have to decode every name to map the gallery.
+    identities, labels = identity_labels(table)
+    identity_table = NameTable.from_names(identities)
+
+    files = [
+        (matrix_path, lambda f: np.save(f, matrix)),
+        (offsets_path, lambda f: np.save(f, table.offsets)),
+        (names_path, lambda f: f.write(table.blob.tobytes())),
+        (identities_path, lambda f: np.savez(f, labels=labels, blob=identity_table.blob,
+                                             offsets=identity_table.offsets)),
+    ]
+    if metadata is not None:
+        files.append((metadata_path, lambda f: np.savez(f, **metadata)))
+    for path, write in files:
+        with open(f"{path}.tmp", 'wb') as f:
+            write(f)
+        os.replace(f"{path}.tmp", path)
+
+    with open(os.path.join(directory, f"{GENERATION_FILE}.tmp"), 'w') as f:
+        f.write(str(generation))
+    os.replace(os.path.join(directory, f"{GENERATION_FILE}.tmp"), os.path.join(directory, GENERATION_FILE))
+
+    for path in _generation_paths(directory, generation - 2):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Windows refuses to delete files that a reader still has mapped.
+            logging.debug(f"Could not remove old gallery file {path}: {e}")
+    logging.info(f"Published shared gallery generation {generation} with {len(matrix)} faces.")
+    return generation
+
+
+def read_shared_metadata(directory, generation):
+    """Return the metadata arrays published with a generation, or None if it has none."""
+    try:
+        with np.load(_generation_paths(directory, generation)[4], allow_pickle=False) as data:
+            return {key: data[key] for key in data.files}
+    except FileNotFoundError:
+        return None
+
+
+class SharedGallery:
+    """Read-only, memory-mapped view of a gallery published with publish_shared_gallery.
+
+    Every process maps the same files, so the encodings are held once in the
+    page cache no matter how many workers serve requests. refresh() remaps
+    when a new generation has been published.
+    """
+
+    def __init__(self, directory, **matcher_options):
+        self.directory = directory
+        self.matcher_options = matcher_options
+        self.generation = 0
+        self.matcher = GalleryMatcher([], [], **matcher_options)
+
+    def refresh(self):
+        """Map the current generation if it changed; returns True when remapped."""
+        generation = read_generation(self.directory)
+        if generation == self.generation:
+            return False
+        matrix_path, offsets_path, names_path, identities_path, _ = _generation_paths(self.directory, generation)
+        matrix = np.load(matrix_path, mmap_mode='r')
+        offsets = np.load(offsets_path, mmap_mode='r')
+        if offsets[-1]:
+            blob = np.memmap(names_path, dtype=np.uint8, mode='r')
+        else:
+            # numpy cannot map an empty file.
+            blob = np.empty(0, dtype=np.uint8)
+        try:
+            with np.load(identities_path, allow_pickle=False) as data:
+                grouping = {'identities': NameTable(data['blob'], data['offsets']), 'labels': data['labels']}
+        except FileNotFoundError:
+            # Published before identities were stored: group the names here.
+            grouping = {}
+        self.matcher = GalleryMatcher(matrix, NameTable(blob, offsets), previous=self.matcher, **self.matcher_options,
+                                      **grouping)
+        self.generation = generation
+        logging.info(f"Mapped shared gallery generation {generation} with {len(matrix)} faces.")
+        return True
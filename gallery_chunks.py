@@ -0,0 +1,237 @@
+import argparse
+import logging
+
+import numpy as np
+from bson import ObjectId
+from bson.binary import Binary
+from pymongo import MongoClient
+
+from gallery import NameTable, DEFAULT_PARTITION, partition_filter
+from gallery_sync import _to_micros
+from config import MONGODB_CONFIG
+from encoding_format import ENCODING_BYTES, ENCODING_FORMAT, gallery_matrix
+
+# Most template rows packed into one chunk document (2 MB of float32 encodings).
+CHUNK_ROWS = 4096
+# Attempts at an optimistic read-modify-write of one chunk before giving up.
+WRITE_RETRIES = 5
+
+# User fields copied into the chunks.
+CHUNK_USER_PROJECTION = {'name': 1, 'partition': 1, 'updated_at': 1, 'version': 1, 'encodings': 1, 'encoding_format': 1}
+
+# Packed fields of a chunk, as (field, dtype); one entry per user unless noted.
+PACKED_FIELDS = (
+    ('ids', np.uint8),              # 12 bytes per user: the ObjectId
+    ('versions', np.dtype('<i8')),
+    ('updated_at', np.dtype('<i8')),  # microseconds since the epoch, MISSING_TIME for None
+    ('rows', np.dtype('<i8')),      # templates of the user
+    ('names', np.uint8),            # UTF-8 name of every template row, back to back
+    ('name_offsets', np.dtype('<i8')),  # rows + 1 offsets into names
+)
+
+
+def _unpack_chunk(doc):
+    """Return the packed arrays and the encoding bytes of a chunk document."""
+    arrays = {field: np.frombuffer(doc[field], dtype=dtype) for field, dtype in PACKED_FIELDS}
+    arrays['ids'] = arrays['ids'].reshape(-1, 12)
+    return arrays, doc['encodings']
+
+
+def _chunk_document(partition, arrays, encodings, revision):
+    """Build a chunk document from its packed arrays and encoding bytes."""
+    doc = {field: Binary(np.ascontiguousarray(arrays[field], dtype=dtype).tobytes()) for field, dtype in PACKED_FIELDS}
+    doc.update({
+        'partition': partition,
+        # Parallel to the packed ids; only read to find the chunk of a user, never when loading.
+        'user_ids': [ObjectId(raw_id.tobytes()) for raw_id in arrays['ids']],
+        'encodings': Binary(encodings),
+        'encoding_format': ENCODING_FORMAT,
+        'users': len(arrays['ids']),
+        'rows_total': len(encodings) // ENCODING_BYTES,
+        'revision': revision,
+    })
+    return doc
+
+
+def _user_arrays(user):
+    """Return the packed arrays and encoding bytes of one typed user document."""
+    data = bytes(user['encodings'])
+    rows = len(data) // ENCODING_BYTES
+    row_names = NameTable.from_names([user['name']] * rows)
+    return {
+        'ids': np.frombuffer(user['_id'].binary, dtype=np.uint8).reshape(1, 12),
+        'versions': np.array([user.get('version', 0)], dtype=np.int64),
+        'updated_at': np.array([_to_micros(user.get('updated_at'))], dtype=np.int64),
+        'rows': np.array([rows], dtype=np.int64),
+        'names': row_names.blob,
+        'name_offsets': row_names.offsets,
+    }, data
+
+
+def _concat_arrays(parts):
+    """Concatenate the packed arrays of several chunks (or users) in order."""
+    arrays = {field: np.concatenate([part[field] for part in parts]) for field in ('ids', 'versions', 'updated_at', 'rows', 'names')}
+    offsets, base = [np.zeros(1, dtype=np.int64)], 0
+    for part in parts:
+        offsets.append(part['name_offsets'][1:] + base)
+        base += part['name_offsets'][-1]
+    arrays['name_offsets'] = np.concatenate(offsets)
+    return arrays
+
+
+def _drop_user(arrays, encodings, index):
+    """Return the packed arrays and encoding bytes without the user at index."""
+    row_ends = np.cumsum(arrays['rows'])
+    first, last = row_ends[index] - arrays['rows'][index], row_ends[index]
+    offsets = arrays['name_offsets']
+    cut = offsets[last] - offsets[first]
+    kept = {
+        field: np.delete(arrays[field], index, axis=0) for field in ('ids', 'versions', 'updated_at', 'rows')
+    }
+    kept['names'] = np.concatenate([arrays['names'][:offsets[first]], arrays['names'][offsets[last]:]])
+    kept['name_offsets'] = np.concatenate([offsets[:first + 1], offsets[last + 1:] - cut])
+    encodings = encodings[:first * ENCODING_BYTES] + encodings[last * ENCODING_BYTES:]
+    return kept, encodings
+
+
+class GalleryChunks:
+    """Packed copies of the gallery, up to chunk_rows template rows per document.
+
+    Each chunk holds the float32 encodings of a few thousand users of one
+    partition as one binary blob, with packed parallel arrays of their ids,
+    versions, updated_at and row names, so a whole gallery is read in a few
+    hundred documents and decoded with np.frombuffer instead of one BSON
+    document per user.
+
+    Writers going through the application keep the chunks current with
+    write_user() and remove_user(); each is an optimistic read-modify-write
+    of one chunk guarded by its revision. Chunks are only a cache: loaders
+    compare them with the users collection and fetch what differs, and
+    rebuild() writes them again from scratch (run it after bulk changes made
+    directly in the database).
+    """
+
+    def __init__(self, collection, chunk_rows=CHUNK_ROWS):
+        self.collection = collection
+        self.chunk_rows = chunk_rows
+        self.collection.create_index('user_ids')
+        self.collection.create_index([('partition', 1), ('rows_total', 1)])
+
+    def load(self, scope=None):
+        """Return {partition: packed arrays plus 'matrix'} of all chunks, for some partitions only with scope."""
+        query = {} if scope is None else {'partition': {'$in': sorted(scope)}}
+        parts, blobs = {}, {}
+        # Chunks are large: a few per cursor batch; user_ids is only an index.
+        for doc in self.collection.find(query, {'user_ids': 0}, batch_size=4).sort('_id', 1):
+            if doc.get('encoding_format') != ENCODING_FORMAT:
+                logging.warning(f"Skipping gallery chunk {doc['_id']} in format {doc.get('encoding_format')!r}.")
+                continue
+            arrays, encodings = _unpack_chunk(doc)
+            parts.setdefault(doc['partition'], []).append(arrays)
+            blobs.setdefault(doc['partition'], []).append(encodings)
+        packed = {}
+        for partition, chunks in parts.items():
+            arrays = _concat_arrays(chunks)
+            arrays['matrix'] = gallery_matrix(blobs[partition])
+            packed[partition] = arrays
+        return packed
+
+    def write_user(self, user):
+        """Store the current templates of one user document in the chunks, replacing its previous copy."""
+        self.remove_user(user['_id'])
+        if user.get('encoding_format') != ENCODING_FORMAT or not len(user.get('encodings') or b''):
+            # Legacy records are not packed; loaders fetch them from the users collection.
+            return
+        partition = user.get('partition') or DEFAULT_PARTITION
+        user_arrays, data = _user_arrays(user)
+        rows = len(data) // ENCODING_BYTES
+        for _ in range(WRITE_RETRIES):
+            chunk = self.collection.find_one({'partition': partition, 'rows_total': {'$lte': self.chunk_rows - rows}},
+                                             {'user_ids': 0})
+            if chunk is None:
+                self.collection.insert_one(_chunk_document(partition, user_arrays, data, 1))
+                return
+            arrays, encodings = _unpack_chunk(chunk)
+            doc = _chunk_document(partition, _concat_arrays([arrays, user_arrays]), encodings + data,
+                                  chunk['revision'] + 1)
+            if self.collection.replace_one({'_id': chunk['_id'], 'revision': chunk['revision']}, doc).matched_count:
+                return
+        raise RuntimeError(f"Could not add user {user['name']} to a gallery chunk: too many concurrent writes")
+
+    def write_users(self, users_collection, user_ids):
+        """Copy the current documents of some users into the chunks."""
+        for user in users_collection.find({'_id': {'$in': list(user_ids)}}, CHUNK_USER_PROJECTION):
+            self.write_user(user)
+
+    def remove_user(self, user_id):
+        """Remove one user from the chunks, if it is in one."""
+        for _ in range(WRITE_RETRIES):
+            chunk = self.collection.find_one({'user_ids': user_id})
+            if chunk is None:
+                return
+            index = chunk['user_ids'].index(user_id)
+            arrays, encodings = _unpack_chunk(chunk)
+            guard = {'_id': chunk['_id'], 'revision': chunk['revision']}
+            if len(arrays['ids']) == 1:
+                result = self.collection.delete_one(guard)
+                if result.deleted_count:
+                    return
+                continue
+            arrays, encodings = _drop_user(arrays, encodings, index)
+            doc = _chunk_document(chunk['partition'], arrays, encodings, chunk['revision'] + 1)
+            if self.collection.replace_one(guard, doc).matched_count:
+                return
+        raise RuntimeError(f"Could not remove user {user_id} from its gallery chunk: too many concurrent writes")
+
+    def rebuild(self, users_collection, partitions=None, batch_size=2000):
+        """Write the chunks of some partitions (all by default) again from the users collection.
+
+        The new chunks are inserted before the old ones are deleted, so a
+        concurrent loader sees duplicates rather than missing users; it
+        detects them and falls back to the users collection. Returns the
+        number of users packed.
+        """
+        query = {} if partitions is None else {'$or': [partition_filter(p) for p in sorted(partitions)]}
+        old_query = {} if partitions is None else {'partition': {'$in': sorted(partitions)}}
+        old_ids = [doc['_id'] for doc in self.collection.find(old_query, {'_id': 1})]
+        # partition -> (list of user arrays, list of encodings, rows so far)
+        pending = {}
+        packed = 0
+        for user in users_collection.find(query, CHUNK_USER_PROJECTION, batch_size=batch_size):
+            if user.get('encoding_format') != ENCODING_FORMAT or not len(user.get('encodings') or b''):
+                continue
+            partition = user.get('partition') or DEFAULT_PARTITION
+            user_arrays, data = _user_arrays(user)
+            parts, blobs, rows = pending.get(partition, ([], [], 0))
+            if rows + len(data) // ENCODING_BYTES > self.chunk_rows and parts:
+                self.collection.insert_one(_chunk_document(partition, _concat_arrays(parts), b''.join(blobs), 1))
+                parts, blobs, rows = [], [], 0
+            parts.append(user_arrays)
+            blobs.append(data)
+            pending[partition] = (parts, blobs, rows + len(data) // ENCODING_BYTES)
+            packed += 1
+        for partition, (parts, blobs, _) in pending.items():
+            self.collection.insert_one(_chunk_document(partition, _concat_arrays(parts), b''.join(blobs), 1))
+        if old_ids:
+            self.collection.delete_many({'_id': {'$in': old_ids}})
+        logging.info(f"Packed {packed} users into gallery chunks.")
+        return packed
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Rebuild the packed gallery chunks from the users collection.")
+    parser.add_argument("--collection", default=MONGODB_CONFIG['chunk_collection'] or "gallery_chunks",
+                        help="collection holding the chunks")
+    parser.add_argument("--partition", action="append", help="only rebuild this partition (repeatable)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="most template rows per chunk")
+    args = parser.parse_args()
+
+    client = MongoClient(MONGODB_CONFIG['host'])
+    db = client[MONGODB_CONFIG['database']]
+    chunks = GalleryChunks(db[args.collection], args.chunk_rows)
+    chunks.rebuild(db[MONGODB_CONFIG['collection']], args.partition)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,524 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import numpy as np
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from gallery import (GalleryMatcher, GallerySnapshot, SharedGallery, publish_shared_gallery,
+                     ENCODING_DIM, DEFAULT_PARTITION, partition_filter, is_valid_partition)
+from gallery_sync import GallerySync, map_snapshot, USER_PROJECTION
+from face_index import INDEX_BACKENDS
+from encoding_format import ENCODING_BYTES, ENCODING_FORMAT, encoding_fields, gallery_matrix, pack_encodings, stored_encodings
+from legacy_conversion import LegacyConverter
+from gallery_chunks import GalleryChunks
+
+
+class MongoStore(GallerySync):
+    """Users stored in MongoDB, kept in memory with the incremental reads of GallerySync.
+
+    Records holding a JS/base64 image are queued in a LegacyConverter pool
+    and join the gallery on a later poll, once converted and written back.
+    conversion holds the LegacyConverter options (see CONVERSION_CONFIG).
+
+    With chunk_collection, the gallery is also kept in packed chunks (see
+    gallery_chunks.py) that the full load reads instead of every user
+    document; users added through add_user or converted are written to them.
+    """
+
+    def __init__(self, host='mongodb://localhost:27017/', database='face_recognition_db', collection='users',
+                 conversion=None, chunk_collection=None, **sync_options):
+        try:
+            self.client = MongoClient(host)
+            users_collection = self.client[database][collection]
+            users_collection.create_index("name", unique=True)  # Ensure fast lookups
+            chunks = GalleryChunks(self.client[database][chunk_collection]) if chunk_collection else None
+            logging.info("MongoDB connection successful")
+        except PyMongoError as e:
+            raise RuntimeError(f"MongoDB connection failed: {e}")
+        super().__init__(users_collection, self.decode_user, chunks=chunks, **sync_options)
+        self.converter = LegacyConverter(users_collection, chunks=chunks, **(conversion or {}))
+
+    def decode_user(self, user):
+        """Return the packed encodings of a user document, or b'' if none can be read."""
+        try:
+            data = stored_encodings(user)
+        except Exception as e:
+            logging.error(f"Failed to load face templates for user {user['name']}: {e}")
+            return b''
+        if data is not None:
+            return data
+
+        logging.warning(f"No encoding stored for user {user['name']} (likely stored from JS). Queued for conversion.")
+        self.converter.submit(user)
+        return b''
+
+    def poll(self):
+        # Converted legacy users are written back here and picked up by the poll.
+        self.converter.flush()
+        return super().poll()
+
+    def busy(self):
+        """Return True while legacy conversions are running or waiting."""
+        return self.converter.busy()
+
+    def add_user(self, name, encodings, partition=DEFAULT_PARTITION):
+        """Store a new user with its templates; raises ValueError if the name is taken."""
+        try:
+            result = self.collection.insert_one({
+                'name': name,
+                'partition': partition,
+                # All templates as raw float32 bytes, see encoding_format.py.
+                **encoding_fields(encodings),
+                'created_at': datetime.now(),
+                # Watermark and version used for incremental gallery syncs.
+                'updated_at': datetime.now(timezone.utc),
+                'version': 1
+            })
+        except DuplicateKeyError:
+            raise ValueError(f"User {name} already exists.")
+        if self.chunks is not None:
+            # Copied as stored, so the chunk matches what the users collection returns.
+            self.chunks.write_users(self.collection, [result.inserted_id])
+
+    def find_user(self, name, partition=DEFAULT_PARTITION):
+        """Return the packed templates of one user read from the database, or None if unknown."""
+        user = self.collection.find_one({'name': name, **partition_filter(partition)}, USER_PROJECTION)
+        return (self.decode_user(user) or None) if user else None
+
+    def user_name(self, user_id):
+        """Return the name of the user with this id, or None; raises ValueError for a malformed id."""
+        try:
+            user_id = ObjectId(user_id)
+        except (InvalidId, TypeError):
+            raise ValueError(f"Invalid user_id {user_id!r}")
+        user = self.collection.find_one({'_id': user_id}, {'name': 1})
+        return user['name'] if user else None
+
+    def close(self):
+        self.converter.close()
+        self.client.close()
+        logging.info("MongoDB connection closed.")
+
+
+SQLITE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        partition TEXT NOT NULL,
+        encodings BLOB NOT NULL,
+        encoding_format TEXT NOT NULL,
+        created_at TEXT,
+        updated_at TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 1
+    )""",
+    "CREATE INDEX IF NOT EXISTS users_partition ON users (partition)",
+)
+
+
+class SQLiteStore:
+    """Users stored in one SQLite file, for single machines without a database server.
+
+    Every poll reads a fingerprint of each partition (count, newest
+    updated_at, sums of ids and versions) with one grouped query and reloads
+    only the partitions whose fingerprint changed, with one np.frombuffer
+    each. Ids are never reused, so writers only have to set updated_at and
+    increment version on every update, as with MongoDB.
+    """
+
+    def __init__(self, path='./gallery.db', scope=None):
+        self.path = path
+        self.scope = None if scope is None else sorted(scope)
+        # partition -> (matrix, names)
+        self.partitions = {}
+        self.fingerprints = {}
+        with self._connect() as conn:
+            for statement in SQLITE_SCHEMA:
+                conn.execute(statement)
+
+    @contextmanager
+    def _connect(self):
+        # One connection per call, so the store can be used from any thread.
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def poll(self):
+        """Reload the partitions that changed since the last poll; returns their names."""
+        where, params = '', ()
+        if self.scope is not None:
+            where, params = f"WHERE partition IN ({', '.join('?' * len(self.scope))})", tuple(self.scope)
+        with self._connect() as conn:
+            fingerprints = {
+                row[0]: tuple(row[1:]) for row in conn.execute(
+                    "SELECT partition, COUNT(*), MAX(updated_at), SUM(version), SUM(id) "
+                    f"FROM users {where} GROUP BY partition", params)
+                if is_valid_partition(row[0])
+            }
+            changed = {p for p in set(fingerprints) | set(self.fingerprints)
+                       if fingerprints.get(p) != self.fingerprints.get(p)}
+            for partition in changed:
+                if partition in fingerprints:
+                    self.partitions[partition] = self._load(conn, partition)
+                else:
+                    self.partitions.pop(partition, None)
+        self.fingerprints = fingerprints
+        return changed
+
+    def _load(self, conn, partition):
+        blobs, names = [], []
+        rows = conn.execute("SELECT name, encodings, encoding_format FROM users WHERE partition = ? ORDER BY id",
+                            (partition,))
+        for name, data, encoding_format in rows:
+            if encoding_format != ENCODING_FORMAT or len(data) % ENCODING_BYTES:
+                logging.error(f"Skipping user {name} with unsupported encodings ({encoding_format!r}).")
+                continue
+            blobs.append(data)
+            names.extend([name] * (len(data) // ENCODING_BYTES))
+        logging.info(f"Loaded {len(names)} faces of partition {partition} from {self.path}.")
+        return gallery_matrix(blobs), names
+
+    def matcher(self, partition, **matcher_options):
+        """Build a GalleryMatcher from the loaded users of one partition."""
+        return GalleryMatcher(*self.partitions.get(partition, ([], [])), **matcher_options)
+
+    def add_user(self, name, encodings, partition=DEFAULT_PARTITION):
+        """Store a new user with its templates; raises ValueError if the name is taken."""
+        now = datetime.now(timezone.utc).isoformat()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT INTO users (name, partition, encodings, encoding_format, created_at, updated_at, version) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 1)",
+                    (name, partition, pack_encodings(encodings), ENCODING_FORMAT, now, now))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"User {name} already exists.")
+
+    def find_user(self, name, partition=DEFAULT_PARTITION):
+        """Return the packed templates of one user, or None if unknown."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT encodings FROM users WHERE name = ? AND partition = ?",
+                               (name, partition)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def user_name(self, user_id):
+        """Return the name of the user with this id, or None; raises ValueError for a malformed id."""
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid user_id {user_id!r}")
+        with self._connect() as conn:
+            row = conn.execute("SELECT name FROM users WHERE id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        pass
+
+
+class FileStore:
+    """Galleries published with publish_shared_gallery, one directory per partition.
+
+    This is how 'reader' API workers follow the gallery of a 'writer': a poll
+    only reads each partition's generation file and remaps the partitions
+    that were republished, without copying. The matchers are built once per
+    generation with matcher_options. add_user publishes a new generation, so
+    only one process should write to a directory.
+    """
+
+    def __init__(self, directory='./shared_gallery', scope=None, matcher_options=None):
+        self.directory = directory
+        self.scope = None if scope is None else set(scope)
+        self.matcher_options = dict(matcher_options or {})
+        # partition -> SharedGallery
+        self.partitions = {}
+
+    def poll(self):
+        """Map the partitions published since the last poll; returns their names."""
+        names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        found = {p for p in names if is_valid_partition(p) and (self.scope is None or p in self.scope)}
+        changed = set(self.partitions) - found
+        for partition in changed:
+            del self.partitions[partition]
+        for partition in sorted(found):
+            if partition not in self.partitions:
+                self.partitions[partition] = SharedGallery(os.path.join(self.directory, partition),
+                                                           **self.matcher_options)
+            if self.partitions[partition].refresh():
+                changed.add(partition)
+        return changed
+
+    def matcher(self, partition, **matcher_options):
+        """Return the mapped matcher of one partition (built with the store's matcher_options)."""
+        gallery = self.partitions.get(partition)
+        return gallery.matcher if gallery is not None else GalleryMatcher([], [], **self.matcher_options)
+
+    def add_user(self, name, encodings, partition=DEFAULT_PARTITION):
+        """Publish the partition again with a new user; raises ValueError if the name is taken."""
+        gallery = SharedGallery(os.path.join(self.directory, partition))
+        gallery.refresh()
+        current = gallery.matcher
+        if current.template_rows_of(name) is not None:
+            raise ValueError(f"User {name} already exists.")
+        templates = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        publish_shared_gallery(gallery.directory, np.concatenate([current.matrix, templates]),
+                               list(current.names) + [name] * len(templates))
+
+    def find_user(self, name, partition=DEFAULT_PARTITION):
+        """Return the packed templates of one user as last mapped, or None if unknown."""
+        gallery = self.partitions.get(partition)
+        rows = gallery.matcher.template_rows_of(name) if gallery is not None else None
+        return pack_encodings(gallery.matcher.matrix[rows]) if rows is not None else None
+
+    def user_name(self, user_id):
+        # Published galleries only hold names.
+        return None
+
+    def close(self):
+        pass
+
+
+STORAGE_BACKENDS = {
+    'mongo': MongoStore,
+    'sqlite': SQLiteStore,
+    'file': FileStore,
+}
+
+
+def build_store(name, **params):
+    """Create the storage backend registered under name with its parameters."""
+    try:
+        backend = STORAGE_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown storage backend '{name}'. Choose from: {', '.join(STORAGE_BACKENDS)}")
+    return backend(**params)
+
+
+# 'stopped': not started; 'warming': restoring the snapshot; 'loading': first load running;
+# 'failed': first load failed, retried on the next interval; 'ready': serving a loaded gallery.
+READINESS_STATES = ('stopped', 'warming', 'loading', 'failed', 'ready')
+
+
+class GalleryService:
+    """The in-memory gallery of the API and the camera tools, on top of any storage backend.
+
+    refresh() polls the store, rebuilds the matchers of the partitions that
+    changed with matcher_options (see GALLERY_CONFIG) and publishes them as
+    a new GallerySnapshot; get() is lock-free and returns the matcher of the
+    current snapshot. Stores that support it (MongoStore) are warm-started
+    from a snapshot saved in snapshot_directory, saved again at most every
+    snapshot_interval seconds. With publish_directory every rebuilt
+    partition is also published for FileStore readers.
+
+    With serve_mapped (and a snapshot_directory), stores that support it
+    save every changed partition to its snapshot right away and serve it
+    from the mapped files, so the full-precision rows stay in the page
+    cache rather than the heap; with a compressed index ('pq', 'quantized')
+    only the reranked shortlist is read from them. serve_mapped=None (the
+    default) turns it on exactly for those indexes.
+
+    stats() reports sizes, poll and reload counts and durations.
+
+    The service goes through the READINESS_STATES: it becomes 'ready' once a
+    snapshot was restored or the first refresh succeeded. start() does both
+    in its thread, so callers are not blocked and use wait_ready() with a
+    timeout, or readiness() to report progress, until then.
+    """
+
+    def __init__(self, store, matcher_options=None, snapshot_directory=None, snapshot_interval=60,
+                 publish_directory=None, serve_mapped=None):
+        self.store = store
+        self.matcher_options = dict(matcher_options or {})
+        self.snapshot_directory = snapshot_directory
+        self.snapshot_interval = snapshot_interval
+        self.publish_directory = publish_directory
+        if serve_mapped is None:
+            backend = INDEX_BACKENDS.get(self.matcher_options.get('index'))
+            serve_mapped = not getattr(backend, 'scans_matrix', True)
+        self.serve_mapped = serve_mapped and snapshot_directory is not None and hasattr(store, 'map_partition')
+        self.snapshot = GallerySnapshot()
+        # Matcher used for partitions without users.
+        self.empty = GalleryMatcher([], [], **self.matcher_options)
+        self.unsaved = set()
+        self.last_saved = None
+        # Partitions served from a snapshot the store could not resume from: the next
+        # refresh rebuilds (or drops) them whatever the store reports as changed.
+        self.unconfirmed = set()
+        # Serializes refreshes; readers never take it.
+        self.lock = threading.Lock()
+        self.metrics = {
+            'polls': 0, 'reloads': 0, 'errors': 0, 'snapshot_saves': 0,
+            'last_poll_seconds': None, 'last_reload_seconds': None, 'last_error': None,
+        }
+        self.state = 'stopped'
+        self.ready_event = threading.Event()
+        self.started_at = time.monotonic()
+        self.ready_at = None
+
+    def get(self, partition=DEFAULT_PARTITION):
+        """Return the matcher of a partition, or None if the partition is unknown.
+
+        Call once per request and use the result throughout: a reload publishes
+        a new snapshot instead of changing the matcher already returned.
+        """
+        gallery = self.snapshot.get(partition)
+        if gallery is None and partition == DEFAULT_PARTITION:
+            return self.empty
+        return gallery
+
+    def warm_start(self):
+        """Serve the snapshot saved by the last run, if any; returns True when the store resumed from it.
+
+        The mapped matchers are served, and the service is ready, before the
+        store rebuilds the state its polls diff against, so readiness only
+        costs mapping the files.
+        """
+        if self.snapshot_directory is None or not hasattr(self.store, 'restore_snapshot'):
+            return False
+        try:
+            shared = map_snapshot(self.snapshot_directory, **self.matcher_options)
+        except Exception as e:
+            logging.error(f"Could not map the gallery snapshot: {e}")
+            return False
+        if self.store.scope is not None:
+            shared = {p: gallery for p, gallery in shared.items() if p in self.store.scope}
+        served = {partition: saved.matcher for partition, saved in shared.items() if len(saved.matcher)}
+        if not served:
+            return False
+        snapshot = self.snapshot
+        for partition, matcher in served.items():
+            snapshot = snapshot.with_partition(partition, matcher)
+        self.snapshot = snapshot
+        self._set_ready()
+
+        with self.lock:
+            try:
+                restored = self.store.restore_snapshot(shared)
+            except Exception as e:
+                logging.error(f"Could not restore the gallery snapshot: {e}")
+                restored = False
+            if restored:
+                self.last_saved = time.monotonic()
+            else:
+                self.unconfirmed = set(served)
+        return restored
+
+    def refresh(self):
+        """Apply the changes of the store and swap in the rebuilt matchers; returns the changed partitions."""
+        with self.lock:
+            if not self.ready_event.is_set():
+                self.state = 'loading'
+            started = time.perf_counter()
+            changed = self.store.poll() | self.unconfirmed
+            self.unconfirmed = set()
+            polled = time.perf_counter()
+            snapshot = self.snapshot
+            mapped = set()
+            for partition in sorted(changed):
+                gallery = self._mapped_matcher(partition, snapshot.get(partition))
+                if gallery is not None:
+                    mapped.add(partition)
+                else:
+                    gallery = self.store.matcher(partition, previous=snapshot.get(partition), **self.matcher_options)
+                if self.publish_directory is not None:
+                    publish_shared_gallery(os.path.join(self.publish_directory, partition),
+                                           gallery.matrix, gallery.names)
+                snapshot = snapshot.with_partition(partition, gallery if partition in self.store.partitions else None)
+                logging.info(f"Loaded {len(gallery)} known faces of partition {partition} into memory "
+                             f"(snapshot {snapshot.version}).")
+            self.snapshot = snapshot
+            self.metrics['polls'] += 1
+            self.metrics['last_poll_seconds'] = polled - started
+            if changed:
+                self.metrics['reloads'] += 1
+                self.metrics['last_reload_seconds'] = time.perf_counter() - started
+            # Mapped partitions were saved as they were rebuilt.
+            self._save_snapshot(changed - mapped)
+            self._set_ready()
+            return changed
+
+    def _mapped_matcher(self, partition, previous):
+        """Save one partition to its snapshot and return the matcher mapped from it, or None."""
+        if not self.serve_mapped:
+            return None
+        return self.store.map_partition(partition, os.path.join(self.snapshot_directory, partition),
+                                        previous=previous, **self.matcher_options)
+
+    def _set_ready(self):
+        if not self.ready_event.is_set():
+            self.state = 'ready'
+            self.ready_at = time.monotonic()
+            self.ready_event.set()
+
+    def wait_ready(self, timeout=None):
+        """Block until the gallery is ready or timeout seconds passed; returns True if ready."""
+        return self.ready_event.wait(timeout)
+
+    def readiness(self):
+        """Return the readiness state and the progress of the initial load as a JSON-friendly dict."""
+        now = time.monotonic()
+        progress = getattr(self.store, 'progress', None)
+        return {
+            'state': self.state,
+            'ready': self.ready_event.is_set(),
+            'seconds_since_start': now - self.started_at,
+            'seconds_to_ready': None if self.ready_at is None else self.ready_at - self.started_at,
+            'faces': sum(len(matcher) for matcher in self.snapshot.matchers.values()),
+            'progress': progress() if progress is not None else None,
+            'last_error': self.metrics['last_error'],
+        }
+
+    def _save_snapshot(self, changed):
+        if self.snapshot_directory is None or not hasattr(self.store, 'save_snapshot'):
+            return
+        self.unsaved |= changed
+        # Without a snapshot to start from, save one right after the first load.
+        if self.unsaved and (self.last_saved is None or
+                             time.monotonic() - self.last_saved >= self.snapshot_interval):
+            self.store.save_snapshot(self.snapshot_directory, self.unsaved)
+            self.unsaved = set()
+            self.last_saved = time.monotonic()
+            self.metrics['snapshot_saves'] += 1
+
+    def run(self, interval):
+        """Warm-start, then refresh every interval seconds, more often while the store converts legacy users."""
+        self.started_at = time.monotonic()
+        self.state = 'warming'
+        self.warm_start()
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                if not self.ready_event.is_set():
+                    self.state = 'failed'
+                self.metrics['errors'] += 1
+                self.metrics['last_error'] = str(e)
+                logging.error(f"Error in background gallery update: {e}")
+            busy = getattr(self.store, 'busy', None)
+            time.sleep(min(interval, 0.5) if busy is not None and busy() else interval)
+
+    def start(self, interval):
+        """Start the background thread that loads the gallery and keeps it current; returns at once."""
+        thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        """Return the gallery sizes and the refresh metrics as a JSON-friendly dict."""
+        snapshot = self.snapshot
+        return {
+            'store': type(self.store).__name__,
+            'version': snapshot.version,
+            'partitions': {partition: len(matcher) for partition, matcher in snapshot.matchers.items()},
+            'faces': sum(len(matcher) for matcher in snapshot.matchers.values()),
+            **self.metrics,
+        }
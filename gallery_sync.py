@@ -0,0 +1,748 @@
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from gallery import (GalleryMatcher, NameTable, SharedGallery, publish_shared_gallery, read_shared_metadata,
+                     ENCODING_DIM, DEFAULT_PARTITION, partition_filter, is_valid_partition)
+from encoding_format import ENCODING_BYTES, ENCODING_FORMAT, gallery_matrix
+
+
+# One user in memory: encodings are packed float32 bytes (see encoding_format.py)
+# and version counts the writes to its document.
+UserEntry = namedtuple('UserEntry', 'name encodings updated_at version')
+
+# The only fields the gallery reads; audit fields and the like are never transferred.
+# face_encoding and face_encodings only exist on records not yet migrated (migrate_encodings.py).
+USER_PROJECTION = {
+    'name': 1, 'partition': 1, 'updated_at': 1, 'version': 1,
+    'encodings': 1, 'encoding_format': 1, 'face_encodings': 1, 'face_encoding': 1
+}
+
+# Modulus of the per-user fingerprint hash; sums of up to 2**32 hashes fit in a long.
+FINGERPRINT_MODULUS = 2147483647
+
+
+def _user_hash_expression():
+    """Aggregation expression hashing one user's _id and version.
+
+    A polynomial rolling hash of the 24 hex digits of the ObjectId, seeded
+    with the version, modulo FINGERPRINT_MODULUS. Same value as user_hash().
+    """
+    return {'$reduce': {
+        'input': {'$range': [0, 24]},
+        'initialValue': {'$ifNull': ['$version', 0]},
+        'in': {'$mod': [{'$add': [
+            {'$multiply': ['$$value', 16]},
+            {'$indexOfBytes': ['0123456789abcdef', {'$substrBytes': [{'$toString': '$_id'}, '$$this', 1]}]}
+        ]}, FINGERPRINT_MODULUS]}
+    }}
+
+
+def user_hash(user_id, version):
+    """Python counterpart of _user_hash_expression()."""
+    value = version
+    for digit in str(user_id):
+        value = (value * 16 + int(digit, 16)) % FINGERPRINT_MODULUS
+    return value
+
+
+def user_hashes(ids, versions):
+    """Vectorized user_hash() of many users, ids given as an (N, 12) uint8 array of ObjectId bytes."""
+    ids = np.asarray(ids, dtype=np.uint8).reshape(-1, 12)
+    # The 24 hex digits of every id, most significant first.
+    digits = np.empty((len(ids), 24), dtype=np.int64)
+    digits[:, 0::2] = ids >> 4
+    digits[:, 1::2] = ids & 15
+    values = np.array(versions, dtype=np.int64)
+    for column in digits.T:
+        values = (values * 16 + column) % FINGERPRINT_MODULUS
+    return values
+
+
+# Snapshot timestamps are stored as microseconds since EPOCH, MISSING_TIME for None.
+EPOCH = datetime(1970, 1, 1)
+MISSING_TIME = np.iinfo(np.int64).min
+
+
+def partition_fingerprints(collection, query=None):
+    """Return {partition: (count, max updated_at, hash sum)} computed server-side in one aggregation.
+
+    The hash sum is order-independent, so any insert, delete or version bump
+    changes the fingerprint even when count and newest updated_at stay the same.
+    query optionally restricts the users taken into account.
+    """
+    stages = [{'$match': query}] if query else []
+    stages.append({'$group': {
+        '_id': {'$ifNull': ['$partition', DEFAULT_PARTITION]},
+        'count': {'$sum': 1},
+        'max_updated_at': {'$max': '$updated_at'},
+        'hash_sum': {'$sum': _user_hash_expression()}
+    }})
+    return {
+        doc['_id']: (doc['count'], doc['max_updated_at'], doc['hash_sum'])
+        for doc in collection.aggregate(stages)
+    }
+
+
+def partition_row_counts(collection, query=None):
+    """Return {partition: upper bound on the gallery rows of its users} from one aggregation.
+
+    Typed records count their templates, legacy records one row per pickle
+    (or one for an image still to be converted).
+    """
+    rows = {'$cond': [
+        {'$eq': ['$encoding_format', ENCODING_FORMAT]},
+        {'$divide': [{'$binarySize': '$encodings'}, ENCODING_BYTES]},
+        {'$max': [1, {'$size': {'$ifNull': ['$face_encodings', []]}}]}
+    ]}
+    stages = [{'$match': query}] if query else []
+    stages.append({'$group': {'_id': {'$ifNull': ['$partition', DEFAULT_PARTITION]}, 'rows': {'$sum': rows}}})
+    return {doc['_id']: int(doc['rows']) for doc in collection.aggregate(stages)}
+
+
+def local_fingerprint(users):
+    """Compute the partition_fingerprints() tuple of an in-memory {_id: UserEntry} dict."""
+    updated = [entry.updated_at for entry in users.values() if entry.updated_at is not None]
+    try:
+        ids = np.frombuffer(b''.join(user_id.binary for user_id in users), dtype=np.uint8)
+    except AttributeError:
+        # Ids that are not ObjectIds are hashed through their string form.
+        hash_sum = sum(user_hash(user_id, entry.version) for user_id, entry in users.items())
+    else:
+        hash_sum = int(user_hashes(ids, [entry.version for entry in users.values()]).sum())
+    return len(users), max(updated) if updated else None, hash_sum
+
+
+def _to_micros(value):
+    if value is None:
+        return MISSING_TIME
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(value):
+    return None if value == MISSING_TIME else EPOCH + timedelta(microseconds=int(value))
+
+
+def map_snapshot(directory, **matcher_options):
+    """Map the partitions saved with GallerySync.save_snapshot; returns {partition: SharedGallery}.
+
+    The matrices are memory-mapped, so the matchers can serve right away,
+    long before the users collection could have been read.
+    """
+    shared = {}
+    if not os.path.isdir(directory):
+        return shared
+    for partition in sorted(os.listdir(directory)):
+        if not is_valid_partition(partition):
+            continue
+        gallery = SharedGallery(os.path.join(directory, partition), **matcher_options)
+        try:
+            if gallery.refresh():
+                shared[partition] = gallery
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable gallery snapshot of partition {partition}: {e}")
+    return shared
+
+
+class PartitionUsers:
+    """The users of one partition: packed arrays as loaded, plus the users written since.
+
+    A snapshot or the gallery chunks give every user as parallel arrays
+    (ObjectId bytes, versions, updated_at, template rows) next to the matrix
+    and row names of their templates. These stay packed, without a Python
+    object per user: lookups binary-search the sorted ids, and fingerprints,
+    diffs and the gallery rows are computed with numpy. A packed user that
+    is written or removed is masked out; written users are kept as UserEntry
+    in entries.
+
+    With unique=False the arrays may hold a user twice (chunks read during a
+    rebuild) and only its last copy is kept.
+    """
+
+    def __init__(self, arrays=None, matrix=None, names=None, user_names=None, unique=True):
+        if arrays is None:
+            arrays = {'ids': (), 'versions': (), 'updated_at': (), 'rows': ()}
+            matrix = np.empty((0, ENCODING_DIM), dtype=np.float32)
+            names = user_names = NameTable.from_names([])
+        self.ids = np.ascontiguousarray(arrays['ids'], dtype=np.uint8).reshape(-1, 12)
+        self.versions = np.asarray(arrays['versions'], dtype=np.int64)
+        self.updated_at = np.asarray(arrays['updated_at'], dtype=np.int64)
+        self.template_counts = np.asarray(arrays['rows'], dtype=np.int64)
+        self.row_ends = np.cumsum(self.template_counts)
+        self.matrix = matrix
+        self.names = names
+        self.user_names = user_names
+        self.alive = np.ones(len(self.ids), dtype=bool)
+        self.packed_count = len(self.ids)
+        # _id -> UserEntry of the users written after the arrays were loaded.
+        self.entries = {}
+        # Sorted ids and the user_hashes() of the packed users, computed on first use.
+        self.order = None
+        self.keys = None
+        self.hashes = None
+        if not unique:
+            self._sort()
+
+    def _sort(self):
+        if self.order is not None:
+            return
+        keys = self.ids.view('S12').reshape(-1)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        # The stable sort puts the last copy of a user last among its copies.
+        self.alive[self.order[:-1][self.keys[1:] == self.keys[:-1]]] = False
+        self.packed_count = int(np.count_nonzero(self.alive))
+
+    def _index(self, user_id):
+        """Return the position of a user in the packed arrays, or None if it is not (or no longer) there."""
+        if not self.packed_count or not isinstance(user_id, ObjectId):
+            return None
+        self._sort()
+        position = int(np.searchsorted(self.keys, np.frombuffer(user_id.binary, dtype='S12'), side='right')[0]) - 1
+        if position < 0:
+            return None
+        index = int(self.order[position])
+        if self.ids[index].tobytes() != user_id.binary or not self.alive[index]:
+            return None
+        return index
+
+    def __len__(self):
+        return self.packed_count + len(self.entries)
+
+    def __contains__(self, user_id):
+        return user_id in self.entries or self._index(user_id) is not None
+
+    def get(self, user_id):
+        """Return the UserEntry of a user, or None."""
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            return entry
+        index = self._index(user_id)
+        if index is None:
+            return None
+        end = int(self.row_ends[index])
+        encodings = self.matrix[end - int(self.template_counts[index]):end].reshape(-1).view(np.uint8)
+        return UserEntry(self.user_names[index], encodings, _from_micros(self.updated_at[index]),
+                         int(self.versions[index]))
+
+    def put(self, user_id, entry):
+        """Store (or replace) the UserEntry of a user."""
+        index = self._index(user_id)
+        if index is not None:
+            self.alive[index] = False
+            self.packed_count -= 1
+        self.entries[user_id] = entry
+
+    def pop(self, user_id):
+        """Forget a user; returns True if it was there."""
+        if self.entries.pop(user_id, None) is not None:
+            return True
+        index = self._index(user_id)
+        if index is None:
+            return False
+        self.alive[index] = False
+        self.packed_count -= 1
+        return True
+
+    def fingerprint(self):
+        """Compute the partition_fingerprints() tuple of the users."""
+        count, max_updated_at, hash_sum = local_fingerprint(self.entries)
+        if not self.packed_count:
+            return count, max_updated_at, hash_sum
+        if self.hashes is None:
+            self.hashes = user_hashes(self.ids, self.versions)
+        updated = self.updated_at[self.alive]
+        updated = updated[updated != MISSING_TIME]
+        if len(updated):
+            newest = _from_micros(updated.max())
+            max_updated_at = newest if max_updated_at is None else max(max_updated_at, newest)
+        return count + self.packed_count, max_updated_at, hash_sum + int(self.hashes[self.alive].sum())
+
+    def diff(self, server):
+        """Compare the users with the {_id: (updated_at, version)} of the server.
+
+        Returns (stale, removed): the ids to fetch because they are missing or
+        differ here, and the ids here that the server no longer has.
+        """
+        stale, packed = [], []
+        for user_id, stamp in server.items():
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                if (entry.updated_at, entry.version) != stamp:
+                    stale.append(user_id)
+            elif self.packed_count and isinstance(user_id, ObjectId):
+                packed.append(user_id)
+            else:
+                stale.append(user_id)
+        removed = [user_id for user_id in self.entries if user_id not in server]
+        found = np.zeros(len(self.ids), dtype=bool)
+        if packed:
+            self._sort()
+            keys = np.frombuffer(b''.join(user_id.binary for user_id in packed), dtype='S12')
+            positions = np.maximum(np.searchsorted(self.keys, keys, side='right') - 1, 0)
+            indices = self.order[positions]
+            known = (self.keys[positions] == keys) & self.alive[indices]
+            versions = np.array([server[user_id][1] for user_id in packed], dtype=np.int64)
+            updated_at = np.array([_to_micros(server[user_id][0]) for user_id in packed], dtype=np.int64)
+            current = known & (self.versions[indices] == versions) & (self.updated_at[indices] == updated_at)
+            found[indices[known]] = True
+            stale.extend(user_id for user_id, fresh in zip(packed, current.tolist()) if not fresh)
+        removed.extend(ObjectId(self.ids[index].tobytes()) for index in np.flatnonzero(self.alive & ~found).tolist())
+        return stale, removed
+
+    def rows(self):
+        """Return the (encoding matrix, row names NameTable) of the users, packed users first."""
+        if not self.entries and self.packed_count == len(self.ids):
+            return self.matrix, self.names
+        kept = np.repeat(self.alive, self.template_counts)
+        entries = list(self.entries.values())
+        names = []
+        for entry in entries:
+            names.extend([entry.name] * (len(entry.encodings) // ENCODING_BYTES))
+        matrix = np.concatenate([self.matrix[kept], gallery_matrix([entry.encodings for entry in entries])])
+        return matrix, NameTable.concatenate([self.names.take(np.flatnonzero(kept)), NameTable.from_names(names)])
+
+    def metadata(self):
+        """Return the arrays save_snapshot stores next to the rows() of the users."""
+        entries = list(self.entries.values())
+        user_names = NameTable.concatenate([self.user_names.take(np.flatnonzero(self.alive)),
+                                            NameTable.from_names([entry.name for entry in entries])])
+        count, max_updated_at, hash_sum = self.fingerprint()
+        entry_ids = np.frombuffer(b''.join(user_id.binary for user_id in self.entries), dtype=np.uint8)
+        return {
+            'ids': np.concatenate([self.ids[self.alive], entry_ids.reshape(-1, 12)]),
+            'user_names': user_names.blob,
+            'user_name_offsets': user_names.offsets,
+            'updated_at': np.concatenate([self.updated_at[self.alive],
+                                          np.array([_to_micros(entry.updated_at) for entry in entries], dtype=np.int64)]),
+            'versions': np.concatenate([self.versions[self.alive],
+                                        np.array([entry.version for entry in entries], dtype=np.int64)]),
+            'rows': np.concatenate([self.template_counts[self.alive],
+                                    np.array([len(entry.encodings) // ENCODING_BYTES for entry in entries],
+                                             dtype=np.int64)]),
+            'fingerprint': np.array([count, _to_micros(max_updated_at), hash_sum], dtype=np.int64),
+        }
+
+
+class _MatrixFiller:
+    """Preallocated encoding matrix of one partition, filled as cursor batches arrive."""
+
+    def __init__(self, rows):
+        self.matrix = np.empty((rows, ENCODING_DIM), dtype=np.float32)
+        self.flat = self.matrix.reshape(-1).view(np.uint8)
+        self.filled = 0
+        self.names = []
+        self.valid = True
+
+    def add(self, entry):
+        """Move the templates of entry into the matrix; returns the entry pointing at them."""
+        rows = len(entry.encodings) // ENCODING_BYTES
+        if not self.valid or self.filled + rows > len(self.matrix):
+            # More rows than counted, e.g. users added during the load: build the matrix later.
+            self.valid = False
+            return entry
+        start, end = self.filled * ENCODING_BYTES, (self.filled + rows) * ENCODING_BYTES
+        self.flat[start:end] = np.frombuffer(entry.encodings, dtype=np.uint8)
+        self.filled += rows
+        self.names.extend([entry.name] * rows)
+        return entry._replace(encodings=self.flat[start:end])
+
+
+class GallerySync:
+    """Keep an in-memory copy of the users collection current with incremental reads.
+
+    The first poll loads every user. Later polls only apply the inserts, updates
+    and deletes made since the previous poll, read from a change stream when
+    the server supports one (replica sets) and otherwise by polling:
+
+    - every poll first reads the per-partition fingerprints (one small
+      aggregation); when they equal those of the previous poll nothing else
+      is fetched or decoded;
+    - otherwise inserts and updates are found with the indexed updated_at
+      watermark, re-reading a short overlap window so writes that commit late
+      or come from a writer with a slightly different clock are not missed;
+    - deletes, and documents written without updated_at, are found by
+      comparing each partition's fingerprint with that of the users in memory
+      and, only when they differ, diffing the ids and versions of that
+      partition.
+
+    decode_user(user) turns a user document into its packed encoding bytes.
+    Users are kept per partition so callers only rebuild the matchers of the
+    partitions a poll reports as changed; scope restricts the sync to some
+    partitions.
+
+    save_snapshot() writes the users to disk and restore_snapshot() resumes
+    from them, so a restart only fetches what changed in the meantime.
+
+    Reads only fetch USER_PROJECTION, batch_size documents at a time. The
+    full load writes the templates straight into one preallocated matrix per
+    partition, so its peak memory is the gallery plus one cursor batch.
+
+    With chunks (a GalleryChunks) the full load reads the packed gallery
+    chunks instead of one document per user, then catches up with the users
+    collection like after restore_snapshot, fetching only the users the
+    chunks are missing or hold in an older version.
+    """
+
+    def __init__(self, collection, decode_user, overlap=timedelta(seconds=5), use_change_stream=True,
+                 scope=None, batch_size=2000, chunks=None):
+        self.collection = collection
+        self.decode_user = decode_user
+        self.overlap = overlap
+        self.use_change_stream = use_change_stream
+        self.scope = None if scope is None else set(scope)
+        self.batch_size = batch_size
+        self.chunks = chunks
+        self.query = {} if scope is None else {'$or': [partition_filter(p) for p in sorted(self.scope)]}
+        # partition -> PartitionUsers
+        self.partitions = {}
+        # partition_fingerprints() as of the last poll, None if unavailable.
+        self.fingerprints = None
+        # Cleared once the server turns out not to support the fingerprint aggregation.
+        self.server_fingerprints = True
+        # partition -> (matrix, names) filled by the full load, until the partition changes.
+        self.matrices = {}
+        self.watermark = None
+        self.stream = None
+        # Set when resuming from a snapshot: open the stream on the next poll.
+        self.pending_stream = False
+        self.loaded = False
+        # Progress of the full load: users read so far and gallery rows expected (None if unknown).
+        self.users_read = 0
+        self.rows_expected = None
+        try:
+            self.collection.create_index('updated_at')
+        except PyMongoError as e:
+            logging.warning(f"Could not create the updated_at index: {e}")
+
+    def poll(self):
+        """Apply all changes since the last poll; returns the set of partitions that changed."""
+        if not self.loaded:
+            return self._full_load()
+        if self.stream is not None:
+            try:
+                return self._drain_stream()
+            except PyMongoError as e:
+                logging.warning(f"Change stream failed ({e}); falling back to polling.")
+                self.stream = None
+        return self._poll_watermark()
+
+    def progress(self):
+        """Return how far the running (or last) full load got."""
+        return {'users_read': self.users_read, 'rows_expected': self.rows_expected, 'loaded': self.loaded}
+
+    def matcher(self, partition, **matcher_options):
+        """Build a GalleryMatcher from the in-memory users of one partition."""
+        return GalleryMatcher(*self._rows(partition), **matcher_options)
+
+    def save_snapshot(self, directory, partitions=None):
+        """Save the users of some partitions (all by default) for restore_snapshot.
+
+        Each partition is published like a shared gallery in its own
+        subdirectory, with the ids, versions and fingerprint of its users.
+        """
+        for partition in sorted(self.partitions if partitions is None else partitions):
+            self._publish(partition, os.path.join(directory, partition))
+
+    def _publish(self, partition, directory):
+        """Publish one partition with the metadata restore_snapshot needs; returns False if it cannot be saved."""
+        users = self.partitions.get(partition) or PartitionUsers()
+        try:
+            metadata = users.metadata()
+        except AttributeError:
+            logging.warning(f"Not saving a snapshot of partition {partition}: its user ids are not ObjectIds.")
+            return False
+        matrix, names = self._rows(partition)
+        publish_shared_gallery(directory, matrix, names, metadata)
+        return True
+
+    def map_partition(self, partition, directory, previous=None, **matcher_options):
+        """Save one partition like save_snapshot, then serve it from the mapped files.
+
+        The users of the partition are kept packed over the mapped matrix, as
+        after restore_snapshot, so its full-precision rows live in the page
+        cache instead of the process heap. Returns the matcher of the mapped
+        gallery (previous is the matcher it replaces), or None if the
+        partition has no users or cannot be saved.
+        """
+        if partition not in self.partitions or not self._publish(partition, directory):
+            return None
+        gallery = SharedGallery(directory, **matcher_options)
+        if previous is not None:
+            gallery.matcher = previous
+        gallery.refresh()
+        metadata = read_shared_metadata(directory, gallery.generation)
+        self.partitions[partition] = PartitionUsers(metadata, gallery.matcher.matrix, gallery.matcher.names,
+                                                    NameTable(metadata['user_names'], metadata['user_name_offsets']))
+        self.matrices.pop(partition, None)
+        return gallery.matcher
+
+    def restore_snapshot(self, shared):
+        """Resume from the galleries returned by map_snapshot instead of loading every user.
+
+        The encodings and names stay in the mapped files and the users stay
+        packed arrays (see PartitionUsers). The next poll compares the saved
+        fingerprints with the server and only fetches the users that changed
+        after the snapshot was saved. Returns True if anything was restored.
+        """
+        partitions, fingerprints = {}, {}
+        for partition, gallery in shared.items():
+            if self.scope is not None and partition not in self.scope:
+                continue
+            metadata = read_shared_metadata(gallery.directory, gallery.generation)
+            if metadata is None:
+                continue
+            users = PartitionUsers(metadata, gallery.matcher.matrix, gallery.matcher.names,
+                                   NameTable(metadata['user_names'], metadata['user_name_offsets']))
+            if users:
+                partitions[partition] = users
+                count, max_updated_at, hash_sum = metadata['fingerprint']
+                fingerprints[partition] = (int(count), _from_micros(max_updated_at), int(hash_sum))
+        if not partitions:
+            return False
+
+        self.partitions = partitions
+        self.matrices = {}
+        self.fingerprints = fingerprints
+        updated = [fingerprint[1] for fingerprint in fingerprints.values() if fingerprint[1] is not None]
+        self.watermark = max(updated) if updated else None
+        self.pending_stream = self.use_change_stream
+        self.loaded = True
+        logging.info(f"Restored {self._user_count()} users in {len(partitions)} partitions from a snapshot.")
+        return True
+
+    def _rows(self, partition):
+        """Return the (encoding matrix, row names) of the in-memory users of one partition."""
+        if partition in self.matrices:
+            return self.matrices[partition]
+        return (self.partitions.get(partition) or PartitionUsers()).rows()
+
+    def _user_count(self):
+        return sum(len(users) for users in self.partitions.values())
+
+    def _locate(self, user_id):
+        """Return the partition holding a user, or None."""
+        for partition, users in self.partitions.items():
+            if user_id in users:
+                return partition
+        return None
+
+    def _open_stream(self):
+        if not self.use_change_stream:
+            return None
+        try:
+            # Embedded documents do not keep their _id unless it is projected.
+            fields = {f'fullDocument.{field}': 1 for field in ['_id', *USER_PROJECTION]}
+            return self.collection.watch([{'$project': {'operationType': 1, 'documentKey': 1, **fields}}],
+                                         full_document='updateLookup', batch_size=self.batch_size)
+        except Exception as e:
+            # Standalone servers and in-memory stand-ins have no change streams.
+            logging.info(f"Change streams unavailable ({e}); polling for gallery changes.")
+            return None
+
+    def _read_fingerprints(self):
+        if not self.server_fingerprints:
+            return None
+        try:
+            return partition_fingerprints(self.collection, self.query)
+        except (OperationFailure, NotImplementedError) as e:
+            # Servers older than 4.0 lack $toString and stand-ins such as mongomock lack
+            # $reduce: every poll then reads the delta and diffs the ids and versions.
+            logging.warning(f"Gallery fingerprints unsupported ({e}); diffing partitions on every poll.")
+            self.server_fingerprints = False
+            return None
+        except PyMongoError as e:
+            logging.warning(f"Could not read gallery fingerprints ({e}).")
+            return None
+
+    def _read_row_counts(self):
+        try:
+            return partition_row_counts(self.collection, self.query)
+        except PyMongoError as e:
+            # Servers older than 4.4 lack $binarySize; the matrices are then built after the load.
+            logging.warning(f"Could not count gallery rows ({e}).")
+            return {}
+
+    def _find(self, query):
+        return self.collection.find(query, USER_PROJECTION, batch_size=self.batch_size)
+
+    def _load_chunks(self):
+        """Start from the packed gallery chunks; returns the changed partitions, or None without chunks."""
+        packed = self.chunks.load(self.scope)
+        if not packed:
+            logging.info("No gallery chunks yet; loading users one by one (build them with gallery_chunks.py).")
+            return None
+        previous = set(self.partitions)
+        self.partitions, self.matrices, fingerprints = {}, {}, {}
+        for partition, arrays in packed.items():
+            if not is_valid_partition(partition):
+                continue
+            names = NameTable(arrays['names'], arrays['name_offsets'])
+            # One name per user: that of its first row.
+            user_names = names.take(np.cumsum(arrays['rows']) - arrays['rows'])
+            users = PartitionUsers(arrays, arrays['matrix'], names, user_names, unique=False)
+            if len(users) < len(arrays['ids']):
+                logging.info(f"Users of partition {partition} are in two gallery chunks (a rebuild is running); "
+                             f"using their last copy.")
+            self.partitions[partition] = users
+            fingerprints[partition] = users.fingerprint()
+        self.fingerprints = fingerprints
+        updated = [fingerprint[1] for fingerprint in fingerprints.values() if fingerprint[1] is not None]
+        self.watermark = max(updated) if updated else None
+        self.pending_stream = self.use_change_stream
+        self.loaded = True
+        self.users_read = self._user_count()
+        logging.info(f"Loaded {self.users_read} users in {len(self.partitions)} partitions from gallery chunks.")
+        # Users written without updating the chunks (or not in them at all) are fetched here.
+        return previous | set(self.partitions) | self._poll_watermark()
+
+    def _full_load(self):
+        if self.chunks is not None:
+            changed = self._load_chunks()
+            if changed is not None:
+                return changed
+        # Open the stream before reading so no change between the two is lost.
+        self.stream = self._open_stream()
+        self.fingerprints = None if self.stream is not None else self._read_fingerprints()
+        row_counts = self._read_row_counts()
+        fillers = {partition: _MatrixFiller(rows) for partition, rows in row_counts.items()}
+        self.rows_expected = sum(row_counts.values()) if row_counts else None
+        self.users_read = 0
+        previous = set(self.partitions)
+        self.partitions = {}
+        self.matrices = {}
+        self.watermark = None
+        for user in self._find(self.query):
+            self.users_read += 1
+            located = self._locate(user['_id'])
+            if located in fillers:
+                # Returned twice by the cursor after an update: its old rows are already in a matrix.
+                fillers[located].valid = False
+            self._upsert(user)
+            partition = self._locate(user['_id'])
+            if partition in fillers:
+                users = self.partitions[partition]
+                users.put(user['_id'], fillers[partition].add(users.get(user['_id'])))
+        self.matrices = {
+            partition: (filler.matrix[:filler.filled], filler.names)
+            for partition, filler in fillers.items() if filler.valid and partition in self.partitions
+        }
+        self.loaded = True
+        logging.info(f"Loaded {self._user_count()} users in {len(self.partitions)} partitions.")
+        return previous | set(self.partitions)
+
+    def _drain_stream(self):
+        changed = set()
+        while True:
+            change = self.stream.try_next()
+            if change is None:
+                return changed
+            operation = change['operationType']
+            if operation in ('insert', 'update', 'replace') and change.get('fullDocument') is not None:
+                changed |= self._upsert(change['fullDocument'])
+            elif operation in ('insert', 'update', 'replace', 'delete'):
+                # A missing fullDocument means the user was deleted before the lookup.
+                changed |= self._remove(change['documentKey']['_id'])
+            else:
+                # drop, rename or invalidate: the stream is over, start again from scratch.
+                logging.warning(f"Change stream reported '{operation}'; reloading the gallery.")
+                self.stream.close()
+                self.loaded = False
+                return changed | self._full_load()
+
+    def _poll_watermark(self):
+        if self.pending_stream:
+            # Resumed from a snapshot: open the stream before catching up so no change is lost.
+            self.pending_stream = False
+            self.stream = self._open_stream()
+        # Read before the delta: a write racing with this poll changes the
+        # fingerprint again and is picked up by the next one.
+        fingerprints = self._read_fingerprints()
+        if fingerprints is not None and fingerprints == self.fingerprints:
+            return set()
+
+        changed = set()
+        query = dict(self.query)
+        if self.watermark is not None:
+            query['updated_at'] = {'$gte': self.watermark - self.overlap}
+        for user in self._find(query):
+            changed |= self._upsert(user)
+
+        partitions = set(self.partitions) | set(fingerprints or {})
+        for partition in sorted(partitions):
+            if not is_valid_partition(partition):
+                continue
+            local = self.partitions.get(partition) or PartitionUsers()
+            if fingerprints is not None and fingerprints.get(partition) == local.fingerprint():
+                continue
+            changed |= self._reconcile(partition)
+        self.fingerprints = fingerprints
+        return changed
+
+    def _reconcile(self, partition):
+        """Diff one partition by id and version and fetch only the users that differ."""
+        changed = set()
+        local = self.partitions.get(partition) or PartitionUsers()
+        server = {
+            user['_id']: (user.get('updated_at'), user.get('version', 0))
+            for user in self.collection.find(partition_filter(partition), {'updated_at': 1, 'version': 1})
+        }
+        stale, removed = local.diff(server)
+        for user_id in removed:
+            changed |= self._remove(user_id)
+        if stale:
+            for user in self._find({'_id': {'$in': stale}}):
+                changed |= self._upsert(user)
+        return changed
+
+    def _upsert(self, user):
+        """Store one user document; returns the partitions it changed."""
+        partition = user.get('partition') or DEFAULT_PARTITION
+        if not is_valid_partition(partition):
+            logging.error(f"Skipping user {user.get('name')} with invalid partition {partition!r}.")
+            return set()
+        if self.scope is not None and partition not in self.scope:
+            # Not (or no longer) in one of the partitions this sync keeps.
+            return self._remove(user['_id'])
+        updated_at = user.get('updated_at')
+        version = user.get('version', 0)
+        if updated_at is not None and (self.watermark is None or updated_at > self.watermark):
+            self.watermark = updated_at
+
+        previous = self._locate(user['_id'])
+        if previous == partition and updated_at is not None:
+            entry = self.partitions[partition].get(user['_id'])
+            if (entry.updated_at, entry.version) == (updated_at, version):
+                # Already applied, e.g. re-read from the overlap window.
+                return set()
+        changed = {partition}
+        self.matrices.pop(partition, None)
+        if previous is not None and previous != partition:
+            changed |= self._remove(user['_id'])
+
+        # Users that cannot be decoded are kept without templates so fingerprints stay comparable.
+        encodings = self.decode_user(user)
+        users = self.partitions.get(partition)
+        if users is None:
+            users = self.partitions[partition] = PartitionUsers()
+        users.put(user['_id'], UserEntry(user['name'], encodings, updated_at, version))
+        return changed
+
+    def _remove(self, user_id):
+        """Forget one user; returns the partitions it changed."""
+        partition = self._locate(user_id)
+        if partition is None:
+            return set()
+        self.matrices.pop(partition, None)
+        users = self.partitions[partition]
+        users.pop(user_id)
+        if not users:
+            del self.partitions[partition]
+        return {partition}
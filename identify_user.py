@@ -1,6 +1,8 @@
 import cv2
 import face_recognition
 from face_detector import FaceRecognitionSystem
+from gallery import DEFAULT_PARTITION
+import sys
 import time
 import numpy as np
 from scipy.spatial import distance as dist
@@ -16,15 +18,20 @@ def calculate_ear(eye_landmarks):
     ear = (A + B) / (2.0 * C)
     return ear
 
-def identify_user():
+def identify_user(partition=DEFAULT_PARTITION):
     """
-    This function identifies the user by comparing the captured face with the stored face encodings.
+    This function identifies the user by comparing the captured face with the stored face encodings
+    of one partition (tenant/site/group).
     Added enhanced error handling, diagnostic information, and improved blink detection.
     """
     face_system = None
     try:
         print("Initializing face recognition system...")
-        face_system = FaceRecognitionSystem()
+        face_system = FaceRecognitionSystem(partition)
+        while not face_system.wait_until_ready(timeout=1):
+            readiness = face_system.gallery_service.readiness()
+            print(f"Waiting for the camera and the known faces ({readiness['state']}, "
+                  f"{readiness['faces']} faces so far)...")
         
         print("\nStarting face identification...")
         print("Press 'q' to exit or blink twice to release camera")
@@ -61,12 +68,12 @@ def identify_user():
             # Convert the frame to RGB
             rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
             
-            # Detect faces in the frame
-            face_locations = face_recognition.face_locations(rgb_frame)
+            # Detect faces in the frame; the Haar pre-filter skips HOG on empty frames
+            face_locations = face_system.detector.locate(rgb_frame)
             
             # Process detected faces
             if face_locations:
-                face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+                face_encodings = face_system.camera_encoder.encode(rgb_frame, face_locations)
                 face_landmarks = face_recognition.face_landmarks(rgb_frame, face_locations)
                 
                 for face_encoding, landmarks, face_location in zip(face_encodings, face_landmarks, face_locations):
@@ -103,16 +110,9 @@ def identify_user():
                         print("\nDouble blink confirmed - releasing camera")
                         return
                     
-                    matches = face_recognition.compare_faces(
-                        face_system.known_face_encodings,
-                        face_encoding,
-                        tolerance=0.6
-                    )
+                    name, distance = face_system.gallery.best_match(face_encoding, tolerance=0.6)
                     
-                    if True in matches:
-                        match_index = matches.index(True)
-                        name = face_system.known_face_names[match_index]
-                        
+                    if name is not None:
                         # Draw rectangle and name
                         top, right, bottom, left = face_location
                         cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
@@ -130,7 +130,7 @@ def identify_user():
                             cv2.putText(frame, "BLINK!", (left, top - 30),
                                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
                         
-                        print(f"Identified: {name}")
+                        print(f"Identified: {name} (distance {distance:.3f})")
                     else:
                         print("Unknown face detected")
             
@@ -154,4 +154,4 @@ def identify_user():
         print("\nFace recognition system shutdown complete")
 
 if __name__ == "__main__":
-    identify_user()
\ No newline at end of file
+    identify_user(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PARTITION)
\ No newline at end of file
@@ -0,0 +1,175 @@
+import base64
+import logging
+import re
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+from pymongo import UpdateOne
+
+from encoding_format import LEGACY_FIELDS, encoding_fields
+from face_detection import SELECTED_BACKENDS, build_detector, remember_selections
+from face_encoding import build_encoder
+from config import DETECTION_CONFIG, ENCODING_CONFIG
+
+# Face detector and encoder of this process, built on first use.
+_detector = None
+_encoder = None
+
+
+def conversion_detector():
+    """Return the configured FaceDetector, shared by the conversions of this process."""
+    global _detector
+    if _detector is None:
+        _detector = build_detector(DETECTION_CONFIG)
+    return _detector
+
+
+def conversion_encoder():
+    """Return the FaceEncoder of converted records: they become stored templates, like registrations."""
+    global _encoder
+    if _encoder is None:
+        _encoder = build_encoder(ENCODING_CONFIG, 'registration')
+    return _encoder
+
+
+def encode_image_data(stored_data, name):
+    """Compute the face encoding of an image stored by the JS client, or return None.
+
+    stored_data is a base64 string (optionally a data URI) or the raw image bytes.
+    """
+    try:
+        # Determine if stored_data is a string (base64) or already binary
+        if isinstance(stored_data, str):
+            # Remove potential data URI header if present
+            base64_str = re.sub(r"^data:image\/\w+;base64,", "", stored_data)
+            image_data = base64.b64decode(base64_str)
+        else:
+            image_data = stored_data
+
+        # Convert binary data to a NumPy array and decode the image using OpenCV
+        np_arr = np.frombuffer(image_data, np.uint8)
+        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+        if img is None:
+            logging.error(f"Failed to decode image for user {name}.")
+            return None
+
+        # Convert to RGB for face_recognition
+        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        # Detect face locations with the same backend as the API
+        face_locations = conversion_detector().locate(rgb_img)
+        if not face_locations:
+            logging.warning(f"No face detected in the image for user {name}.")
+            return None
+
+        # Compute face encoding
+        face_encodings = conversion_encoder().encode(rgb_img, face_locations)
+        if not face_encodings:
+            logging.warning(f"Face encoding failed for user {name}.")
+            return None
+        return face_encodings[0]
+    except Exception as js_error:
+        logging.error(f"Error processing JS face data for user {name}: {js_error}")
+        return None
+
+
+def conversion_update(user_id, face_encoding):
+    """Return the UpdateOne storing a converted encoding in the typed format."""
+    return UpdateOne({'_id': user_id}, {
+        '$set': {**encoding_fields([face_encoding]), 'updated_at': datetime.now(timezone.utc)},
+        '$unset': {field: '' for field in LEGACY_FIELDS},
+        '$inc': {'version': 1}
+    })
+
+
+def _shutdown_executor(executor):
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LegacyConverter:
+    """Convert records holding a JS/base64 image into typed encodings, in worker processes.
+
+    Loaders submit() such users and carry on without them; at most max_pending
+    conversions run at a time and the rest wait in a backlog holding only
+    their ids. flush() writes the finished encodings back with one bulk_write,
+    which bumps updated_at and version, so the gallery sync picks each
+    converted user up on its next poll without waiting for the slow ones.
+    Safe to share between request threads and a background loader.
+    Converted users are also written to chunks (a GalleryChunks), if given.
+    """
+
+    def __init__(self, collection, workers=2, max_pending=8, chunks=None):
+        self.collection = collection
+        self.chunks = chunks
+        self.workers = workers
+        self.max_pending = max(1, max_pending)
+        # _id -> (name, future) of the conversions running in the pool.
+        self.pending = {}
+        self.backlog = deque()
+        self.queued = set()
+        self.executor = None
+        self._finalizer = None
+        self.lock = threading.Lock()
+
+    def submit(self, user):
+        """Queue the conversion of one legacy user document; repeated submissions are ignored."""
+        with self.lock:
+            if user['_id'] in self.queued:
+                return
+            self.queued.add(user['_id'])
+            self.backlog.append((user['_id'], user['name']))
+            self._fill()
+
+    def busy(self):
+        """Return True while conversions are running or waiting."""
+        return bool(self.pending or self.backlog)
+
+    def flush(self):
+        """Write the finished conversions back with one bulk_write; returns how many users were converted."""
+        updates, converted = [], []
+        with self.lock:
+            for user_id in [user_id for user_id, (_, future) in self.pending.items() if future.done()]:
+                name, future = self.pending.pop(user_id)
+                self.queued.discard(user_id)
+                try:
+                    face_encoding = future.result()
+                except Exception as e:
+                    logging.error(f"Conversion worker failed for user {name}: {e}")
+                    continue
+                if face_encoding is not None:
+                    updates.append(conversion_update(user_id, face_encoding))
+                    converted.append(user_id)
+            self._fill()
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
+            logging.info(f"Converted {len(updates)} legacy users to typed encodings.")
+            if self.chunks is not None:
+                self.chunks.write_users(self.collection, converted)
+        return len(updates)
+
+    def close(self):
+        """Stop the worker processes; queued conversions are dropped."""
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def _fill(self):
+        while self.backlog and len(self.pending) < self.max_pending:
+            user_id, name = self.backlog.popleft()
+            # Only the running conversions hold image data; the backlog keeps ids.
+            user = self.collection.find_one({'_id': user_id}, {'face_encoding': 1})
+            if user is None or 'face_encoding' not in user:
+                self.queued.discard(user_id)
+                continue
+            if self.executor is None:
+                # Started on first use, so galleries without legacy records never fork workers.
+                # Workers reuse the detector backend this process selected instead of benchmarking again.
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=remember_selections,
+                                                    initargs=(dict(SELECTED_BACKENDS),))
+                self._finalizer = weakref.finalize(self, _shutdown_executor, self.executor)
+            future = self.executor.submit(encode_image_data, user['face_encoding'], name)
+            self.pending[user_id] = (name, future)
@@ -0,0 +1,78 @@
+import argparse
+import logging
+from datetime import datetime, timezone
+
+from pymongo import MongoClient, UpdateOne
+
+from encoding_format import ENCODING_FORMAT, LEGACY_FIELDS, encoding_fields, stored_encodings, unpack_encodings
+from legacy_conversion import encode_image_data
+from config import MONGODB_CONFIG
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def migration_update(user, keep_legacy=False):
+    """Return the UpdateOne rewriting one legacy user in the typed format, or None if it cannot be read."""
+    try:
+        data = stored_encodings(user)
+    except Exception as e:
+        logging.error(f"Failed to read face templates of user {user['name']}: {e}")
+        return None
+    if data is None:
+        # Stored by the JS client as an image: compute the encoding once here.
+        face_encoding = encode_image_data(user.get('face_encoding'), user['name'])
+        if face_encoding is None:
+            return None
+        fields = encoding_fields([face_encoding])
+    else:
+        fields = encoding_fields(unpack_encodings(data))
+
+    update = {'$set': {**fields, 'updated_at': datetime.now(timezone.utc)}, '$inc': {'version': 1}}
+    if not keep_legacy:
+        update['$unset'] = {field: '' for field in LEGACY_FIELDS}
+    return UpdateOne({'_id': user['_id']}, update)
+
+
+def migrate(users_collection, batch_size=500, keep_legacy=False, dry_run=False):
+    """Rewrite every pickled or JS/base64 record in the typed format; returns (migrated, failed)."""
+    query = {'encoding_format': {'$exists': False}}
+    projection = {'name': 1, 'face_encoding': 1, 'face_encodings': 1}
+    migrated, failed = 0, 0
+    batch = []
+    for user in users_collection.find(query, projection, batch_size=batch_size):
+        update = migration_update(user, keep_legacy)
+        if update is None:
+            failed += 1
+            continue
+        batch.append(update)
+        if len(batch) == batch_size:
+            migrated += _write(users_collection, batch, dry_run)
+            batch = []
+    if batch:
+        migrated += _write(users_collection, batch, dry_run)
+    return migrated, failed
+
+
+def _write(users_collection, batch, dry_run):
+    if not dry_run:
+        users_collection.bulk_write(batch, ordered=False)
+    logging.info(f"{'Would migrate' if dry_run else 'Migrated'} {len(batch)} users.")
+    return len(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Rewrite stored face encodings in the {ENCODING_FORMAT} format.")
+    parser.add_argument("--batch-size", type=int, default=500, help="users per bulk write")
+    parser.add_argument("--keep-legacy", action="store_true",
+                        help="keep the pickled fields for readers that do not know the typed format yet")
+    parser.add_argument("--dry-run", action="store_true", help="convert without writing to the database")
+    args = parser.parse_args()
+
+    client = MongoClient(MONGODB_CONFIG['host'])
+    users_collection = client[MONGODB_CONFIG['database']][MONGODB_CONFIG['collection']]
+    migrated, failed = migrate(users_collection, args.batch_size, args.keep_legacy, args.dry_run)
+    logging.info(f"Done: {migrated} users migrated, {failed} could not be converted.")
+
+
+if __name__ == "__main__":
+    main()
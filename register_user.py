@@ -1,21 +1,19 @@
 from face_detector import FaceRecognitionSystem
+from gallery import DEFAULT_PARTITION
 import sys
 import logging
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def register_new_user():
-    """Main function to handle user registration."""
-    logging.info("Starting user registration process")
+def register_new_user(partition=DEFAULT_PARTITION):
+    """Main function to handle user registration into a partition (tenant/site/group)."""
+    logging.info(f"Starting user registration process for partition {partition}")
     face_system = None
     
     try:
-        face_system = FaceRecognitionSystem()
+        # The camera warms up while the name is typed; register_new_face waits for it.
+        face_system = FaceRecognitionSystem(partition)
 
-        if not face_system.video_capture.isOpened():
-            logging.error("Unable to access the camera.")
-            return
-            
         while True:
             name = input("\nEnter name (or 'q' to quit): ").strip()
 
@@ -35,6 +33,7 @@ def register_new_user():
                 continue
 
             logging.info("Capturing face. Follow guidelines for best results.")
+            logging.info("Several templates are captured; turn your head slightly between captures.")
 
             input("Press Enter to start...")
 
@@ -59,4 +58,4 @@ def register_new_user():
             face_system.cleanup()
 
 if __name__ == "__main__":
-    register_new_user()
+    register_new_user(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PARTITION)
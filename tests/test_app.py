@@ -0,0 +1,203 @@
+import base64
+import io
+
+import numpy as np
+import pytest
+
+for module in ('flask', 'flask_cors', 'cv2', 'torch', 'transformers', 'face_recognition'):
+    pytest.importorskip(module)
+
+import cv2
+
+import app
+from gallery_service import GalleryService, SQLiteStore
+
+
+class BrightnessDetector:
+    """One face covering the whole image."""
+
+    def locate(self, rgb, reduced=None):
+        return [(0, rgb.shape[1], rgb.shape[0], 0)]
+
+    def reduced_copy(self, shape, payload):
+        return None
+
+
+class BrightnessEncoder:
+    """Encodes a face as its mean brightness in every dimension."""
+
+    def encode(self, rgb, boxes):
+        return [np.full(128, rgb.mean() / 255.0) for _ in boxes]
+
+
+def png(value):
+    """A uniform PNG image that BrightnessEncoder encodes as np.full(128, value)."""
+    return cv2.imencode('.png', np.full((32, 32, 3), round(value * 255), dtype=np.uint8))[1].tobytes()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteStore(str(tmp_path / 'gallery.db'))
+    store.add_user('alice', [np.full(128, 0.2)])
+    store.add_user('bob', [np.full(128, 0.6)])
+    return store
+
+
+@pytest.fixture
+def client(store, monkeypatch):
+    service = GalleryService(store)
+    service.refresh()
+    monkeypatch.setattr(app, 'store', store)
+    monkeypatch.setattr(app, 'gallery_service', service)
+    monkeypatch.setattr(app, 'detector', BrightnessDetector())
+    monkeypatch.setattr(app, 'encoder', BrightnessEncoder())
+    monkeypatch.setattr(app, 'services_started', True)
+    return app.app.test_client()
+
+
+def test_json_image(client):
+    response = client.post('/face-recognizer', json={'image': base64.b64encode(png(0.2)).decode()})
+    assert response.status_code == 200 and response.json['name'] == 'alice'
+
+
+def test_unknown_face(client):
+    response = client.post('/face-recognizer', data=png(1.0), content_type='image/png')
+    assert response.status_code == 200 and response.json['name'] == 'Unknown' and response.json['distance'] > 0.6
+
+
+def test_no_face(client, monkeypatch):
+    monkeypatch.setattr(app.detector, 'locate', lambda rgb, reduced=None: [])
+    response = client.post('/face-recognizer', data=png(0.2), content_type='image/png')
+    assert response.status_code == 400 and response.json['error'] == 'No face detected'
+    response = client.post('/face-recognizer', json={})
+    assert response.status_code == 400 and response.json['error'] == 'No image provided'
+
+
+def test_raw_image(client):
+    response = client.post('/face-recognizer', data=png(0.6), content_type='image/png')
+    assert response.status_code == 200 and response.json['name'] == 'bob'
+
+
+def test_top_k(client):
+    response = client.post('/face-recognizer', json={'image': base64.b64encode(png(0.2)).decode(), 'top_k': 2})
+    assert response.status_code == 200
+    assert [c['name'] for c in response.json['candidates']] == ['alice', 'bob']
+    assert response.json['name'] == 'alice'
+    assert response.json['margin'] == pytest.approx(0.4 * np.sqrt(128), rel=1e-3)
+    # The margin is reported even when a single candidate is asked for.
+    response = client.post('/face-recognizer', data=png(1.0), content_type='image/png', query_string={'top_k': '1'})
+    assert response.json['name'] == 'Unknown' and len(response.json['candidates']) == 1
+    assert response.json['candidates'][0]['name'] == 'bob' and response.json['margin'] > 0
+
+
+@pytest.mark.parametrize('top_k', [0, -1, 10 ** 6, 'two', 1.5, True])
+def test_invalid_top_k(client, top_k):
+    response = client.post('/face-recognizer', json={'image': base64.b64encode(png(0.2)).decode(), 'top_k': top_k})
+    assert response.status_code == 400 and 'top_k' in response.json['error']
+
+
+def test_partitions(client, store):
+    store.add_user('dave', [np.full(128, 0.6)], partition='site-b')
+    app.gallery_service.refresh()
+    image = base64.b64encode(png(0.6)).decode()
+    # Only the gallery of the requested partition is searched.
+    response = client.post('/face-recognizer', json={'image': image, 'partition': 'site-b'})
+    assert response.status_code == 200 and response.json['name'] == 'dave'
+    response = client.post('/face-recognizer', json={'image': image})
+    assert response.json['name'] == 'bob'
+    response = client.post('/face-verify', json={'image': image, 'name': 'dave', 'partition': 'site-b'})
+    assert response.status_code == 200 and response.json['match']
+    response = client.post('/face-verify', json={'image': image, 'name': 'dave'})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('endpoint', ['/face-recognizer', '/face-verify'])
+def test_unknown_and_invalid_partitions(client, endpoint):
+    data = {'image': base64.b64encode(png(0.6)).decode(), 'name': 'bob'}
+    response = client.post(endpoint, json={**data, 'partition': 'site-z'})
+    assert response.status_code == 404
+    for partition in ['../default', '', 7]:
+        response = client.post(endpoint, json={**data, 'partition': partition})
+        assert response.status_code == 400 and response.json['error'] == 'Invalid partition'
+
+
+def test_multipart_image(client):
+    response = client.post('/face-recognizer', data={'image': (io.BytesIO(png(0.6)), 'bob.png'), 'top_k': '1'},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200 and response.json['candidates'][0]['name'] == 'bob'
+
+
+@pytest.mark.parametrize('image', [12345, None, ['a'], {'a': 1}, 'not base64!', ''])
+def test_invalid_json_image(client, image):
+    response = client.post('/face-recognizer', json={'image': image})
+    assert response.status_code == 400 and response.json['error'] == 'Invalid image data'
+
+
+def test_invalid_raw_image(client):
+    response = client.post('/face-recognizer', data=b'not an image', content_type='image/png')
+    assert response.status_code == 400
+
+
+def test_face_verify(client):
+    response = client.post('/face-verify', json={'image': base64.b64encode(png(0.2)).decode(), 'name': 'alice'})
+    assert response.status_code == 200 and response.json['match'] and response.json['distance'] < 0.01
+    response = client.post('/face-verify', data=png(0.2), content_type='image/png', query_string={'name': 'bob'})
+    assert response.status_code == 200 and not response.json['match']
+
+
+def test_face_verify_user_id(client):
+    response = client.post('/face-verify', data=png(0.6), content_type='image/png', query_string={'user_id': '2'})
+    assert response.status_code == 200 and response.json['name'] == 'bob' and response.json['match']
+    response = client.post('/face-verify', data=png(0.6), content_type='image/png', query_string={'user_id': '9'})
+    assert response.status_code == 404
+    response = client.post('/face-verify', json={'image': base64.b64encode(png(0.6)).decode(), 'user_id': ['2']})
+    assert response.status_code == 400
+
+
+def test_face_verify_enrolled_since_reload(client, store):
+    store.add_user('carol', [np.full(128, 0.4)])
+    response = client.post('/face-verify', data=png(0.4), content_type='image/png', query_string={'name': 'carol'})
+    assert response.status_code == 200 and response.json['match']
+    response = client.post('/face-verify', data=png(0.4), content_type='image/png', query_string={'name': 'dave'})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('name', [['alice'], 12, {'name': 'alice'}, True])
+def test_face_verify_invalid_name(client, name):
+    response = client.post('/face-verify', json={'image': base64.b64encode(png(0.2)).decode(), 'name': name})
+    assert response.status_code == 400
+
+
+def test_gallery_stats(client):
+    response = client.get('/gallery-stats')
+    assert response.status_code == 200
+    assert response.json['store'] == 'SQLiteStore' and response.json['partitions'] == {'default': 2}
+
+
+def test_not_ready(client, store, monkeypatch):
+    # A worker that has not loaded the gallery yet.
+    monkeypatch.setattr(app, 'gallery_service', GalleryService(SQLiteStore(store.path)))
+    monkeypatch.setitem(app.READINESS_CONFIG, 'max_wait', 0)
+    response = client.get('/ready')
+    assert response.status_code == 503 and response.json['state'] == 'stopped'
+    assert response.headers['Retry-After'] == str(app.READINESS_CONFIG['retry_after'])
+    response = client.post('/face-recognizer', data=png(0.2), content_type='image/png')
+    assert response.status_code == 503 and 'Retry-After' in response.headers
+    response = client.post('/face-verify', data=png(0.2), content_type='image/png', query_string={'name': 'alice'})
+    assert response.status_code == 503
+    # Served as soon as the first load is done.
+    app.gallery_service.refresh()
+    response = client.get('/ready')
+    assert response.status_code == 200 and response.json['ready'] and response.json['faces'] == 2
+    response = client.post('/face-recognizer', data=png(0.2), content_type='image/png')
+    assert response.status_code == 200 and response.json['name'] == 'alice'
+
+
+def test_services_start_on_first_request(client, monkeypatch):
+    started = []
+    monkeypatch.setattr(app, 'services_started', False)
+    monkeypatch.setattr(app, 'init_services', lambda: started.append('init'))
+    monkeypatch.setattr(app, 'start_gallery_updater', lambda: started.append('updater'))
+    assert client.get('/gallery-stats').status_code == 200
+    assert client.get('/gallery-stats').status_code == 200
+    assert started == ['init', 'updater']
@@ -0,0 +1,61 @@
+import pickle
+
+import numpy as np
+import pytest
+
+pytest.importorskip('bson')
+
+from encoding_format import (ENCODING_BYTES, ENCODING_FORMAT, encoding_fields, gallery_matrix, pack_encodings,
+                             stored_encodings, unpack_encodings)
+
+
+def templates(count, seed=0):
+    return np.random.default_rng(seed).random((count, 128))
+
+
+def test_roundtrip():
+    encodings = templates(3)
+    data = pack_encodings(encodings)
+    assert len(data) == 3 * ENCODING_BYTES
+    assert np.array_equal(unpack_encodings(data), encodings.astype(np.float32))
+    # Little-endian whatever the platform.
+    assert np.frombuffer(data[:4], dtype='<f4')[0] == np.float32(encodings[0, 0])
+    assert not unpack_encodings(data).flags.writeable
+    assert np.array_equal(gallery_matrix([pack_encodings(encodings[:1]), data[ENCODING_BYTES:]]), unpack_encodings(data))
+    assert gallery_matrix([]).shape == (0, 128)
+
+
+def test_stored_encodings():
+    encodings = templates(2)
+    typed = {'name': 'alice', **encoding_fields(encodings)}
+    assert typed['encoding_format'] == ENCODING_FORMAT
+    assert stored_encodings(typed) == pack_encodings(encodings)
+    # Records written before the typed format are still read.
+    legacy = {'name': 'bob', 'face_encoding': pickle.dumps(encodings[0])}
+    assert stored_encodings(legacy) == pack_encodings(encodings[:1])
+    several = {'name': 'carol', 'face_encodings': [pickle.dumps(e) for e in encodings]}
+    assert stored_encodings(several) == pack_encodings(encodings)
+    # A JS/base64 image is not an encoding.
+    assert stored_encodings({'name': 'dave', 'face_encoding': 'data:image/jpeg;base64,AAAA'}) is None
+
+
+@pytest.mark.parametrize('user', [
+    {'encodings': b'', 'encoding_format': 'float64-be/1'},
+    {'encodings': b'\0' * (ENCODING_BYTES - 4), 'encoding_format': ENCODING_FORMAT},
+])
+def test_unreadable_encodings(user):
+    with pytest.raises(ValueError):
+        stored_encodings(user)
+
+
+def test_migration_update():
+    pytest.importorskip('face_recognition')
+    from migrate_encodings import migration_update
+
+    encodings = templates(2)
+    update = migration_update({'_id': 1, 'name': 'carol', 'face_encodings': [pickle.dumps(e) for e in encodings]})
+    fields = update._doc
+    assert bytes(fields['$set']['encodings']) == pack_encodings(encodings)
+    assert fields['$inc'] == {'version': 1} and set(fields['$unset']) == {'face_encoding', 'face_encodings'}
+    assert '$unset' not in migration_update({'_id': 2, 'name': 'bob', 'face_encoding': pickle.dumps(encodings[0])},
+                                            keep_legacy=True)._doc
@@ -0,0 +1,154 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('face_recognition')
+
+import face_detection
+from config import DETECTION_CONFIG
+from face_detection import FaceDetector, HaarBackend, HogBackend, build_detector, configured_detector, resolve_path
+
+
+class CenterBackend:
+    """Finds one face in the middle half of any image and records the shapes it searched."""
+
+    screened = True
+
+    def __init__(self):
+        self.shapes = []
+
+    def detect(self, rgb_image):
+        self.shapes.append(rgb_image.shape)
+        height, width = rgb_image.shape[:2]
+        return [(height // 4, 3 * width // 4, 3 * height // 4, width // 4)]
+
+
+def image(height=400, width=800):
+    return np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+
+def sample():
+    """The sample image of the repository: one face around (224, 801, 494, 531)."""
+    return cv2.cvtColor(cv2.imread(resolve_path('1.jpg')), cv2.COLOR_BGR2RGB)
+
+
+def test_full_resolution_by_default():
+    detector = configured_detector(DETECTION_CONFIG, 'hog')
+    assert detector.max_side is None and detector.prefilter is None
+    backend = CenterBackend()
+    assert FaceDetector(backend=backend).locate(image()) == [(100, 600, 300, 200)]
+    assert backend.shapes == [(400, 800, 3)]
+
+
+def test_bounded_resolution_maps_boxes_back():
+    backend = CenterBackend()
+    assert FaceDetector(max_side=100, backend=backend).locate(image()) == [(96, 600, 296, 200)]
+    assert backend.shapes == [(50, 100, 3)]
+
+
+def test_reduced_decode():
+    backend = CenterBackend()
+    detector = FaceDetector(max_side=100, backend=backend, reduced_decode=True)
+    payload = cv2.imencode('.jpg', image())[1].tobytes()
+    reduced = detector.reduced_copy((400, 800, 3), payload)
+    assert reduced.shape == (50, 100, 3)
+    assert detector.locate(image(), reduced) == [(96, 600, 296, 200)]
+    # base64 payloads and detectors without a bound are decoded once, at full size.
+    assert detector.reduced_copy((400, 800, 3), 'base64') is None
+    assert FaceDetector(reduced_decode=True).reduced_copy((400, 800, 3), payload) is None
+
+
+PREFILTER = {'min_neighbors': 3, 'min_size': 40, 'margin': 0.5}
+
+
+def test_prefilter_skips_face_free_images():
+    backend = CenterBackend()
+    detector = FaceDetector(backend=backend, prefilter=PREFILTER)
+    assert detector.locate(np.full((480, 640, 3), 128, dtype=np.uint8)) == []
+    assert backend.shapes == []
+
+
+def test_prefilter_searches_around_candidates():
+    backend = CenterBackend()
+    image = sample()
+    boxes = FaceDetector(backend=backend, prefilter=PREFILTER).locate(image)
+    # One region around the face is searched, and its box is put back in image coordinates.
+    (height, width, _), = backend.shapes
+    assert height * width < image.shape[0] * image.shape[1]
+    (top, right, bottom, left), = boxes
+    assert top <= 359 <= bottom and left <= 666 <= right
+
+
+def test_prefilter_only_screens_costly_backends():
+    assert FaceDetector(backend=HaarBackend(), prefilter=PREFILTER).prefilter is None
+
+
+def test_hog_by_default(monkeypatch):
+    monkeypatch.setattr(face_detection, 'select_backend', lambda config: pytest.fail("no selection expected"))
+    assert isinstance(build_detector(DETECTION_CONFIG).backend, HogBackend)
+
+
+class SampleFace:
+    """Finds the face of the sample image, taking delay seconds."""
+
+    screened = False
+    delay = 0.0
+
+    def detect(self, rgb_image):
+        time.sleep(self.delay)
+        return [(224, 801, 494, 531)]
+
+
+class SlowSampleFace(SampleFace):
+    delay = 0.002
+
+
+class NoFace(SampleFace):
+    def detect(self, rgb_image):
+        return []
+
+
+class Unavailable:
+    def __init__(self):
+        raise RuntimeError("model files missing")
+
+
+@pytest.fixture
+def auto_config(monkeypatch):
+    for name, backend in (('reference', SlowSampleFace), ('slow', SlowSampleFace), ('fast', SampleFace),
+                          ('blind', NoFace), ('missing', Unavailable)):
+        monkeypatch.setitem(face_detection.DETECTOR_BACKENDS, name, backend)
+    monkeypatch.setattr(face_detection, 'SELECTED_BACKENDS', {})
+    selection = {**DETECTION_CONFIG['selection'], 'candidates': ['blind', 'missing', 'slow', 'fast'],
+                 'reference': 'reference', 'repeat': 2, 'fallback': 'slow'}
+    return {**DETECTION_CONFIG, 'backend': 'auto', 'backends': {}, 'selection': selection}
+
+
+def test_auto_selects_fastest_accurate_backend(auto_config, monkeypatch):
+    calls = []
+    select = face_detection.select_backend
+    monkeypatch.setattr(face_detection, 'select_backend', lambda config: calls.append(1) or select(config))
+    for _ in range(2):
+        assert type(build_detector(auto_config).backend) is SampleFace
+    # Selected once per process and configuration.
+    assert len(calls) == 1
+
+
+def test_auto_falls_back(auto_config):
+    auto_config['selection']['candidates'] = ['blind', 'missing']
+    assert face_detection.select_backend(auto_config) == 'slow'
+
+
+def test_haar_backend_shared_between_threads():
+    backend = HaarBackend()
+    image = sample()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(backend.detect(image))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4 and all(result == results[0] and len(result) == 1 for result in results)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('face_recognition')
+
+import face_encoding
+from config import ENCODING_CONFIG
+from face_encoding import FaceEncoder, build_encoder, profile_encoder
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """The settings face_recognition.face_encodings is called with."""
+    calls = []
+
+    def face_encodings(rgb_image, boxes, num_jitters=1, model='small'):
+        calls.append((model, num_jitters))
+        return [np.zeros(128) for _ in boxes]
+
+    monkeypatch.setattr(face_encoding.face_recognition, 'face_encodings', face_encodings)
+    return calls
+
+
+def encode(encoder):
+    return encoder.encode(np.zeros((64, 64, 3), dtype=np.uint8), [(8, 56, 56, 8)])
+
+
+def test_api_keeps_the_previous_model(calls):
+    encode(build_encoder(ENCODING_CONFIG, 'api'))
+    assert calls == [('small', 1)]
+
+
+@pytest.mark.parametrize('use', ['api', 'registration', 'camera'])
+def test_each_use_encodes_with_its_profile(calls, use):
+    settings = ENCODING_CONFIG['profiles'][ENCODING_CONFIG[use]]
+    assert len(encode(build_encoder(ENCODING_CONFIG, use))) == 1
+    assert calls == [(settings['model'], settings['num_jitters'])]
+
+
+def test_invalid_profiles():
+    with pytest.raises(ValueError):
+        profile_encoder(ENCODING_CONFIG, 'unknown')
+    with pytest.raises(ValueError):
+        build_encoder(ENCODING_CONFIG, 'unknown')
+    with pytest.raises(ValueError):
+        FaceEncoder(model='medium')
+    with pytest.raises(ValueError):
+        FaceEncoder(num_jitters=0)
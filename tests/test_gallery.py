@@ -0,0 +1,203 @@
+import os
+
+import numpy as np
+import pytest
+
+from gallery import GalleryMatcher, GallerySnapshot, SharedGallery, is_valid_partition, publish_shared_gallery, read_generation
+
+
+def gallery(people=100, templates=3, seed=0):
+    """Templates scattered around one point per person."""
+    rng = np.random.default_rng(seed)
+    centers = rng.random((people, 128))
+    matrix = (np.repeat(centers, templates, axis=0) + rng.normal(0, 0.01, (people * templates, 128))).astype(np.float32)
+    return matrix, [f"person{i // templates}" for i in range(people * templates)]
+
+
+def test_best_match_is_the_exact_nearest_face():
+    matrix, names = gallery()
+    matcher = GalleryMatcher(matrix, names, index='linear')
+    probe = matrix[10] + 0.001
+    distances = np.linalg.norm(matrix.astype(np.float64) - probe, axis=1)
+    name, distance = matcher.best_match(probe)
+    assert name == names[int(np.argmin(distances))]
+    assert distance == pytest.approx(distances.min())
+
+
+def test_best_match_tolerance():
+    matrix, names = gallery()
+    name, distance = GalleryMatcher(matrix, names).best_match(np.full(128, 10.0))
+    assert name is None and distance > 0.6
+    assert GalleryMatcher([], []).best_match(np.zeros(128)) == (None, None)
+    with pytest.raises(ValueError):
+        GalleryMatcher(matrix, names[:-1])
+
+
+def test_top_k_lists_nearest_identities_once():
+    matrix, names = gallery()
+    matcher = GalleryMatcher(matrix, names, index='linear')
+    candidates = matcher.top_k(matrix[4], k=5)
+    assert candidates[0] == ('person1', pytest.approx(0.0, abs=1e-6))
+    assert len({name for name, _ in candidates}) == 5
+    assert [d for _, d in candidates] == sorted(d for _, d in candidates)
+    # Each identity is scored by its nearest template.
+    distances = np.linalg.norm(matrix.astype(np.float64) - matrix[4], axis=1)
+    for name, distance in candidates:
+        assert distance == pytest.approx(min(d for d, n in zip(distances, names) if n == name))
+    assert len(matcher.top_k(matrix[4], k=1000)) == 100
+
+
+def test_several_templates_per_person():
+    matrix, names = gallery()
+    # Templates of one person are not stored next to each other.
+    order = np.random.default_rng(1).permutation(len(matrix))
+    matrix, names = matrix[order], [names[i] for i in order]
+    matcher = GalleryMatcher(matrix, names)
+    assert matcher.grouped and matcher.max_templates == 3
+    assert len(matcher.template_rows_of('person3')) == 3 and matcher.template_rows_of('nobody') is None
+    exact = GalleryMatcher(matrix, names, index='linear')
+    for probe in matrix[::11] + 0.01:
+        assert matcher.top_k(probe, k=3) == exact.top_k(probe, k=3)
+
+    # Verification keeps the nearest template of the claimed person only.
+    rows = matcher.template_rows_of('person3')
+    probe = matrix[rows[1]] + 0.001
+    match, distance = matcher.verify('person3', probe)
+    assert match and distance == pytest.approx(np.linalg.norm(matrix[rows] - probe, axis=1).min())
+    assert not matcher.verify('person4', probe)[0]
+    assert matcher.verify('nobody', probe) == (None, None)
+
+
+def test_snapshots_are_immutable():
+    matrix, names = gallery()
+    matcher = GalleryMatcher(matrix, names)
+    empty = GallerySnapshot()
+    snapshot = empty.with_partition('default', matcher)
+    assert empty.get('default') is None and snapshot.get('default') is matcher
+    assert snapshot.version == empty.version + 1
+    removed = snapshot.with_partition('default', None)
+    assert removed.get('default') is None and snapshot.get('default') is matcher
+    with pytest.raises(TypeError):
+        snapshot.matchers['other'] = matcher
+    with pytest.raises(ValueError):
+        matcher.matrix[0, 0] = 0
+    # The caller's array is not frozen along with the matcher's view of it.
+    matrix[0, 0] = 0
+
+
+def test_centroid_top_k_beyond_users():
+    matrix, names = gallery()
+    matcher = GalleryMatcher(matrix, names, index='centroid', index_params={'users': 8})
+    exact = GalleryMatcher(matrix, names, index='linear')
+    assert matcher.top_k(matrix[0], k=20) == exact.top_k(matrix[0], k=20)
+
+
+def test_ivf_matches_linear_search():
+    matrix, names = gallery()
+    exact = GalleryMatcher(matrix, names, index='linear')
+    probes = matrix[::7] + 0.01
+    # Probing every list is an exhaustive scan.
+    ivf = GalleryMatcher(matrix, names, index='ivf', index_params={'nlist': 8, 'nprobe': 8})
+    assert all(ivf.top_k(probe, k=5) == exact.top_k(probe, k=5) for probe in probes)
+    # Probes near an enrolled face are found with the default nprobe.
+    ivf = GalleryMatcher(matrix, names, index='ivf')
+    assert all(ivf.best_match(probe) == exact.best_match(probe) for probe in probes)
+    assert GalleryMatcher([], [], index='ivf').best_match(probes[0]) == (None, None)
+
+
+def test_ivf_rebuild_keeps_training():
+    matrix, names = gallery()
+    first = GalleryMatcher(matrix, names, index='ivf', index_params={'nprobe': 4})
+    changed = matrix.copy()
+    changed[:3] += 0.01
+    second = GalleryMatcher(changed, names, index='ivf', index_params={'nprobe': 4}, previous=first)
+    assert second.index.centroids is first.index.centroids
+    assert second.index.added_rows == 3
+    assert second.best_match(changed[0])[0] == 'person0'
+
+
+def test_pq_reranks_to_exact_distances():
+    matrix, names = gallery()
+    matcher = GalleryMatcher(matrix, names, index='pq', index_params={'m': 16})
+    exact = GalleryMatcher(matrix, names, index='linear')
+    assert matcher.index.codes.nbytes == len(matrix) * 16
+    for probe in matrix[::7] + 0.01:
+        name, distance = matcher.best_match(probe)
+        # The approximate scores only pick the shortlist; the reported distance is exact.
+        assert (name, distance) == exact.best_match(probe)
+
+
+@pytest.mark.parametrize('m', [3, 7, 256])
+def test_pq_rejects_invalid_subquantizers(m):
+    matrix, names = gallery()
+    with pytest.raises(ValueError):
+        GalleryMatcher(matrix, names, index='pq', index_params={'m': m})
+
+
+def test_shared_gallery_generations(tmp_path):
+    matrix, names = gallery()
+    directory = str(tmp_path)
+    shared = SharedGallery(directory)
+    assert not shared.refresh() and len(shared.matcher) == 0
+    assert publish_shared_gallery(directory, matrix[:30], names[:30]) == 1
+    assert shared.refresh() and not shared.refresh()
+    # Readers use the published files as they are.
+    base = shared.matcher.matrix
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert base is not None
+    assert shared.matcher.best_match(matrix[4])[0] == 'person1'
+
+    publish_shared_gallery(directory, matrix, names)
+    publish_shared_gallery(directory, matrix[:3], names[:3])
+    assert read_generation(directory) == 3
+    assert shared.refresh() and shared.generation == 3
+    assert list(shared.matcher.names) == names[:3]
+    # Only the current and the previous generation stay on disk.
+    assert sorted(f for f in os.listdir(directory) if f.endswith('.npy') and 'offsets' not in f) == \
+        ['gallery-2.npy', 'gallery-3.npy']
+
+    publish_shared_gallery(directory, [], [])
+    assert shared.refresh() and shared.matcher.best_match(matrix[0]) == (None, None)
+
+
+def test_sharded_rebuild_keeps_workers():
+    matrix, names = gallery()
+    first = GalleryMatcher(matrix, names, index='sharded', index_params={'shards': 2, 'min_rows': 0})
+    try:
+        enrolled = np.concatenate([matrix, matrix[:1] + 0.5])
+        second = GalleryMatcher(enrolled, names + ['new'], index='sharded', index_params={'shards': 2, 'min_rows': 0},
+                                previous=first)
+        assert second.index.workers is first.index.workers
+        # The first shard is unchanged and the old gallery still answers from its own shards.
+        assert list(second.index.bounds[:2]) == list(first.index.bounds[:2])
+        assert second.best_match(enrolled[-1])[0] == 'new'
+        assert first.top_k(matrix[5], k=3) == GalleryMatcher(matrix, names, index='linear').top_k(matrix[5], k=3)
+    finally:
+        first.index.close()
+
+
+def test_small_sharded_gallery_runs_in_process():
+    matrix, names = gallery()
+    assert GalleryMatcher(matrix, names, index='sharded').index.workers is None
+    assert GalleryMatcher([], [], index='sharded').index.workers is None
+
+
+@pytest.mark.parametrize('dtype, bytes_per_value', [('int8', 1), ('float16', 2)])
+def test_quantized_index_keeps_only_codes(dtype, bytes_per_value):
+    matrix, names = gallery()
+    matcher = GalleryMatcher(matrix, names, index='quantized', index_params={'dtype': dtype})
+    # The index holds the codes and their norms, not the float32 matrix, and the matcher no norms of its own.
+    assert matcher.index.codes.nbytes == matrix.size * bytes_per_value
+    assert not any(value is matrix or getattr(value, 'base', None) is matrix for value in vars(matcher.index).values())
+    assert matcher.sq_norms is None
+    exact = GalleryMatcher(matrix, names, index='linear')
+    assert matcher.top_k(matrix[7], k=5) == exact.top_k(matrix[7], k=5)
+
+
+@pytest.mark.parametrize('partition, valid', [
+    ('default', True), ('site-b', True), ('tenant_1.eu', True), ('x' * 64, True),
+    ('', False), ('.hidden', False), ('../etc', False), ('a/b', False), ('x' * 65, False), (None, False), (3, False),
+])
+def test_partition_names(partition, valid):
+    assert is_valid_partition(partition) == valid
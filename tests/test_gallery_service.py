@@ -0,0 +1,158 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('face_recognition')
+
+import gallery_service
+from encoding_format import unpack_encodings
+from gallery_service import FileStore, GalleryService, MongoStore, SQLiteStore, build_store
+
+
+def encoding(value):
+    return np.full(128, value, dtype=np.float32)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteStore(str(tmp_path / 'gallery.db'))
+    store.add_user('alice', [encoding(0.1)])
+    store.add_user('bob', [encoding(0.2)])
+    return store
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    client = mongomock.MongoClient()
+    # Every MongoStore of the test connects to the same in-memory server.
+    monkeypatch.setattr(gallery_service, 'MongoClient', lambda host: client)
+    return client
+
+
+def test_sqlite_store(store, tmp_path):
+    assert store.poll() == {'default'}
+    store.add_user('carol', [encoding(0.3), encoding(0.35)], partition='site-b')
+    with pytest.raises(ValueError):
+        store.add_user('alice', [encoding(0.5)])
+    assert store.poll() == {'site-b'} and store.poll() == set()
+    matcher = store.matcher('site-b')
+    assert list(matcher.names) == ['carol', 'carol'] and matcher.verify('carol', encoding(0.35))[0]
+    assert np.array_equal(unpack_encodings(store.find_user('carol', 'site-b')), [encoding(0.3), encoding(0.35)])
+    assert store.find_user('carol') is None
+    assert store.user_name(1) == 'alice' and store.user_name('9') is None
+    with pytest.raises(ValueError):
+        store.user_name('alice')
+    # A store scoped to some partitions never loads the others.
+    scoped = SQLiteStore(store.path, scope=['site-b'])
+    assert scoped.poll() == {'site-b'} and 'default' not in scoped.partitions
+
+
+def test_file_store(tmp_path):
+    writer = build_store('file', directory=str(tmp_path))
+    reader = FileStore(str(tmp_path), matcher_options={'index': 'linear'})
+    assert reader.poll() == set() and len(reader.matcher('default')) == 0
+    writer.add_user('alice', [encoding(0.1)])
+    writer.add_user('bob', [encoding(0.2), encoding(0.25)], partition='site-b')
+    with pytest.raises(ValueError):
+        writer.add_user('alice', [encoding(0.5)])
+    assert reader.poll() == {'default', 'site-b'} and reader.poll() == set()
+    assert reader.matcher('site-b').best_match(encoding(0.25))[0] == 'bob'
+    assert np.array_equal(unpack_encodings(reader.find_user('bob', 'site-b')), [encoding(0.2), encoding(0.25)])
+    assert reader.find_user('bob') is None and reader.user_name(1) is None
+    writer.add_user('carol', [encoding(0.3)])
+    assert reader.poll() == {'default'} and sorted(reader.matcher('default').names) == ['alice', 'carol']
+
+
+def test_stats(store):
+    service = GalleryService(store)
+    service.refresh()
+    store.add_user('carol', [encoding(0.3)], partition='site-b')
+    service.refresh()
+    stats = service.stats()
+    assert stats['store'] == 'SQLiteStore' and stats['faces'] == 3
+    assert stats['partitions'] == {'default': 2, 'site-b': 1}
+    assert stats['polls'] == 2 and stats['reloads'] == 2 and stats['errors'] == 0
+
+
+def test_reload_keeps_served_matchers(store):
+    service = GalleryService(store)
+    assert service.refresh() == {'default'}
+    matcher = service.get()
+    version = service.snapshot.version
+    store.add_user('carol', [encoding(0.3)])
+    assert service.refresh() == {'default'}
+    # A request holding the old matcher keeps a consistent gallery.
+    assert sorted(matcher.names) == ['alice', 'bob'] and matcher.best_match(encoding(0.3))[0] is None
+    current = service.get()
+    assert sorted(current.names) == ['alice', 'bob', 'carol']
+    assert service.snapshot.version > version
+    # Nothing changed: the same matcher stays published.
+    assert service.refresh() == set() and service.get() is current
+
+
+def test_warm_start(mongo, tmp_path, monkeypatch):
+    first = GalleryService(MongoStore(), snapshot_directory=str(tmp_path))
+    first.store.add_user('alice', [encoding(0.1)])
+    first.store.add_user('bob', [encoding(0.2), encoding(0.25)])
+    first.refresh()
+    # Saved right after the first load, with nothing to start from.
+    assert first.metrics['snapshot_saves'] == 1
+    first.store.add_user('carol', [encoding(0.3)])
+    first.store.close()
+
+    service = GalleryService(MongoStore(), snapshot_directory=str(tmp_path))
+    reads = []
+    find = service.store._find
+    monkeypatch.setattr(service.store, '_find', lambda query: reads.append(query) or find(query))
+    assert service.readiness()['state'] == 'stopped'
+    assert service.warm_start()
+    # Ready from the mapped snapshot without reading a user.
+    assert service.readiness()['ready'] and reads == []
+    assert sorted(service.get().identities) == ['alice', 'bob'] and len(service.get()) == 3
+    # The first poll only catches up with what changed since the snapshot.
+    assert service.refresh() == {'default'}
+    assert sorted(service.get().identities) == ['alice', 'bob', 'carol']
+    assert service.get().best_match(encoding(0.3))[0] == 'carol'
+
+
+def test_warm_start_without_snapshot(mongo, tmp_path):
+    service = GalleryService(MongoStore(), snapshot_directory=str(tmp_path / 'missing'))
+    assert not service.warm_start() and not service.readiness()['ready']
+
+
+class FlakyStore(SQLiteStore):
+    """Fails its first poll, then waits for release before polling."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.failed = threading.Event()
+        self.release = threading.Event()
+
+    def poll(self):
+        if not self.failed.is_set():
+            self.failed.set()
+            raise RuntimeError('database down')
+        self.release.wait()
+        return super().poll()
+
+
+def test_readiness(tmp_path):
+    store = FlakyStore(str(tmp_path / 'gallery.db'))
+    store.add_user('alice', [encoding(0.1)])
+    service = GalleryService(store)
+    assert service.readiness()['state'] == 'stopped' and not service.wait_ready(0)
+    service.start(0.05)
+    deadline = time.monotonic() + 10
+    while service.metrics['errors'] < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # A failed first load is reported and retried on the next interval.
+    readiness = service.readiness()
+    assert readiness['state'] == 'failed' and not readiness['ready'] and readiness['last_error'] == 'database down'
+    assert readiness['seconds_to_ready'] is None
+    store.release.set()
+    assert service.wait_ready(10)
+    readiness = service.readiness()
+    assert readiness['state'] == 'ready' and readiness['faces'] == 1 and readiness['seconds_to_ready'] >= 0
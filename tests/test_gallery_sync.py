@@ -0,0 +1,341 @@
+import base64
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from bson import ObjectId
+
+mongomock = pytest.importorskip('mongomock')
+
+from encoding_format import ENCODING_FORMAT, encoding_fields, stored_encodings
+from gallery import NameTable
+from gallery_chunks import GalleryChunks
+import gallery_sync
+from gallery_sync import GallerySync, map_snapshot, user_hash, user_hashes
+
+
+def encoding(value):
+    return np.full(128, value, dtype=np.float32)
+
+
+def user(name, value, partition='default', version=1, updated_at=None):
+    return {
+        'name': name,
+        'partition': partition,
+        **encoding_fields([encoding(value)]),
+        'updated_at': updated_at or datetime.utcnow(),
+        'version': version,
+    }
+
+
+@pytest.fixture
+def users():
+    return mongomock.MongoClient().db.users
+
+
+def decode(doc):
+    return stored_encodings(doc) or b''
+
+
+@pytest.fixture
+def sync(users):
+    users.insert_many([user('alice', 0.1), user('bob', 0.2), user('carol', 0.3, partition='site-b')])
+    sync = GallerySync(users, decode)
+    assert sync.poll() == {'default', 'site-b'}
+    return sync
+
+
+def names(sync, partition='default'):
+    return sorted(sync.matcher(partition).names)
+
+
+def test_full_load(sync):
+    assert names(sync) == ['alice', 'bob']
+    assert names(sync, 'site-b') == ['carol']
+    matcher = sync.matcher('default')
+    assert matcher.best_match(encoding(0.2))[0] == 'bob'
+    # mongomock has no $reduce: the sync falls back to diffing instead of failing.
+    assert not sync.server_fingerprints
+
+
+def test_idle_poll(sync):
+    assert sync.poll() == set()
+    assert names(sync) == ['alice', 'bob']
+
+
+def test_update(sync, users):
+    users.update_one({'name': 'bob'}, {'$set': {**encoding_fields([encoding(0.5)]), 'updated_at': datetime.utcnow()},
+                                       '$inc': {'version': 1}})
+    assert sync.poll() == {'default'}
+    assert sync.matcher('default').verify('bob', encoding(0.5))[0]
+
+
+def test_delete(sync, users):
+    users.delete_one({'name': 'alice'})
+    assert sync.poll() == {'default'}
+    assert names(sync) == ['bob']
+    users.delete_one({'name': 'carol'})
+    assert sync.poll() == {'site-b'}
+    assert 'site-b' not in sync.partitions
+
+
+def python_fingerprints(collection, query=None):
+    """partition_fingerprints() computed here, since mongomock has no $reduce."""
+    fingerprints = {}
+    for doc in collection.find(query or {}):
+        partition = doc.get('partition') or 'default'
+        count, newest, hash_sum = fingerprints.get(partition, (0, None, 0))
+        updated_at = doc.get('updated_at')
+        if newest is None or (updated_at is not None and updated_at > newest):
+            newest = updated_at
+        fingerprints[partition] = (count + 1, newest, hash_sum + user_hash(doc['_id'], doc.get('version', 0)))
+    return fingerprints
+
+
+def test_user_hashes():
+    ids = [ObjectId() for _ in range(5)]
+    expected = [user_hash(user_id, version) for version, user_id in enumerate(ids)]
+    assert user_hashes(np.frombuffer(b''.join(i.binary for i in ids), dtype=np.uint8), range(5)).tolist() == expected
+
+
+def test_unchanged_fingerprint_skips_reads(users, monkeypatch):
+    monkeypatch.setattr(gallery_sync, 'partition_fingerprints', python_fingerprints)
+    users.insert_many([user('alice', 0.1), user('bob', 0.2), user('carol', 0.3, partition='site-b')])
+    sync = GallerySync(users, decode)
+    sync.poll()
+    assert sync.server_fingerprints
+    # The users in memory hash to what the server reports.
+    assert sync.partitions['default'].fingerprint() == python_fingerprints(users)['default']
+    reads = []
+    find = sync._find
+    monkeypatch.setattr(sync, '_find', lambda query: reads.append(query) or find(query))
+    assert sync.poll() == set() and reads == []
+    # The updated_at watermark cannot see a delete: only the fingerprint does.
+    users.delete_one({'name': 'alice'})
+    assert sync.poll() == {'default'} and names(sync) == ['bob']
+    assert sync.poll() == set()
+
+
+def test_delete_and_insert(sync, users):
+    # Same count afterwards, and the new user is older than the watermark window.
+    users.delete_one({'name': 'alice'})
+    users.insert_one(user('dave', 0.4, updated_at=datetime.utcnow() - timedelta(days=1)))
+    assert sync.poll() == {'default'}
+    assert names(sync) == ['bob', 'dave']
+    assert sync.poll() == set()
+
+
+def test_late_write_within_overlap(sync, users, monkeypatch):
+    # Committed after the last poll but stamped before it, as by a writer with a slower clock.
+    users.insert_one(user('dave', 0.4, updated_at=sync.watermark - timedelta(seconds=1)))
+    reads = []
+    find = sync._find
+    monkeypatch.setattr(sync, '_find', lambda query: reads.append(query) or find(query))
+    assert sync.poll() == {'default'} and names(sync) == ['alice', 'bob', 'dave']
+    # Picked up by the updated_at watermark read, which only asks for recent writes.
+    assert reads[0]['updated_at'] == {'$gte': sync.watermark - sync.overlap}
+
+
+def test_scope(users):
+    users.insert_many([user('alice', 0.1), user('bob', 0.2, partition=None), user('carol', 0.3, partition='site-b')])
+    sync = GallerySync(users, decode, scope=['default'])
+    # Users without a partition belong to the default one.
+    assert sync.poll() == {'default'} and names(sync) == ['alice', 'bob']
+    users.insert_one(user('dave', 0.4, partition='site-b'))
+    assert sync.poll() == set() and 'site-b' not in sync.partitions
+
+
+def test_restore_snapshot(sync, users, tmp_path):
+    sync.save_snapshot(str(tmp_path))
+    users.delete_one({'name': 'alice'})
+    users.update_one({'name': 'bob'}, {'$set': encoding_fields([encoding(0.5)]), '$inc': {'version': 1}})
+    users.insert_one(user('dave', 0.4))
+
+    restored = GallerySync(users, decode)
+    assert restored.restore_snapshot(map_snapshot(str(tmp_path)))
+    # Restored users stay packed until they change.
+    assert names(restored) == ['alice', 'bob'] and not restored.partitions['default'].entries
+    assert restored.poll() == {'default'}
+    assert names(restored) == ['bob', 'dave']
+    assert restored.matcher('default').verify('bob', encoding(0.5))[0]
+    assert names(restored, 'site-b') == ['carol'] and not restored.partitions['site-b'].entries
+    assert restored.poll() == set()
+
+
+def test_chunk_load(users):
+    users.insert_many([user('alice', 0.1), user('bob', 0.2), user('carol', 0.3, partition='site-b')])
+    chunks = GalleryChunks(users.database.gallery_chunks)
+    chunks.rebuild(users)
+    # Every user packed twice, as while a rebuild runs.
+    for chunk in list(chunks.collection.find()):
+        del chunk['_id']
+        chunks.collection.insert_one(chunk)
+    sync = GallerySync(users, decode, chunks=chunks)
+    assert sync.poll() == {'default', 'site-b'}
+    assert names(sync) == ['alice', 'bob']
+    assert names(sync, 'site-b') == ['carol']
+    users.delete_one({'name': 'bob'})
+    assert sync.poll() == {'default'}
+    assert names(sync) == ['alice']
+
+
+def chunk_rows(chunks):
+    """{partition: (row names, matrix)} as loaded from the chunks."""
+    return {partition: (list(NameTable(packed['names'], packed['name_offsets'])), packed['matrix'])
+            for partition, packed in chunks.load().items()}
+
+
+def test_chunk_writes(users):
+    chunks = GalleryChunks(users.database.gallery_chunks, chunk_rows=3)
+    carol = {**user('carol', 0.3), **encoding_fields([encoding(0.3), encoding(0.35)])}
+    ids = users.insert_many([user('alice', 0.1), user('bob', 0.2), carol]).inserted_ids
+    chunks.write_users(users, ids)
+    # carol's two templates do not fit next to alice and bob.
+    assert chunks.collection.count_documents({}) == 2
+    names, matrix = chunk_rows(chunks)['default']
+    assert names == ['alice', 'bob', 'carol', 'carol']
+    assert np.array_equal(matrix, [encoding(0.1), encoding(0.2), encoding(0.3), encoding(0.35)])
+
+    chunks.remove_user(ids[0])
+    names, matrix = chunk_rows(chunks)['default']
+    assert names == ['bob', 'carol', 'carol'] and np.array_equal(matrix[0], encoding(0.2))
+    # Rewriting a user replaces its previous copy.
+    users.update_one({'_id': ids[1]}, {'$set': encoding_fields([encoding(0.5)]), '$inc': {'version': 1}})
+    chunks.write_users(users, [ids[1]])
+    names, matrix = chunk_rows(chunks)['default']
+    assert sorted(names) == ['bob', 'carol', 'carol'] and np.array_equal(matrix[names.index('bob')], encoding(0.5))
+    chunks.remove_user(ids[2])
+    chunks.remove_user(ids[2])
+    assert chunk_rows(chunks)['default'][0] == ['bob'] and chunks.collection.count_documents({}) == 1
+    # Legacy records stay out of the chunks.
+    legacy = users.insert_one({'name': 'dave', 'face_encoding': 'data:image/png;base64,AAAA'}).inserted_id
+    chunks.write_users(users, [legacy])
+    assert chunk_rows(chunks)['default'][0] == ['bob']
+
+
+def test_legacy_conversion(users, monkeypatch):
+    pytest.importorskip('cv2')
+    pytest.importorskip('face_recognition')
+    from face_detection import resolve_path
+    from legacy_conversion import LegacyConverter
+
+    with open(resolve_path('1.jpg'), 'rb') as f:
+        image = 'data:image/jpeg;base64,' + base64.b64encode(f.read()).decode()
+    users.insert_many([
+        {'name': 'erin', 'partition': 'default', 'face_encoding': image, 'updated_at': datetime.utcnow(), 'version': 1},
+        {'name': 'frank', 'partition': 'default', 'face_encoding': 'data:image/png;base64,AAAA',
+         'updated_at': datetime.utcnow(), 'version': 1},
+    ])
+    # mongomock's bulk_write does not take the UpdateOne of recent pymongo versions.
+    monkeypatch.setattr(users, 'bulk_write', lambda updates, ordered=True: [
+        users.update_one(update._filter, update._doc) for update in updates])
+    converter = LegacyConverter(users, workers=1, max_pending=1)
+
+    def decode_user(doc):
+        # As MongoStore.decode_user: records holding an image are queued for conversion.
+        data = stored_encodings(doc)
+        if data is None:
+            converter.submit(doc)
+        return data or b''
+
+    sync = GallerySync(users, decode_user)
+    try:
+        sync.poll()
+        assert names(sync) == []
+        # Queued once however often the loaders see the record; only the running conversion holds its image.
+        for doc in users.find():
+            converter.submit(doc)
+        assert len(converter.pending) == 1 and len(converter.backlog) == 1
+        deadline = time.monotonic() + 60
+        while converter.busy() and time.monotonic() < deadline:
+            converter.flush()
+            time.sleep(0.05)
+        assert not converter.busy()
+    finally:
+        converter.close()
+
+    erin = users.find_one({'name': 'erin'})
+    assert erin['encoding_format'] == ENCODING_FORMAT and erin['version'] == 2 and 'face_encoding' not in erin
+    # Records without a usable face are left as they are.
+    assert 'encoding_format' not in users.find_one({'name': 'frank'})
+    assert sync.poll() == {'default'} and names(sync) == ['erin']
+
+
+def mapped(array):
+    while array is not None and not isinstance(array, np.memmap):
+        array = array.base
+    return array is not None
+
+
+def test_map_partition(sync, users, tmp_path):
+    options = {'index': 'pq', 'index_params': {'m': 8}, 'rerank': 4}
+    matcher = sync.map_partition('default', str(tmp_path), **options)
+    # The full-precision rows stay mapped and are only read for the re-ranking.
+    assert mapped(matcher.matrix) and matcher.sq_norms is None
+    assert matcher.best_match(encoding(0.2))[0] == 'bob'
+    assert not sync.partitions['default'].entries
+    users.update_one({'name': 'bob'}, {'$set': encoding_fields([encoding(0.5)]), '$inc': {'version': 1}})
+    assert sync.poll() == {'default'}
+    matcher = sync.map_partition('default', str(tmp_path), previous=matcher, **options)
+    assert matcher.verify('bob', encoding(0.5))[0] and sorted(matcher.names) == ['alice', 'bob']
+    assert sync.map_partition('missing', str(tmp_path / 'missing')) is None
+
+
+class FakeStream:
+    """Change events served by try_next with the $project of the watch pipeline applied, as the server does."""
+
+    def __init__(self, pipeline):
+        self.projection = pipeline[0]['$project']
+        self.events = []
+
+    def push(self, event):
+        projected = {key: event[key] for key in ('operationType', 'documentKey') if key in event}
+        if event.get('fullDocument') is not None:
+            fields = {key.split('.', 1)[1] for key in self.projection if key.startswith('fullDocument.')}
+            projected['fullDocument'] = {k: v for k, v in event['fullDocument'].items() if k in fields}
+        self.events.append(projected)
+
+    def try_next(self):
+        return self.events.pop(0) if self.events else None
+
+    def close(self):
+        pass
+
+
+def test_change_stream(users, monkeypatch):
+    streams = []
+
+    def watch(pipeline, **options):
+        streams.append(FakeStream(pipeline))
+        return streams[-1]
+
+    monkeypatch.setattr(users, 'watch', watch, raising=False)
+    users.insert_many([user('alice', 0.1), user('bob', 0.2)])
+    sync = GallerySync(users, decode)
+    assert sync.poll() == {'default'}
+    stream, = streams
+
+    dave = users.find_one({'_id': users.insert_one(user('dave', 0.4)).inserted_id})
+    stream.push({'operationType': 'insert', 'documentKey': {'_id': dave['_id']}, 'fullDocument': dave})
+    bob = users.find_one({'name': 'bob'})
+    bob.update({**encoding_fields([encoding(0.5)]), 'version': 2})
+    stream.push({'operationType': 'update', 'documentKey': {'_id': bob['_id']}, 'fullDocument': bob})
+    alice = users.find_one({'name': 'alice'})
+    stream.push({'operationType': 'delete', 'documentKey': {'_id': alice['_id']}})
+    assert sync.poll() == {'default'}
+    assert names(sync) == ['bob', 'dave']
+    assert sync.matcher('default').verify('bob', encoding(0.5))[0]
+    assert sync.poll() == set()
+
+
+@pytest.mark.parametrize('index, served_mapped', [('pq', True), ('quantized', True), ('linear', False)])
+def test_service_maps_compressed_galleries(sync, tmp_path, index, served_mapped):
+    pytest.importorskip('face_recognition')
+    from gallery_service import GalleryService
+    service = GalleryService(sync, {'index': index, 'rerank': 4}, snapshot_directory=str(tmp_path))
+    service.unconfirmed = {'default', 'site-b'}
+    service.refresh()
+    matcher = service.get('default')
+    assert mapped(matcher.matrix) == served_mapped
+    assert matcher.best_match(encoding(0.2))[0] == 'bob'